@@ -5,6 +5,132 @@ Aircraft Class - Manage an Aircraft entity
 """
 
 import datetime
+import sys
+import time
+
+# Field presence bits - one per decoded dump1090 field
+FIELD_FLIGHT = 0x001
+FIELD_SQUAWK = 0x002
+FIELD_GS = 0x004
+FIELD_LAT = 0x008
+FIELD_LON = 0x010
+FIELD_ALT = 0x020
+FIELD_TRACK = 0x040
+FIELD_VSI = 0x080
+FIELD_CATEGORY = 0x100
+
+# Fields required for a quality record
+QUALITY_FIELDS = (
+    FIELD_FLIGHT | FIELD_SQUAWK | FIELD_GS | FIELD_LAT | FIELD_LON | FIELD_ALT
+)
+
+# Fields whose first appearance counts as useful new info in Aircraft.update()
+UPDATE_FIELDS = QUALITY_FIELDS
+
+# Fields that mean the aircraft moved - distances / airspaces need redoing
+POSITION_FIELDS = FIELD_LAT | FIELD_LON | FIELD_ALT
+
+# Slots kept in memory only - per tick counters and the track history are
+# not part of the saved record, so they never cause a record to be rewritten
+TRANSIENT_SLOTS = frozenset(("changed_mask", "update_counter", "history"))
+
+EMERGENCY_SQUAWKS = frozenset(("7700", "7600", "7500"))
+
+CATEGORY_TEXT = {
+    "A1": "Cat:Light",
+    "A2": "Cat:Small",
+    "A3": "Cat:Large",
+    "A4": "Cat:Large",
+    "A5": "Cat:Heavy",
+    "A7": "Cat:Rotor",
+}
+
+CARDINAL_DIRECTIONS = (
+    "N",
+    "NNE",
+    "NE",
+    "ENE",
+    "E",
+    "ESE",
+    "SE",
+    "SSE",
+    "S",
+    "SSW",
+    "SW",
+    "WSW",
+    "W",
+    "WNW",
+    "NW",
+    "NNW",
+)
+
+
+def _intern(value):
+    """Intern repeated short strings (squawk, category, typecode ...)"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def _first_word(value):
+    """First word of a Global DB text field, interned"""
+    if value is None:
+        return None
+    return _intern(value.split(" ", 1)[0])
+
+
+def decode_fields(adsb_record):
+    """
+    Decode the dump1090 fields Barkley uses
+    Returns (field mask, {slot name: value}) for the fields present
+    """
+    mask = 0
+    values = {}
+    if "flight" in adsb_record:
+        mask |= FIELD_FLIGHT
+        values["flight_id"] = adsb_record["flight"].strip()
+    if "squawk" in adsb_record:
+        mask |= FIELD_SQUAWK
+        values["squawk_code"] = _intern(adsb_record["squawk"])
+    if "gs" in adsb_record:
+        mask |= FIELD_GS
+        values["ground_speed"] = adsb_record["gs"]
+    if "lat" in adsb_record:
+        mask |= FIELD_LAT
+        values["latitude"] = adsb_record["lat"]
+    if "lon" in adsb_record:
+        mask |= FIELD_LON
+        values["longitude"] = adsb_record["lon"]
+    if "alt_baro" in adsb_record:
+        mask |= FIELD_ALT
+        values["altitude"] = _intern(adsb_record["alt_baro"])
+    if "track" in adsb_record:
+        mask |= FIELD_TRACK
+        values["track_angle"] = adsb_record["track"]
+    if "geom_rate" in adsb_record:
+        mask |= FIELD_VSI
+        values["vertical_rate"] = adsb_record["geom_rate"]
+    if "category" in adsb_record:
+        mask |= FIELD_CATEGORY
+        category = adsb_record["category"]
+        values["category_text"] = _intern(
+            CATEGORY_TEXT.get(category, "Raw:" + category)
+        )
+    return mask, values
+
+
+# Field bit for each decoded slot
+FIELD_SLOTS = {
+    "flight_id": FIELD_FLIGHT,
+    "squawk_code": FIELD_SQUAWK,
+    "ground_speed": FIELD_GS,
+    "latitude": FIELD_LAT,
+    "longitude": FIELD_LON,
+    "altitude": FIELD_ALT,
+    "track_angle": FIELD_TRACK,
+    "vertical_rate": FIELD_VSI,
+    "category_text": FIELD_CATEGORY,
+}
 
 
 class Aircraft:
@@ -13,62 +139,142 @@ class Aircraft:
     Initially it's all aircraft - but who knows what else turns up
     Initially it's all ADSB data - but as Barkley gets smarter
     we should be able to include more sources
+
+    The dump1090 record is decoded once, when it arrives, into slots -
+    the raw dictionary is not kept. field_mask records which fields
+    have been reported so far, changed_mask which fields changed value
+    since the last clear_changes() (once per tick).
     """
 
-    data = None
-    global_db = None
-    airport_distance = 0
-    create_time = 0
-    flutter_sent = 0
-    update_counter = 0
-    manufacturer = None
-    typecode = None
-    model = None
-    entered_interesting_location = False
+    __slots__ = (
+        "hex_code",
+        "flight_id",
+        "squawk_code",
+        "ground_speed",
+        "latitude",
+        "longitude",
+        "altitude",
+        "track_angle",
+        "vertical_rate",
+        "category_text",
+        "field_mask",
+        "changed_mask",
+        "global_db",
+        "airport_distance",
+        "create_time",
+        "last_seen",
+        "flutter_sent",
+        "update_counter",
+        "manufacturer",
+        "typecode",
+        "model",
+        "entered_interesting_location",
+        "airspaces",
+        "revision_counter",
+        "history",
+    )
 
     def __init__(self, aircraft_data):
         """Init object and set initial values for internals"""
-        self.data = aircraft_data
+        self.hex_code = aircraft_data.get("hex")
+        self.flight_id = None
+        self.squawk_code = None
+        self.ground_speed = None
+        self.latitude = None
+        self.longitude = None
+        self.altitude = None
+        self.track_angle = None
+        self.vertical_rate = None
+        self.category_text = None
+        self.field_mask, values = decode_fields(aircraft_data)
+        for slot, value in values.items():
+            setattr(self, slot, value)
+        self.changed_mask = self.field_mask
         self.global_db = []
         self.airport_distance = {}
         self.create_time = datetime.datetime.now()
+        self.last_seen = time.time()
         self.flutter_sent = 0
         self.update_counter = 0
         self.manufacturer = None
         self.typecode = None
         self.model = None
         self.entered_interesting_location = False
+        self.airspaces = ()
+        self.revision_counter = 0
+        self.history = None
+
+    def __getstate__(self):
+        """Pickle support - slots as a dictionary, without the transient ones"""
+        return {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if slot not in TRANSIENT_SLOTS
+        }
+
+    def __setstate__(self, state):
+        """
+        Pickle support - also accepts records saved before Aircraft
+        used slots, which kept the raw dump1090 dictionary in 'data'
+        """
+        if "data" in state:
+            legacy = dict(state)
+            state = self.__class__(legacy.pop("data")).__getstate__()
+            state.update(
+                {key: value for key, value in legacy.items() if key in state}
+            )
+            # Not a real sighting - fall back on create_time below
+            state["last_seen"] = legacy.get("last_seen")
+        for slot in self.__slots__:
+            setattr(self, slot, state.get(slot))
+        # Older records carried these - they are rebuilt at runtime
+        self.history = None
+        self.update_counter = 0
+        if self.airspaces is None:
+            self.airspaces = ()
+        if self.revision_counter is None:
+            self.revision_counter = 0
+        if self.changed_mask is None:
+            self.changed_mask = 0
+        if self.last_seen is None:
+            # Saved before last seen was tracked
+            self.last_seen = self.create_time.timestamp() if self.create_time else 0.0
 
     def created(self):
         """Get created time"""
         return self.create_time
 
+    def seen(self, timestamp=None):
+        """Record that the aircraft was in the latest snapshot"""
+        self.last_seen = time.time() if timestamp is None else timestamp
+
+    def last_seen_time(self):
+        """Time (epoch seconds) the aircraft was last in a snapshot"""
+        return self.last_seen
+
+    def revision(self):
+        """Revision number - changes whenever the stored record changes"""
+        return self.revision_counter
+
+    def record_changed(self):
+        """Bump the revision so the state store knows to save this record"""
+        self.revision_counter += 1
+
     def fluttered(self):
         """True if this aircraft record is marked as fluttered"""
-        result = False
-        if self.flutter_sent > 0:
-            result = True
-        return result
+        return self.flutter_sent > 0
 
     def hexcode(self):
         """ICAO ADSB Hexcode"""
-        result = None
-        if "hex" in self.data:
-            result = self.data["hex"]
-        return result
+        return self.hex_code
 
     def flight(self):
         """Aircraft ICAO Code"""
-        result = None
-        if "flight" in self.data:
-            result = self.data["flight"].strip()
-        return result
+        return self.flight_id
 
     def squawk(self):
         """Reported SQUAWK Code"""
-        if "squawk" in self.data:
-            return self.data["squawk"]
-        return None
+        return self.squawk_code
 
     def is_emergency(self):
         """
@@ -77,62 +283,31 @@ class Aircraft:
         7600 - Comms failure,
         7500 - Hijacking
         """
-        result = False
-        if "squawk" in self.data:
-            squawk_str = self.data["squawk"]
-            if squawk_str in ("7700", "7600", "7500"):
-                result = True
-        return result
+        return self.squawk_code in EMERGENCY_SQUAWKS
 
     def is_vfr(self):
         """Squawk : 1200"""
-        result = False
-        if "squawk" in self.data:
-            if self.data["squawk"] == "1200":
-                result = True
-        return result
+        return self.squawk_code == "1200"
 
     def lat(self):
         """Reported latitude"""
-        if "lat" in self.data:
-            return self.data["lat"]
-        return None
+        return self.latitude
 
     def lon(self):
         """Reported longitude"""
-        if "lon" in self.data:
-            return self.data["lon"]
-        return None
+        return self.longitude
 
     def gs(self):
         """Reported Ground Speed"""
-        if "gs" in self.data:
-            return self.data["gs"]
-        return None
+        return self.ground_speed
 
     def alt(self):
         """Reported Altitude"""
-        if "alt_baro" in self.data:
-            return self.data["alt_baro"]
-        return None
+        return self.altitude
 
     def category(self):
-        """Query Category Record and convert to text version"""
-        if "category" in self.data:
-            aircraft_category = self.data["category"]
-            result = "Raw:" + aircraft_category
-            if aircraft_category == "A1":
-                result = "Cat:Light"
-            if aircraft_category == "A2":
-                result = "Cat:Small"
-            if aircraft_category in ("A3", "A4"):
-                result = "Cat:Large"
-            if aircraft_category == "A5":
-                result = "Cat:Heavy"
-            if aircraft_category == "A7":
-                result = "Cat:Rotor"
-            return result
-        return None
+        """Category Record converted to text version (decoded at ingest)"""
+        return self.category_text
 
     def get_manufacturer(self):
         """Return the configured manufacturer ID"""
@@ -150,59 +325,64 @@ class Aircraft:
         """Return current number of updates against record"""
         return self.update_counter
 
-    def update(self, adsb_record):
+    def has_fields(self, field_bits):
+        """True if every field in field_bits has been reported"""
+        return (self.field_mask & field_bits) == field_bits
+
+    def update(self, adsb_record, timestamp=None):
         """Process new ADSB record that has the same HEXCODE
-        and update fields"""
+        and update fields - the latest reported values are kept.
+        timestamp = snapshot time, for the track history
+        Returns True if a field we did not have before was added"""
         result = False
         if adsb_record is None:
             return result
         self.update_counter += 1
-        if "flight" not in self.data:
-            if "flight" in adsb_record:
-                self.data["flight"] = adsb_record["flight"]
-                result = True
-        if "gs" not in self.data:
-            if "gs" in adsb_record:
-                self.data["gs"] = adsb_record["gs"]
-                result = True
-        if "lat" not in self.data:
-            if "lat" in adsb_record:
-                self.data["lat"] = adsb_record["lat"]
-                result = True
-        if "lon" not in self.data:
-            if "lon" in adsb_record:
-                self.data["lon"] = adsb_record["lon"]
-                result = True
-        if "squawk" not in self.data:
-            if "squawk" in adsb_record:
-                self.data["squawk"] = adsb_record["squawk"]
-                result = True
-        if "alt_baro" not in self.data:
-            if "alt_baro" in adsb_record:
-                self.data["alt_baro"] = adsb_record["alt_baro"]
-                result = True
-
+        new_mask, values = decode_fields(adsb_record)
+        if new_mask & UPDATE_FIELDS & ~self.field_mask:
+            result = True
+        self.set_fields(new_mask, values, timestamp)
         return result
 
+    def changes(self):
+        """Field bits that changed value since the last clear_changes()"""
+        return self.changed_mask
+
+    def moved(self):
+        """True if the position changed since the last clear_changes()"""
+        return (self.changed_mask & POSITION_FIELDS) != 0
+
+    def clear_changes(self):
+        """Start a new tick - forget which fields changed"""
+        self.changed_mask = 0
+
+    def set_fields(self, field_mask, values, timestamp=None):
+        """
+        Overwrite decoded fields with the latest values
+        - values = {slot name: value} as produced by decode_fields
+        - timestamp = snapshot time the values are from (track history)
+        The revision is only bumped if a value or the field mask changed
+        Returns the field bits whose value changed
+        """
+        changed = 0
+        for slot, value in values.items():
+            if getattr(self, slot) != value:
+                setattr(self, slot, value)
+                changed |= FIELD_SLOTS[slot]
+        self.changed_mask |= changed
+        if changed & POSITION_FIELDS:
+            self.record_track(timestamp)
+        if changed or (field_mask & ~self.field_mask):
+            self.field_mask |= field_mask
+            self.record_changed()
+        return changed
+
     def quality_score(self):
         """
-        Return True if we have the full set of data including
-        hexcode, flight, ground speed, lat, lon, alt and squawk
+        Return the number of the full set of data fields reported
+        flight, squawk, ground speed, lat, lon and alt
         """
-        quality_score = 0
-        if "flight" in self.data:
-            quality_score += 1
-        if "squawk" in self.data:
-            quality_score += 1
-        if "gs" in self.data:
-            quality_score += 1
-        if "lat" in self.data:
-            quality_score += 1
-        if "lon" in self.data:
-            quality_score += 1
-        if "alt_baro" in self.data:
-            quality_score += 1
-        return quality_score
+        return bin(self.field_mask & QUALITY_FIELDS).count("1")
 
     def update_airport_distance(self, airport, distance):
         """Update distance to airport value"""
@@ -210,76 +390,95 @@ class Aircraft:
 
     def get_airport_distance(self, airport):
         """Lookup distance to airport"""
-        result = 0
-        if airport in self.airport_distance:
-            result = self.airport_distance[airport]
-        return result
+        return self.airport_distance.get(airport, 0)
 
     def quality_record(self):
         """
         Return True if we have the full set of data including
         hexcode, flight, ground speed, lat, lon, alt and squawk
         """
-        result = False
-        if self.quality_score() == 6:
-            result = True
-        return result
+        return (self.field_mask & QUALITY_FIELDS) == QUALITY_FIELDS
 
     def mark_as_fluttered(self):
         """Update the internal flag to mark this
         aircraft as one we've fluttered about"""
+        if self.flutter_sent != 1:
+            self.record_changed()
         self.flutter_sent = 1
 
     def update_global_db(self, db_row):
         """Update Aircraft Information based on Global DB Data"""
-        if db_row is None:
+        if (db_row is None) or (db_row == self.global_db):
             return
+        self.record_changed()
         self.global_db = db_row
-        self.manufacturer = db_row[3]
-        if self.manufacturer is not None:
-            self.manufacturer = self.manufacturer.split(" ", 1)[0]
-        self.model = db_row[4]
-        if self.model is not None:
-            self.model = self.model.split(" ", 1)[0]
-        self.typecode = db_row[5]
-        if self.manufacturer is not None:
-            self.typecode = self.typecode.split(" ", 1)[0]
+        self.manufacturer = _first_word(db_row[3])
+        self.model = _first_word(db_row[4])
+        self.typecode = _first_word(db_row[5])
 
     def cardinal(self):
         """Examine ADSB Track information and turn it into a Cardinal Direction"""
-        directions = [
-            "N",
-            "NNE",
-            "NE",
-            "ENE",
-            "E",
-            "ESE",
-            "SE",
-            "SSE",
-            "S",
-            "SSW",
-            "SW",
-            "WSW",
-            "W",
-            "WNW",
-            "NW",
-            "NNW",
-        ]
-        result = "None"
-        if "track" not in self.data:
-            return result
-        track = self.data["track"]
-        index = int((track / 22.5) + 0.5)
-        result = directions[(index % 16)]
-        return result
+        if self.track_angle is None:
+            return "None"
+        index = int((self.track_angle / 22.5) + 0.5)
+        return CARDINAL_DIRECTIONS[(index % 16)]
 
     def vsi(self):
         """Retrieve geom_rate : This is the VSI value recorded by dump1090"""
-        result = None
-        if "geom_rate" in self.data:
-            result = self.data["geom_rate"]
-        return result
+        return self.vertical_rate
 
     def set_interesting_location(self):
-        """Retrieve geom_rate : This is the VSI value recorded by dump1090"""
+        """Mark the aircraft as having been seen inside a known airspace"""
+        if not self.entered_interesting_location:
+            self.record_changed()
         self.entered_interesting_location = True
+
+    def set_airspaces(self, airspace_names):
+        """Record the names of the known airspaces the aircraft is inside"""
+        airspace_names = tuple(airspace_names)
+        if airspace_names != self.airspaces:
+            self.record_changed()
+        self.airspaces = airspace_names
+        if self.airspaces:
+            self.set_interesting_location()
+
+    def get_airspaces(self):
+        """Names of the known airspaces the aircraft was last seen inside"""
+        return self.airspaces
+
+    def in_known_airspace(self):
+        """True if the aircraft was last seen inside any known airspace"""
+        return len(self.airspaces) > 0
+
+    def attach_history(self, history):
+        """Give the aircraft a trackhistory.TrackHistory to record into"""
+        self.history = history
+        self.record_track()
+
+    def detach_history(self):
+        """Remove and return the track history (for release on age out)"""
+        history = self.history
+        self.history = None
+        return history
+
+    def track_history(self):
+        """The aircraft's TrackHistory, or None if it has none"""
+        return self.history
+
+    def record_track(self, timestamp=None):
+        """
+        Append the current position and kinematics to the track history
+        - timestamp = snapshot time, default the time last seen
+        """
+        if (self.history is None) or (self.latitude is None):
+            return
+        if timestamp is None:
+            timestamp = self.last_seen
+        self.history.append(
+            timestamp,
+            self.latitude,
+            self.longitude,
+            self.altitude,
+            self.ground_speed,
+            self.track_angle,
+        )
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Aircraft Table - Compact, memory mapped icao24 lookup table.
+
+An alternative to the SQLite Global DB for lookups. The aircraft database
+is compiled into one binary file which is mmap()ed at startup - nothing is
+parsed or loaded up front, and a lookup is a binary search over the mapped
+pages.
+
+File layout (all integers little endian unless noted)
+
+    header   : magic 'BKLYACT1', record count (uint32), pool offset (uint32)
+    keys     : record count x 3 byte icao24, big endian, sorted ascending
+    fields   : record count x 5 x uint32 string pool offsets
+               (registration, manufacturericao, manufacturername,
+                model, typecode) - 0xFFFFFFFF means no value
+    pool     : interned strings, each a uint16 length + utf-8 bytes
+
+Big endian keys sort the same way bytes compare, so the binary search
+compares raw 3 byte slices without decoding them.
+"""
+
+import mmap
+import os
+import struct
+
+TABLE_MAGIC = b"BKLYACT1"
+HEADER = struct.Struct("<8sII")
+FIELD_COUNT = 5
+FIELDS = struct.Struct("<" + "I" * FIELD_COUNT)
+STRING_LENGTH = struct.Struct("<H")
+NO_VALUE = 0xFFFFFFFF
+KEY_SIZE = 3
+
+
+def _pool_string(value):
+    """utf-8 bytes of a pool string, cut to fit a uint16 length on a character boundary"""
+    encoded = value.encode("utf-8")
+    if len(encoded) > 0xFFFF:
+        encoded = encoded[:0xFFFF].decode("utf-8", "ignore").encode("utf-8")
+    return encoded
+
+
+def compile_table(rows, table_file):
+    """
+    Compile aircraft rows into a table file
+    - rows = iterable of (icao24 int, registration, manufacturericao,
+             manufacturername, model, typecode), sorted by icao24
+    Rows are streamed - keys are written out as they arrive and the fields
+    spooled to a temporary file, only the string pool is kept in memory
+    Duplicate icao24 values keep the first row given
+    Returns the number of records written - ValueError if rows are not sorted
+    """
+    pool = bytearray()
+    pool_index = {}
+    count = 0
+    previous = -1
+    temp_file = table_file + ".tmp"
+    fields_file = table_file + ".fields.tmp"
+    try:
+        with open(temp_file, "wb") as output, open(fields_file, "w+b") as fields:
+            output.write(HEADER.pack(TABLE_MAGIC, 0, 0))
+            for row in rows:
+                icao = row[0]
+                if icao == previous:
+                    continue
+                if icao < previous:
+                    raise ValueError("aircraft rows are not sorted by icao24")
+                previous = icao
+                offsets = []
+                for value in row[1 : 1 + FIELD_COUNT]:
+                    if value is None:
+                        offsets.append(NO_VALUE)
+                        continue
+                    if value not in pool_index:
+                        encoded = _pool_string(value)
+                        pool_index[value] = len(pool)
+                        pool += STRING_LENGTH.pack(len(encoded)) + encoded
+                    offsets.append(pool_index[value])
+                output.write(icao.to_bytes(KEY_SIZE, "big"))
+                fields.write(FIELDS.pack(*offsets))
+                count += 1
+            fields.seek(0)
+            while True:
+                chunk = fields.read(1 << 20)
+                if not chunk:
+                    break
+                output.write(chunk)
+            pool_offset = output.tell()
+            output.write(pool)
+            output.seek(0)
+            output.write(HEADER.pack(TABLE_MAGIC, count, pool_offset))
+        os.replace(temp_file, table_file)
+    finally:
+        os.remove(fields_file)
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return count
+
+
+def is_table_file(table_file):
+    """True if the file is a compiled aircraft table"""
+    try:
+        with open(table_file, "rb") as table:
+            return table.read(len(TABLE_MAGIC)) == TABLE_MAGIC
+    except OSError:
+        return False
+
+
+class AircraftTable:
+    """Read only, memory mapped view of a compiled aircraft table"""
+
+    def __init__(self, table_file):
+        """Map the table file - raises ValueError if it is not a table"""
+        self.table_file = table_file
+        with open(table_file, "rb") as table:
+            self.mapped = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.record_count, self.pool_offset = HEADER.unpack_from(self.mapped, 0)
+        if magic != TABLE_MAGIC:
+            self.mapped.close()
+            raise ValueError(table_file + " is not an aircraft table")
+        self.keys_offset = HEADER.size
+        self.fields_offset = self.keys_offset + self.record_count * KEY_SIZE
+
+    def __len__(self):
+        return self.record_count
+
+    def close(self):
+        """Unmap the table"""
+        self.mapped.close()
+
+    def _index(self, icao):
+        """Binary search for icao24 - record index or None"""
+        key = icao.to_bytes(KEY_SIZE, "big")
+        mapped = self.mapped
+        base = self.keys_offset
+        low = 0
+        high = self.record_count
+        while low < high:
+            mid = (low + high) // 2
+            position = base + mid * KEY_SIZE
+            probe = mapped[position : position + KEY_SIZE]
+            if probe < key:
+                low = mid + 1
+            elif probe > key:
+                high = mid
+            else:
+                return mid
+        return None
+
+    def _string(self, offset):
+        """
+        Decode one pool string - nothing is kept, repeat lookups are
+        cached by global_aircraft_db.AircraftDbCache
+        """
+        if offset == NO_VALUE:
+            return None
+        position = self.pool_offset + offset
+        (length,) = STRING_LENGTH.unpack_from(self.mapped, position)
+        position += STRING_LENGTH.size
+        return self.mapped[position : position + length].decode("utf-8")
+
+    def find(self, icao_str):
+        """
+        Look up one hexcode
+        Returns a row laid out like global_aircraft_db rows
+        (icao24, registration, manufacturericao, manufacturername, model,
+        typecode) or None if the aircraft is unknown
+        """
+        try:
+            icao = int(icao_str, 16)
+        except ValueError:
+            return None
+        if not 0 <= icao <= 0xFFFFFF:
+            return None
+        index = self._index(icao)
+        if index is None:
+            return None
+        offsets = FIELDS.unpack_from(
+            self.mapped, self.fields_offset + index * FIELDS.size
+        )
+        return ("%06x" % icao,) + tuple(self._string(offset) for offset in offsets)
+
+    def find_many(self, icao_list):
+        """Look up a batch of hexcodes - dictionary of found rows"""
+        result = {}
+        for icao_str in icao_list:
+            row = self.find(icao_str)
+            if row is not None:
+                result[row[0]] = row
+        return result
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+"""
+Airspace - Registry of known airspace shapes with a spatial index.
+
+Airspaces can be simple lat/lon boxes (geocalc.Geocalc) or polygons loaded
+from a GeoJSON file (class B/C shelves, neighbourhood outlines, etc).
+
+Every airspace is bucketed into a uniform lat/lon grid by its bounding box,
+so a containment query only looks at the handful of airspaces whose bounding
+box overlaps the grid cell the aircraft is in - rather than walking every
+airspace for every aircraft.
+
+Polygons are 'prepared' when loaded - edges are converted into a flat list
+of (lat_low, lat_high, lon_start, lon_per_lat) tuples with horizontal edges
+dropped, so the point-in-polygon test is a tight loop with no per-query setup.
+The same edges are also kept as NumPy columns for the batch (whole tick)
+containment tests.
+"""
+
+import json
+import math
+
+import numpy as np
+
+import geocalc
+
+
+def _prepare_ring(ring):
+    """
+    Convert a GeoJSON ring [[lon, lat], ...] into prepared edges
+    (lat_a, lat_b, lon_a, lon_per_lat) for ray casting
+    """
+    edges = []
+    count = len(ring)
+    for index in range(count):
+        lon_a, lat_a = ring[index][0], ring[index][1]
+        lon_b, lat_b = ring[(index + 1) % count][0], ring[(index + 1) % count][1]
+        if lat_a == lat_b:
+            # Horizontal edges can never be crossed by an east-west ray
+            continue
+        edges.append((lat_a, lat_b, lon_a, (lon_b - lon_a) / (lat_b - lat_a)))
+    return tuple(edges)
+
+
+class Airspace:
+    """
+    Polygon (or multi-polygon) airspace with an altitude band
+    Coordinates follow GeoJSON ordering - [lon, lat]
+    """
+
+    def __init__(self, name, polygons, alt_bottom=None, alt_top=None):
+        """
+        Init object and prepare geometry
+        - polygons = list of polygons, each a list of rings.
+          The first ring is the outer boundary, any others are holes
+        """
+        self.identity = name
+        self.altitude_lower = alt_bottom
+        self.altitude_upper = alt_top
+        self.polygons = [[list(ring) for ring in polygon] for polygon in polygons]
+        self.prepared = []
+        lats = []
+        lons = []
+        for polygon in self.polygons:
+            edges = []
+            for ring in polygon:
+                edges.extend(_prepare_ring(ring))
+                lons.extend(vertex[0] for vertex in ring)
+                lats.extend(vertex[1] for vertex in ring)
+            self.prepared.append(tuple(edges))
+        self.edge_columns = [
+            np.array(edges, dtype=np.float64).reshape(-1, 4).T
+            for edges in self.prepared
+        ]
+        self.latitude_south = min(lats)
+        self.latitude_north = max(lats)
+        self.longitude_west = min(lons)
+        self.longitude_east = max(lons)
+
+    def name(self):
+        """Airspace name"""
+        return self.identity
+
+    def bbox(self):
+        """Bounding box as (south, north, west, east)"""
+        return (
+            self.latitude_south,
+            self.latitude_north,
+            self.longitude_west,
+            self.longitude_east,
+        )
+
+    def contains(self, lat, lon):
+        """Point in polygon test (2D - altitude is not considered)"""
+        if not (self.latitude_south <= lat <= self.latitude_north) or not (
+            self.longitude_west <= lon <= self.longitude_east
+        ):
+            return False
+        for edges in self.prepared:
+            inside = False
+            for lat_a, lat_b, lon_a, lon_per_lat in edges:
+                if (lat_a > lat) != (lat_b > lat):
+                    if lon < lon_a + (lat - lat_a) * lon_per_lat:
+                        inside = not inside
+            if inside:
+                return True
+        return False
+
+    def inside2D_batch(self, lats, lons):
+        """Boolean mask of the lat/lon pairs that are inside the polygon"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.zeros(lats.shape, dtype=bool)
+        index = np.nonzero(
+            (lats >= self.latitude_south)
+            & (lats <= self.latitude_north)
+            & (lons >= self.longitude_west)
+            & (lons <= self.longitude_east)
+        )[0]
+        if index.size == 0:
+            return result
+        point_lats = lats[index][np.newaxis, :]
+        point_lons = lons[index][np.newaxis, :]
+        inside = np.zeros(index.size, dtype=bool)
+        for lat_a, lat_b, lon_a, lon_per_lat in self.edge_columns:
+            lat_a = lat_a[:, np.newaxis]
+            crossing = ((lat_a > point_lats) != (lat_b[:, np.newaxis] > point_lats)) & (
+                point_lons
+                < lon_a[:, np.newaxis] + (point_lats - lat_a) * lon_per_lat[:, np.newaxis]
+            )
+            inside |= (np.count_nonzero(crossing, axis=0) % 2) == 1
+        result[index] = inside
+        return result
+
+    def inside3D_batch(self, lats, lons, alts):
+        """Boolean mask of the lat/lon/alt points inside the polygon and band"""
+        return self.inside2D_batch(lats, lons) & geocalc.altitude_band_mask(
+            alts, self.altitude_lower, self.altitude_upper
+        )
+
+
+def altitude_value(alt):
+    """
+    dump1090 reports alt_baro as feet, or the string 'ground'
+    Convert to a float (NaN when unknown) for the batch tests
+    """
+    if alt is None:
+        return np.nan
+    if alt == "ground":
+        return 0.0
+    return float(alt)
+
+
+def aircraft_altitudes(craft_list):
+    """Altitude array (feet, NaN if unknown) for a list of Aircraft"""
+    return np.fromiter(
+        (altitude_value(craft.alt()) for craft in craft_list),
+        dtype=np.float64,
+        count=len(craft_list),
+    )
+
+
+def airspace_from_feature(feature, default_name):
+    """Create an Airspace from a GeoJSON Feature - None if unsupported"""
+    geometry = feature.get("geometry") or {}
+    properties = feature.get("properties") or {}
+    if geometry.get("type") == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry.get("type") == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return None
+    name = properties.get("name", default_name)
+    alt_bottom = properties.get("altitude_lower")
+    alt_top = properties.get("altitude_upper")
+    return Airspace(str(name), polygons, alt_bottom, alt_top)
+
+
+class AirspaceRegistry:
+    """
+    Set of known airspaces, indexed by a uniform lat/lon grid
+
+    Entries need to provide
+        name() - unique airspace name
+        bbox() - (south, north, west, east)
+        contains(lat, lon) - 2D containment test
+        inside2D_batch(lats, lons) / inside3D_batch(lats, lons, alts)
+    which both geocalc.Geocalc and airspace.Airspace do
+    """
+
+    def __init__(self, cell_size=0.1):
+        """Create an empty registry - cell_size is in degrees"""
+        self.cell_size = cell_size
+        self.airspaces = {}
+        self.grid = {}
+        # name -> (south, north, west, east) grid cells the bounding box covers
+        self.cell_ranges = {}
+
+    def _cell(self, lat, lon):
+        """Grid cell containing lat/lon"""
+        return (
+            int(math.floor(lat / self.cell_size)),
+            int(math.floor(lon / self.cell_size)),
+        )
+
+    def __len__(self):
+        return len(self.airspaces)
+
+    def __iter__(self):
+        return iter(self.airspaces)
+
+    def __getitem__(self, name):
+        return self.airspaces[name]
+
+    def __contains__(self, name):
+        return name in self.airspaces
+
+    def add(self, airspace):
+        """Add (or replace) an airspace in the registry"""
+        if airspace.name() in self.airspaces:
+            self.remove(airspace.name())
+        self.airspaces[airspace.name()] = airspace
+        south, north, west, east = airspace.bbox()
+        cell_south, cell_west = self._cell(south, west)
+        cell_north, cell_east = self._cell(north, east)
+        self.cell_ranges[airspace.name()] = (
+            cell_south,
+            cell_north,
+            cell_west,
+            cell_east,
+        )
+        for lat_cell in range(cell_south, cell_north + 1):
+            for lon_cell in range(cell_west, cell_east + 1):
+                self.grid.setdefault((lat_cell, lon_cell), []).append(airspace)
+
+    def remove(self, name):
+        """Remove an airspace from the registry"""
+        airspace = self.airspaces.pop(name, None)
+        if airspace is None:
+            return
+        del self.cell_ranges[name]
+        for cell in list(self.grid):
+            entries = [entry for entry in self.grid[cell] if entry is not airspace]
+            if entries:
+                self.grid[cell] = entries
+            else:
+                del self.grid[cell]
+
+    def load_geojson(self, filename):
+        """
+        Load Polygon / MultiPolygon features from a GeoJSON file
+        properties.name, .altitude_lower and .altitude_upper are used if present
+        Returns the number of airspaces loaded
+        """
+        with open(filename, encoding="utf-8") as geojson_file:
+            collection = json.load(geojson_file)
+        if collection.get("type") == "Feature":
+            features = [collection]
+        else:
+            features = collection.get("features", [])
+        loaded = 0
+        for index, feature in enumerate(features):
+            airspace = airspace_from_feature(feature, "airspace-" + str(index))
+            if airspace is None:
+                continue
+            self.add(airspace)
+            loaded += 1
+        return loaded
+
+    def candidates(self, lat, lon):
+        """Airspaces whose bounding box shares a grid cell with lat/lon"""
+        return self.grid.get(self._cell(lat, lon), ())
+
+    def query(self, lat, lon):
+        """Return the list of airspaces that contain lat/lon"""
+        if (lat is None) or (lon is None):
+            return []
+        return [
+            airspace
+            for airspace in self.candidates(lat, lon)
+            if airspace.contains(lat, lon)
+        ]
+
+    def inside_any(self, lat, lon):
+        """True if lat/lon is inside at least one airspace (short-circuits)"""
+        if (lat is None) or (lon is None):
+            return False
+        for airspace in self.candidates(lat, lon):
+            if airspace.contains(lat, lon):
+                return True
+        return False
+
+    def masks(self, lats, lons, alts=None):
+        """
+        Batch containment for a whole tick of aircraft
+        Aircraft are bucketed by grid cell (sorted by cell key), and each
+        airspace is only tested against the aircraft in the cells its
+        bounding box covers - found with a binary search per row of cells
+        Returns {airspace name: boolean mask} for the airspaces that had
+        any aircraft to test
+        With alts given, each airspace's altitude band is honoured
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        rows = np.nonzero(np.isfinite(lats) & np.isfinite(lons))[0]
+        if rows.size == 0 or not self.airspaces:
+            return {}
+        # Cell key = lat cell * stride + lon cell, with lon cells made positive
+        lon_offset = int(math.ceil(180.0 / self.cell_size)) + 1
+        stride = 2 * lon_offset + 1
+        keys = np.floor(lats[rows] / self.cell_size).astype(np.int64) * stride + (
+            np.floor(lons[rows] / self.cell_size).astype(np.int64) + lon_offset
+        )
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        sorted_rows = rows[order]
+        result = {}
+        for name, airspace in self.airspaces.items():
+            cell_south, cell_north, cell_west, cell_east = self.cell_ranges[name]
+            row_starts = (
+                np.arange(cell_south, cell_north + 1, dtype=np.int64) * stride
+                + lon_offset
+            )
+            starts = np.searchsorted(sorted_keys, row_starts + cell_west, "left")
+            ends = np.searchsorted(sorted_keys, row_starts + cell_east, "right")
+            slices = [
+                sorted_rows[start:end]
+                for start, end in zip(starts.tolist(), ends.tolist())
+                if end > start
+            ]
+            if not slices:
+                continue
+            index = np.concatenate(slices)
+            if alts is None:
+                inside = airspace.inside2D_batch(lats[index], lons[index])
+            else:
+                inside = airspace.inside3D_batch(
+                    lats[index], lons[index], np.asarray(alts)[index]
+                )
+            mask = np.zeros(lats.shape, dtype=bool)
+            mask[index] = inside
+            result[name] = mask
+        return result
@@ -6,56 +6,83 @@
 
 """
 
+import asyncio
 import datetime
 
 # Application Specific Imports
-import json
-import logging.handlers
+import logging
 
 # Standard Library Imports
 import os
-import pickle
-import random
+import queue
 
 # import sys
 import time
 
-# Pillow Python Image Manipulation
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
 from dotenv import load_dotenv
 from geopy import distance
-from geopy import point
 
 import aircraft
 import airports
+import airspace
 import bluesky
 import debug
+import expiryindex
+import filewatch
+import fleettable
 import geocalc
+import geodistance
 import global_aircraft_db
+import ingest
+import metrics
+import pipeline
+import postimage
+import publisher
 
 # Barkley Local
 import settings
+import statestore
+import trackhistory
 
 # import atproto
 
 #
-# Setup Logging
+# Setup Logging - handlers (syslog behind a queue) are set up by main(),
+# see debug.py
 #
 logger = logging.getLogger("barkley")
 logger.setLevel(logging.INFO)
 
-formatter = logging.Formatter(
-    "%(asctime)s - \
-    %(name)s - \
-    %(levelname)s - \
-    %(message)s"
+# Only aircraft this close to this airport are posted about
+POST_AIRPORT = "ksea"
+POST_MAX_DISTANCE = 150
+
+#
+# Metrics - see metrics.py
+#
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    "barkley_stage_seconds", "Seconds spent in each main loop stage", ("stage",)
+)
+SNAPSHOTS = metrics.REGISTRY.counter(
+    "barkley_snapshots_total", "Snapshots processed by the main loop"
+)
+AIRCRAFT_SEEN = metrics.REGISTRY.counter(
+    "barkley_aircraft_seen_total", "Aircraft records in processed snapshots"
+)
+AIRCRAFT_NEW = metrics.REGISTRY.counter(
+    "barkley_aircraft_new_total", "Aircraft seen for the first time"
+)
+AIRCRAFT_AGED_OUT = metrics.REGISTRY.counter(
+    "barkley_aircraft_aged_out_total",
+    "Aircraft forgotten - not seen for max_age, or evicted over max_aircraft",
+    ("reason",),
+)
+POSTS_ATTEMPTED = metrics.REGISTRY.counter(
+    "barkley_posts_attempted_total", "Posts sent to Bluesky, including retries"
+)
+POSTS_FAILED = metrics.REGISTRY.counter(
+    "barkley_posts_failed_total", "Posts Bluesky did not accept"
 )
-syslog_handler = logging.handlers.SysLogHandler("/dev/log")
-syslog_handler.setLevel(logging.DEBUG)
-# logger.setFormatter(formatter)
-logger.addHandler(syslog_handler)
 
 
 # Commenting out for now
@@ -77,44 +104,76 @@ logger.addHandler(syslog_handler)
 #    plt.savefig('test.png')
 
 
-def random_delay(low, high):
-    """Sleep for a random interval between low and high seconds"""
-    delay = random.randint(low, high)
-    time.sleep(delay)
+def setup_image_renderer():
+    """
+    Create the post image renderer (and its worker processes)
+    Returns None, so posts go out as text only, if there is no base image
+    """
+    base_image = settings.get_string("images", "base_image")
+    if not os.path.isfile(base_image):
+        logger.warning("No base image %s - posting without images", base_image)
+        return None
+    return postimage.PostImageRenderer(
+        base_image,
+        settings.get_string("images", "font"),
+        font_size=settings.get_integer("images", "font_size"),
+        workers=settings.get_integer("images", "workers"),
+        compress_level=settings.get_integer("images", "png_compress_level"),
+    )
 
 
-def generate_temp_image(aircraft_record, hexcode):
+def generate_post_image(renderer, craft):
     """
-    Create a temporary image by laying
+    Start rendering a post image by laying
         - Aircraft ID
-        - Recorded Track
+        - Flight / Altitude / Heading
         - Date/Time
         on top of the a base image
+    Returns a future of the PNG bytes
+    """
+    lines = []
+    if craft.flight():
+        lines.append(craft.flight())
+    if craft.alt() is not None:
+        lines.append("@" + str(craft.alt()) + "ft Hdg:" + craft.cardinal())
+    lines.append(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+    return renderer.submit(craft.hexcode(), lines)
+
+
+def post_image_bytes(post_image):
+    """
+    PNG bytes of a post image future, or None if there is no image
+    A render that failed or takes too long is logged and the post goes out
+    as text only
     """
-    if "hexcode" not in aircraft_record:
+    if post_image is None:
+        return None
+    try:
+        return post_image.result(
+            timeout=float(settings.get_string("images", "render_timeout"))
+        )
+    except Exception as err:
+        logger.warning("Post image not rendered - posting text only: %r", err)
         return None
-    img = Image.open("sammamish-base-image.png")
-    image_file_str = hexcode + "-post_image.png"
-    img_font = ImageFont.truetype("Helvetica.ttf", 48)
-    draw = ImageDraw.Draw(img)
-    draw.text((50, 50), hexcode, (0, 0, 0), font=img_font)
-    img.save(image_file_str)
-    return image_file_str
 
 
-def publish_flutter(bluesky_obj, post_str):
+def publish_flutter(bluesky_obj, post_str, post_image=None):
     """
     Publish fully formed post to BlueSky.
-    Do the necessary error handling and rate limiting
+    post_image = future of the PNG bytes to attach (see generate_post_image)
+    Do the necessary error handling - rate limiting and retries are
+    done by the publisher (see publisher.py)
     """
     result = False
     status = None
     # debug.dprint("Attempting to post")
     if settings.get_bool("default", "bluesky_enabled"):
         # debug.dprint("Ready to post")
+        POSTS_ATTEMPTED.inc()
         try:
             status = bluesky_obj.bluesky_flutter(
                 post_str,
+                image=post_image_bytes(post_image),
             )
             debug.dprint("==== post Status ====")
             debug.dprint(status)
@@ -122,14 +181,13 @@ def publish_flutter(bluesky_obj, post_str):
             result = True
         except Exception as err:
             debug.dprint("bsky Error")
-            print(err)
             logger.error(
                 "%s - bsky Error: API Code: %s", str(datetime.datetime.now()), err
             )
+            POSTS_FAILED.inc()
             result = False
     else:
         logger.debug("Bluesky Disabled")
-    random_delay(5, 9)
     return result
 
 
@@ -146,13 +204,16 @@ def generate_vfr_data(aircraft_set):
     )
 
 
-def handle_new_aircraft(known_aircraft, new_aircraft, global_db):
-    """A new aircraft has appeared on the list"""
+def handle_new_aircraft(
+    known_aircraft, new_aircraft, db_row, history_budget=None, timestamp=None
+):
+    """A new aircraft has appeared on the list (in the snapshot at timestamp)"""
     new_record = aircraft.Aircraft(new_aircraft)
+    new_record.seen(timestamp)
     known_aircraft[new_record.hexcode()] = new_record
-    # global_aircraft_db.find_aircraft_icao(global_db, new_record.hexcode())
-    db_row = global_aircraft_db.find_aircraft_entry(global_db, new_record.hexcode())
     known_aircraft[new_record.hexcode()].update_global_db(db_row)
+    if history_budget is not None:
+        history_budget.attach(new_record)
     logger.info(
         "New Aircraft record created - %s , hex: %s",
         new_record.flight(),
@@ -160,10 +221,10 @@ def handle_new_aircraft(known_aircraft, new_aircraft, global_db):
     )
 
 
-def handle_existing_aircraft(known_aircraft, aircraft_record):
+def handle_existing_aircraft(known_aircraft, aircraft_record, timestamp=None):
     """This is handling any existing aircraft"""
     hexcode = aircraft_record["hex"]
-    if known_aircraft[hexcode].update(aircraft_record):
+    if known_aircraft[hexcode].update(aircraft_record, timestamp):
         logger.debug(
             "Aircraft Update - Added useful info (%s:%s)",
             known_aircraft[hexcode].flight(),
@@ -228,29 +289,95 @@ def distance_to_airport(airport, lat, lon):
     return geo_distance
 
 
-def update_adsb_data(adsb_list, known_aircraft, global_db):
+def update_adsb_data(
+    adsb_list,
+    known_aircraft,
+    global_db,
+    fleet_table=None,
+    history_budget=None,
+    expiry_index=None,
+    time_now=None,
+):
     """
     Iterate over the a set of visible aircraft
     - Check if currently seen aircraft is on recently seen list
     - If aircraft is not currently seen then mark as 'new'
+    - All new aircraft are looked up in the Global DB in one batch
+    - Every aircraft in the snapshot is marked as seen now (and touched
+      in the expiry index)
+    With a fleet table, the whole snapshot is merged into its columns
+    in bulk and only new aircraft get a record created here - the rows it
+    marks changed are synced back by sync_fleet_candidates
+    time_now is the snapshot time (default now)
+    Returns the set of hexcodes that are new or changed this tick
     """
+    if time_now is None:
+        time_now = time.time()
+    changed_hexcodes = set()
+    new_records = []
+    if fleet_table is not None:
+        new_hexcodes = set(fleet_table.merge_snapshot(adsb_list, time_now))
+        changed_hexcodes.update(fleet_table.changed())
+        if new_hexcodes:
+            new_records = [
+                aircraft_record
+                for aircraft_record in adsb_list
+                if (aircraft_record["hex"] in new_hexcodes)
+                and (aircraft_record["hex"] not in known_aircraft)
+            ]
+    else:
+        for aircraft_record in adsb_list:
+            # debug.dprint("Entering process_adsb_data loop")
+            hexcode = aircraft_record["hex"]
+            # Skip aircraft we have already seen about
+            if hexcode in known_aircraft:
+                # debug.dprint("Found known aircraft " + hexcode)
+                handle_existing_aircraft(known_aircraft, aircraft_record, time_now)
+                if known_aircraft[hexcode].changes():
+                    changed_hexcodes.add(hexcode)
+            else:
+                # debug.dprint("Found new aircraft " + hexcode)
+                new_records.append(aircraft_record)
+    AIRCRAFT_SEEN.inc(len(adsb_list))
+    AIRCRAFT_NEW.inc(len(new_records))
+    if new_records:
+        db_rows = global_db.lookup_many(record["hex"] for record in new_records)
+        for aircraft_record in new_records:
+            handle_new_aircraft(
+                known_aircraft,
+                aircraft_record,
+                db_rows[aircraft_record["hex"]],
+                history_budget,
+                time_now,
+            )
+            changed_hexcodes.add(aircraft_record["hex"])
     for aircraft_record in adsb_list:
-        # debug.dprint("Entering process_adsb_data loop")
         hexcode = aircraft_record["hex"]
-        # Skip aircraft we have already seen about
-        if hexcode in known_aircraft:
-            # debug.dprint("Found known aircraft " + hexcode)
-            handle_existing_aircraft(known_aircraft, aircraft_record)
-        else:
-            # debug.dprint("Found new aircraft " + hexcode)
-            handle_new_aircraft(known_aircraft, aircraft_record, global_db)
+        craft = known_aircraft.get(hexcode)
+        if craft is None:
+            continue
+        craft.seen(time_now)
+        if expiry_index is not None:
+            expiry_index.touch(hexcode, time_now)
+    return changed_hexcodes
 
 
-def flutter_known_aircraft(known_aircraft, airspace_db, bluesky_obj):
-    """Scan list of known aircraft for one that have good data, and not yet posted"""
-    for known_list in list(known_aircraft):
-        craft = known_aircraft[known_list]
-        debug.dprint("Airplane: " + craft.hexcode() + " being examined ")
+def flutter_known_aircraft(
+    known_aircraft, airspace_db, bluesky_obj, candidates=None, publisher=None
+):
+    """
+    Scan list of known aircraft for one that have good data, and not yet posted
+    - candidates = hexcodes to consider, default is every known aircraft
+    - publisher(craft, post_str) is handed each post instead of posting it
+      here, and is then responsible for marking the aircraft as fluttered
+    """
+    if candidates is None:
+        candidates = list(known_aircraft)
+    for known_list in candidates:
+        craft = known_aircraft.get(known_list)
+        if craft is None:
+            continue
+        debug.dprint("Airplane: %s being examined", craft.hexcode())
         # debug.dprint("flutter_known_aircraft")
         # debug.dprint(craft.hexcode())
         if not (craft.quality_record()) or (craft.fluttered()):
@@ -259,101 +386,266 @@ def flutter_known_aircraft(known_aircraft, airspace_db, bluesky_obj):
             # - already been posted
             continue
         debug.dprint(
-            "Airplane: " + craft.flight() + " has full data and has not been posted"
+            "Airplane: %s has full data and has not been posted", craft.flight()
         )
         if craft.is_vfr() and settings.get_bool("default", "squawk_1200_hide"):
             logger.info("Skipping VFR flight %s (%s)", craft.flight(), craft.hexcode())
             continue
-        aprt_dist = craft.get_airport_distance("ksea")
-        if aprt_dist > 150:
+        aprt_dist = craft.get_airport_distance(POST_AIRPORT)
+        if aprt_dist > POST_MAX_DISTANCE:
             # debug.dprint("Airplane: " +
             #             craft.flight() +
             #             " ( " + str(aprt_dist) + " nm) not at an interesting distance")
             # Skip Distant Planes for now - to slow down the rate of posting
             continue
-        debug.dprint("Airplane: " + craft.flight() + " is at an interesting distance")
-        if not aircraft_inside_known_area(craft, airspace_db):
-            debug.dprint(
-                "Airplane: " + craft.flight() + " not in an interesting location"
-            )
+        debug.dprint("Airplane: %s is at an interesting distance", craft.flight())
+        if not craft.in_known_airspace():
+            debug.dprint("Airplane: %s not in an interesting location", craft.flight())
             continue
-        debug.dprint("Airplane: " + craft.flight() + " is in interesting location")
+        debug.dprint("Airplane: %s is in interesting location", craft.flight())
 
         debug.dprint(
-            " post "
-            + craft.flight()
-            + " ("
-            + str(craft.update_count())
-            + ") - Dist from ksea "
-            + str(aprt_dist)
-            + "m"
+            " post %s (%s) - Dist from ksea %sm",
+            craft.flight(),
+            craft.update_count(),
+            aprt_dist,
         )
         post_str = create_flutter(craft, aprt_dist)
         # debug.dprint("Aircraft:" + craft.flight() +" Direction :" + craft.cardinal() )
         # logger.info(f"Skipping post of {post_str}")
+        if not settings.get_bool("default", "bluesky_enabled"):
+            # Nothing to send - queueing it would only be retried as a failure
+            logger.debug("Bluesky Disabled - not posting %s", craft.hexcode())
+            continue
+        if publisher is not None:
+            publisher(craft, post_str)
+            continue
         flutter_success = publish_flutter(bluesky_obj, post_str)
         if flutter_success:
             craft.mark_as_fluttered()
 
 
-def aircraft_inside_known_area(craft, airspace_db):
-    """Check to see if the craft is inside any of the known airspaces"""
-    craft_location = point.Point(craft.lat(), craft.lon())
-    aircraft_inside_area = False
-    for airspace_entry in airspace_db:
-        airspace = airspace_db[airspace_entry]
-        if airspace.inside2D(craft_location):
-            aircraft_inside_area = True
-    return aircraft_inside_area
+def post_eligible(craft):
+    """
+    True if craft is worth posting about - the checks made by
+    flutter_known_aircraft, without the logging
+    """
+    if not (craft.quality_record()) or (craft.fluttered()):
+        return False
+    if craft.is_vfr() and settings.get_bool("default", "squawk_1200_hide"):
+        return False
+    if craft.get_airport_distance(POST_AIRPORT) > POST_MAX_DISTANCE:
+        return False
+    return craft.in_known_airspace()
+
+
+def update_post_candidates(known_aircraft, post_candidates, hexcodes):
+    """
+    Re-check the aircraft in hexcodes (after their fields, distance or
+    airspaces changed) and add them to / remove them from post_candidates
+    Current candidates are always re-checked, so aircraft that were posted
+    about or aged out leave the set
+    Returns the candidates as a list
+    """
+    for hexcode in set(hexcodes) | post_candidates:
+        craft = known_aircraft.get(hexcode)
+        if (craft is not None) and post_eligible(craft):
+            post_candidates.add(hexcode)
+        else:
+            post_candidates.discard(hexcode)
+    return list(post_candidates)
 
 
-def update_aircraft_data(known_aircraft, airport_db, airspace_db):
+def update_aircraft_data(
+    known_aircraft, airport_db, airspace_db, fleet_table=None, changed_hexcodes=None
+):
     """
     Periodically iterate over the a set of known aircraft
-    - Update Aircraft 'distance' data to nearest airport (currently KSEA)
+    - Update Aircraft 'distance' data to every known airport
+      (one batched pass over all aircraft x all airports)
     - Check to see if Aircraft are inside interesting airspace
+      (one batched mask per airspace, optionally honouring altitude bands)
+    With changed_hexcodes, only the aircraft among them whose position
+    moved this tick are recomputed
+    With a fleet table both stages run on its columns instead
     """
 
-    for craft_entry in known_aircraft:
-        craft = known_aircraft[craft_entry]
-        for airport_entry in airport_db:
-            # debug.dprint(" " + airport_entry)
-            airport = airport_db[airport_entry]
-            # debug.dprint("airport: " + airport.icaocode() )
-            craft_distance = distance_to_airport(airport, craft.lat(), craft.lon())
-            # debug.dprint("airport: " + airport.icaocode() + " Distance " + str(distance))
-            craft.update_airport_distance(airport_entry, craft_distance)
-            # debug.dprint("airport distance updated")
-        if aircraft_inside_known_area(craft, airspace_db):
-            # Aircraft inside known area
-            craft.set_interesting_location()
+    if fleet_table is not None:
+        fleet_table.update_distances(
+            airport_db, method=settings.get_string("geo", "distance_method")
+        )
+        fleet_table.update_airspaces(
+            airspace_db, settings.get_bool("airspace", "altitude_bands")
+        )
+        return True
+    if changed_hexcodes is None:
+        craft_list = list(known_aircraft.values())
+    else:
+        craft_list = [
+            known_aircraft[hexcode]
+            for hexcode in changed_hexcodes
+            if (hexcode in known_aircraft) and known_aircraft[hexcode].moved()
+        ]
+    if not craft_list:
+        return True
+    geodistance.update_airport_distances(
+        craft_list,
+        airport_db,
+        method=settings.get_string("geo", "distance_method"),
+    )
+    craft_lats, craft_lons = geodistance.aircraft_arrays(craft_list)
+    craft_alts = None
+    if settings.get_bool("airspace", "altitude_bands"):
+        craft_alts = airspace.aircraft_altitudes(craft_list)
+    airspace_masks = airspace_db.masks(craft_lats, craft_lons, craft_alts)
+    craft_airspaces = [[] for _ in craft_list]
+    for airspace_name, mask in airspace_masks.items():
+        for index in mask.nonzero()[0]:
+            craft_airspaces[index].append(airspace_name)
+    for craft, airspace_names in zip(craft_list, craft_airspaces):
+        # Recorded once per tick, the posting stage reuses the result
+        craft.set_airspaces(airspace_names)
     return True
 
 
-def age_out_old_adsb(data_set, interval):
-    """Delete entries older than interval seconds ago from the dataset"""
-    time_now = datetime.datetime.now()
+def post_priority(craft):
+    """Publisher queue priority - emergencies go first"""
+    if craft.is_emergency():
+        return publisher.PRIORITY_EMERGENCY
+    return publisher.PRIORITY_NORMAL
+
+
+def mark_fluttered(known_aircraft, hexcode, flutter_success):
+    """Record a successful post"""
+    craft = known_aircraft.get(hexcode)
+    if flutter_success and (craft is not None):
+        craft.mark_as_fluttered()
+
+
+def apply_publish_results(known_aircraft, publish_results):
+    """
+    Mark the aircraft posted about since the last tick
+    The publisher thread only reports results on the publish_results queue,
+    so Aircraft records are only ever changed by the thread running the tick
+    """
+    while True:
+        try:
+            hexcode, flutter_success = publish_results.get_nowait()
+        except queue.Empty:
+            return
+        mark_fluttered(known_aircraft, hexcode, flutter_success)
+
+
+def setup_publisher(bluesky_obj, publish_results):
+    """
+    Create and start the publisher that sends posts to bluesky
+    Posts are queued as (post text, post image future or None)
+    Post results are put on publish_results (see apply_publish_results)
+    """
+    return publisher.Publisher(
+        lambda post: publish_flutter(bluesky_obj, *post),
+        on_result=lambda hexcode, flutter_success: publish_results.put(
+            (hexcode, flutter_success)
+        ),
+        rate=settings.get_integer("publisher", "posts_per_minute") / 60.0,
+        burst=settings.get_integer("publisher", "burst"),
+        max_queue=settings.get_integer("publisher", "queue_size"),
+        overflow=settings.get_string("publisher", "overflow"),
+        max_attempts=settings.get_integer("publisher", "max_attempts"),
+        backoff_base=float(settings.get_string("publisher", "backoff_base")),
+        backoff_max=float(settings.get_string("publisher", "backoff_max")),
+        dedupe_seconds=float(settings.get_string("publisher", "dedupe_seconds")),
+        give_up_seconds=float(settings.get_string("publisher", "give_up_seconds")),
+    ).start()
+
+
+def clear_tick_changes(known_aircraft, changed_hexcodes):
+    """End of tick - reset the change tracking of the aircraft that changed"""
+    for hexcode in changed_hexcodes:
+        craft = known_aircraft.get(hexcode)
+        if craft is not None:
+            craft.clear_changes()
+
+
+def sync_fleet_candidates(known_aircraft, fleet_table):
+    """
+    Bring every Aircraft record that changed this tick up to date from
+    the fleet table (so the state store saves current values), and
+    return the hexcodes of the ones that could be posted about
+    Aircraft already fluttered about are left out
+    """
+    fleet_table.sync_changed(known_aircraft)
+    candidates = fleet_table.select(
+        aircraft.QUALITY_FIELDS,
+        airport=POST_AIRPORT,
+        max_distance=POST_MAX_DISTANCE,
+        in_airspace=True,
+    )
+    return [
+        hexcode
+        for hexcode in candidates
+        if (hexcode in known_aircraft) and not known_aircraft[hexcode].fluttered()
+    ]
+
+
+def age_out_old_adsb(
+    data_set,
+    interval,
+    fleet_table=None,
+    history_budget=None,
+    expiry_index=None,
+    time_now=None,
+):
+    """
+    Delete entries not seen for interval seconds from the dataset
+    With a fleet table the expiry runs on its last seen column, with an
+    expiry index only the aircraft that expire are looked at - either way
+    the least recently seen are evicted while over the cap
+    Aircraft deleted here are also dropped from the fleet table, and their
+    track histories are returned to history_budget
+    time_now is the snapshot time (default now)
+    """
+    if time_now is None:
+        time_now = time.time()
+    cutoff = time_now - interval
+    evicted = []
+    if fleet_table is not None:
+        expired = fleet_table.age_out(cutoff)
+        evicted = fleet_table.evict()
+    elif expiry_index is not None:
+        expired = expiry_index.expire(cutoff)
+        evicted = expiry_index.evict()
+    else:
+        expired = [
+            craftid
+            for craftid, craft in data_set.items()
+            if craft.last_seen_time() < cutoff
+        ]
+    AIRCRAFT_AGED_OUT.labels("expired").inc(len(expired))
+    AIRCRAFT_AGED_OUT.labels("evicted").inc(len(evicted))
     deleted_counter = 0
     invisible_counter = 0
-    for craftid in list(data_set):
-        if data_set[craftid].created() < time_now - datetime.timedelta(
-            seconds=interval
-        ):
-            if data_set[craftid].fluttered() == 0:
-                invisible_counter += 1
-            # debug.dprint(" Deleting " +
-            #             data_set[craftid].hexcode() +
-            #             " Score: " +
-            #             str(data_set[craftid].quality_score()))
-            del data_set[craftid]
-            deleted_counter += 1
+    for craftid in expired + evicted:
+        craft = data_set.pop(craftid, None)
+        if fleet_table is not None:
+            fleet_table.remove(craftid)
+        if craft is None:
+            continue
+        if craft.fluttered() == 0:
+            invisible_counter += 1
+        # debug.dprint(" Deleting " +
+        #             craft.hexcode() +
+        #             " Score: " +
+        #             str(craft.quality_score()))
+        if history_budget is not None:
+            history_budget.detach(craft)
+        deleted_counter += 1
     debug.dprint(
-        "Deleted old records "
-        + str(deleted_counter)
-        + " - Remaining: "
-        + str(len(data_set.keys()))
-        + " - Invisible Craft "
-        + str(invisible_counter)
+        "Deleted old records %d (over cap %d) - Remaining: %d - Invisible Craft %d",
+        deleted_counter,
+        len(evicted),
+        len(data_set),
+        invisible_counter,
     )
 
 
@@ -368,40 +660,156 @@ def setup_airports(airport_db):
 
 
 def setup_airspace(airspace_db):
-    """Create an initial set of known Airspace"""
+    """
+    Create an initial set of known Airspace
+    plus any airspace polygons from the configured GeoJSON file
+    """
     new_geobox = geocalc.Geocalc(
         "sammamish", 47.557878, 47.673005, -121.976254, -122.586154, 0, 10000
     )
-    airspace_db["sammamish"] = new_geobox
+    airspace_db.add(new_geobox)
     new_geobox = geocalc.Geocalc(
         "seatac", 47.436920, 47.523239, -121.37, -122.30, 0, 10000
     )
-    airspace_db["seatac"] = new_geobox
+    airspace_db.add(new_geobox)
+    geojson_file = settings.get_string("airspace", "geojson")
+    if geojson_file and os.path.isfile(geojson_file):
+        loaded = airspace_db.load_geojson(geojson_file)
+        logger.info("Loaded %d airspaces from %s", loaded, geojson_file)
 
 
-def main():
+def setup_metrics(runtime):
+    """
+    Register the metrics read from the runtime objects when exported,
+    and start the HTTP endpoint / file writer - returns the exporters
+    """
+    registry = metrics.REGISTRY
+    registry.callback(
+        "barkley_known_aircraft",
+        "Aircraft currently tracked",
+        "gauge",
+        lambda: len(runtime["known_aircraft"]),
+    )
+    registry.callback(
+        "barkley_post_candidates",
+        "Tracked aircraft ready to be posted about",
+        "gauge",
+        lambda: len(runtime["post_candidates"]),
+    )
+    registry.callback(
+        "barkley_track_history_bytes",
+        "Memory used by track histories",
+        "gauge",
+        lambda: runtime["history_budget"].used_bytes(),
+    )
+    registry.callback(
+        "barkley_snapshots_skipped_total",
+        "Snapshot reads skipped because aircraft.json had not changed",
+        "counter",
+        lambda: runtime["snapshot_reader"].skipped(),
+    )
+    registry.callback(
+        "barkley_global_db_cache_total",
+        "Global DB lookups answered from the cache (hit) or the database (miss)",
+        "counter",
+        lambda: {
+            "hit": runtime["global_db"].hits(),
+            "miss": runtime["global_db"].misses(),
+        },
+        labelname="result",
+    )
+    registry.callback(
+        "barkley_global_db_cache_entries",
+        "Hexcodes held in the Global DB cache",
+        "gauge",
+        lambda: len(runtime["global_db"]),
+    )
+    registry.callback(
+        "barkley_publisher_queued",
+        "Posts waiting in the publisher queue",
+        "gauge",
+        lambda: runtime["publisher"].stats()["queued"],
+    )
+    registry.callback(
+        "barkley_publisher_posts_total",
+        "Publisher queue outcomes",
+        "counter",
+        lambda: {
+            outcome: count
+            for outcome, count in runtime["publisher"].stats().items()
+            if outcome != "queued"
+        },
+        labelname="outcome",
+    )
+
+    exporters = []
+    port = settings.get_integer("metrics", "port")
+    if port:
+        try:
+            server = metrics.MetricsServer(
+                registry, settings.get_string("metrics", "listen_address"), port
+            )
+        except OSError as err:
+            logger.error("Metrics - unable to listen on port %d: %s", port, err)
+        else:
+            exporters.append(server.start())
+            logger.info("Serving metrics on http://%s:%d/metrics", *server.address())
+    textfile = settings.get_string("metrics", "textfile")
+    if textfile:
+        exporters.append(
+            metrics.TextfileWriter(
+                registry,
+                textfile,
+                float(settings.get_string("metrics", "textfile_interval")),
+            ).start()
+        )
+    return exporters
+
+
+def setup_pipeline_metrics(runtime_pipeline):
+    """Register the asyncio pipeline queue depths"""
+    metrics.REGISTRY.callback(
+        "barkley_pipeline_queue_depth",
+        "Snapshots waiting in each pipeline queue",
+        "gauge",
+        runtime_pipeline.queue_depths,
+        labelname="queue",
+    )
+    metrics.REGISTRY.callback(
+        "barkley_pipeline_queue_max_depth",
+        "Most snapshots seen waiting in each pipeline queue",
+        "gauge",
+        runtime_pipeline.queue_max_depths,
+        labelname="queue",
+    )
+
+
+def setup_runtime(check_same_thread=True):
     """
-    Main Entrypoint
     Setup initial requirements
+     - Airports, Airspace and the Global DB
      - Connection to bluesky
-     - Connection to FlightAware
-    Start Loop
-     - Scan list of seen aircraft
-     - Identify new target aircraft
-     - Generate and publish post
+     - Restore saved aircraft state
+     - Watch dump1090 for new snapshots
+    Returns a dictionary of everything the main loop needs
     """
-
-    known_aircraft = dict()
+    start_time = time.perf_counter()
     airport_db = dict()
-    airspace_db = dict()
+    airspace_db = airspace.AirspaceRegistry(
+        float(settings.get_string("airspace", "grid_cell_size"))
+    )
 
     setup_airports(airport_db)
     setup_airspace(airspace_db)
 
-    global_db = global_aircraft_db.create_connection("data/global_aircraft_db.sqlite3")
-
-    debug.dprint("Loading Settings")
-    settings.init()
+    global_db = global_aircraft_db.AircraftDbCache(
+        global_aircraft_db.open_readonly(
+            settings.get_string("global_db", "database"),
+            settings.get_integer("global_db", "mmap_size"),
+            check_same_thread,
+        ),
+        settings.get_integer("global_db", "cache_size"),
+    )
 
     load_dotenv()
 
@@ -409,43 +817,315 @@ def main():
     BLUESKY_AUTH = os.getenv("BLUESKY_AUTH")
 
     debug.dprint("Logging into bluesky")
-    bluesky_obj = bluesky.BlueSky(BLUESKY_ACCT, BLUESKY_AUTH)
-
-    aircraft_max_age = 1800
+    bluesky_obj = bluesky.BlueSky(
+        BLUESKY_ACCT,
+        BLUESKY_AUTH,
+        xrpc_url=settings.get_string("bluesky", "xrpc_url"),
+        http_timeout=float(settings.get_string("bluesky", "http_timeout")),
+        handle_ttl=float(settings.get_string("bluesky", "handle_cache_ttl")),
+        handle_negative_ttl=float(
+            settings.get_string("bluesky", "handle_negative_ttl")
+        ),
+        handle_cache_size=settings.get_integer("bluesky", "handle_cache_size"),
+        session_file=settings.get_string("bluesky", "session_file"),
+        relogin_margin=float(settings.get_string("bluesky", "relogin_margin")),
+    )
+    logger.info(
+        "Bluesky login (%s) took %.3fs",
+        bluesky_obj.login_method,
+        bluesky_obj.login_seconds,
+    )
 
     debug.dprint("Loading saved dataset")
-    if os.path.isfile("data/known_aircraft.pkl"):
-        known_aircraft = pickle.load(open("data/known_aircraft.pkl", "rb"))
+    state_store = statestore.StateStore(
+        settings.get_string("state", "database"),
+        check_same_thread,
+        float(settings.get_string("state", "seen_interval")),
+    )
+    known_aircraft = state_store.load()
+    if not known_aircraft:
+        # First run after the move away from the full pickle dump
+        known_aircraft = state_store.import_pickle(
+            settings.get_string("state", "legacy_pickle")
+        )
+    logger.info(
+        "Restored %d aircraft records in %.3fs",
+        len(known_aircraft),
+        state_store.load_seconds,
+    )
+    history_budget = trackhistory.HistoryBudget(
+        settings.get_integer("history", "max_memory_mb") * 1024 * 1024,
+        settings.get_integer("history", "samples"),
+    )
+    for craft in known_aircraft.values():
+        # Track histories are not saved - restored aircraft start a new one
+        history_budget.attach(craft)
+    post_candidates = set()
+    update_post_candidates(known_aircraft, post_candidates, known_aircraft)
+    fleet_table = None
+    expiry_index = None
+    if settings.get_bool("fleet", "enabled"):
+        # The fleet table ages aircraft out on its own columns
+        fleet_table = fleettable.FleetTable(
+            settings.get_integer("fleet", "capacity"),
+            settings.get_integer("tracking", "max_aircraft"),
+        )
+        fleet_table.restore(known_aircraft)
     else:
-        known_aircraft = {}
+        expiry_index = expiryindex.ExpiryIndex(
+            settings.get_integer("tracking", "max_aircraft")
+        )
+        expiry_index.rebuild(known_aircraft)
+
+    aircraft_filename = settings.get_string("dump1090", "aircraftjson")
+    snapshot_reader = ingest.SnapshotReader(aircraft_filename)
+    file_watcher = filewatch.FileWatcher(
+        aircraft_filename,
+        min_interval=float(settings.get_string("dump1090", "min_tick_interval")),
+        poll_interval=float(settings.get_string("dump1090", "poll_interval")),
+        mode=settings.get_string("dump1090", "watch_mode"),
+    )
+    logger.info("Watching %s using %s", aircraft_filename, file_watcher.mode())
+
+    image_renderer = setup_image_renderer()
+    publish_results = queue.SimpleQueue()
+    post_publisher = setup_publisher(bluesky_obj, publish_results)
+    logger.info("Ready to post %.3fs after start", time.perf_counter() - start_time)
+
+    runtime = {
+        "known_aircraft": known_aircraft,
+        "airport_db": airport_db,
+        "airspace_db": airspace_db,
+        "global_db": global_db,
+        "bluesky": bluesky_obj,
+        "publisher": post_publisher,
+        "publish_results": publish_results,
+        "image_renderer": image_renderer,
+        "state_store": state_store,
+        "history_budget": history_budget,
+        "fleet_table": fleet_table,
+        "snapshot_reader": snapshot_reader,
+        "file_watcher": file_watcher,
+        "watch_timeout": float(settings.get_string("dump1090", "watch_timeout")),
+        "expiry_index": expiry_index,
+        "post_candidates": post_candidates,
+        "aircraft_max_age": settings.get_integer("tracking", "max_age"),
+    }
+    runtime["metrics_exporters"] = setup_metrics(runtime)
+    return runtime
+
+
+def read_snapshot(runtime):
+    """
+    Sleep until dump1090 replaces the snapshot (or the timeout passes)
+    Returns the new snapshot, or None if it has not changed
+    """
+    with STAGE_SECONDS.labels("wait").time():
+        runtime["file_watcher"].wait(runtime["watch_timeout"])
+    snapshot_reader = runtime["snapshot_reader"]
+    with STAGE_SECONDS.labels("parse").time():
+        adsb_data = snapshot_reader.read()
+    logger.info(
+        "Snapshots processed: %d , skipped (unchanged): %d",
+        snapshot_reader.processed(),
+        snapshot_reader.skipped(),
+    )
+    if adsb_data is None:
+        debug.dprint("Snapshot unchanged - skipping")
+    return adsb_data
+
+
+def process_snapshot(runtime, adsb_data, publisher=None):
+    """
+    One pass of the main loop over a new snapshot
+     - Merge it into the known aircraft
+     - Update distances and airspaces
+     - Queue posts about aircraft worth posting about
+       (or hand them to publisher(craft, post_str))
+     - Save state and age out old records
+    """
+    with STAGE_SECONDS.labels("tick").time():
+        _process_snapshot(runtime, adsb_data, publisher)
+    SNAPSHOTS.inc()
+
+
+def _process_snapshot(runtime, adsb_data, publisher):
+    """process_snapshot() - each stage timed into STAGE_SECONDS"""
+    known_aircraft = runtime["known_aircraft"]
+    if publisher is None:
+
+        def publisher(craft, post_str):
+            post_image = None
+            if runtime["image_renderer"] is not None:
+                post_image = generate_post_image(runtime["image_renderer"], craft)
+            runtime["publisher"].submit(
+                craft.hexcode(), (post_str, post_image), post_priority(craft)
+            )
 
+    fleet_table = runtime["fleet_table"]
+    history_budget = runtime["history_budget"]
+    apply_publish_results(known_aircraft, runtime["publish_results"])
+    snapshot_time = adsb_data.get("now") or time.time()
+    logger.info("data_set Time: %s", time.ctime(snapshot_time))
+    with STAGE_SECONDS.labels("update_adsb").time():
+        changed_hexcodes = update_adsb_data(
+            adsb_data["aircraft"],
+            known_aircraft,
+            runtime["global_db"],
+            fleet_table,
+            history_budget,
+            runtime["expiry_index"],
+            snapshot_time,
+        )
+    with STAGE_SECONDS.labels("geo").time():
+        update_aircraft_data(
+            known_aircraft,
+            runtime["airport_db"],
+            runtime["airspace_db"],
+            fleet_table,
+            changed_hexcodes,
+        )
+    #
+
+    with STAGE_SECONDS.labels("select").time():
+        if fleet_table is not None:
+            candidates = sync_fleet_candidates(known_aircraft, fleet_table)
+            # Kept for the post candidates gauge
+            runtime["post_candidates"] = set(candidates)
+        else:
+            candidates = update_post_candidates(
+                known_aircraft, runtime["post_candidates"], changed_hexcodes
+            )
+    with STAGE_SECONDS.labels("flutter").time():
+        flutter_known_aircraft(
+            known_aircraft,
+            runtime["airspace_db"],
+            runtime["bluesky"],
+            candidates,
+            publisher,
+        )
+    with STAGE_SECONDS.labels("clear").time():
+        clear_tick_changes(known_aircraft, changed_hexcodes)
+
+    # print(known_aircraft)
+    debug.dprint("------------")
+
+    with STAGE_SECONDS.labels("save").time():
+        saved_rows, deleted_rows = runtime["state_store"].save(known_aircraft)
+    debug.dprint("State saved - written %d removed %d", saved_rows, deleted_rows)
+    debug.dprint("Aging out old records")
+    with STAGE_SECONDS.labels("age_out").time():
+        age_out_old_adsb(
+            known_aircraft,
+            runtime["aircraft_max_age"],
+            fleet_table,
+            history_budget,
+            runtime["expiry_index"],
+            snapshot_time,
+        )
+    logger.info(
+        "Track history memory: %d bytes across %d aircraft (%d waiting)",
+        history_budget.used_bytes(),
+        history_budget.history_count(),
+        history_budget.waiting_count(),
+    )
+    publisher_stats = runtime["publisher"].stats()
+    logger.info(
+        "Publisher: queued %d sent %d merged %d dropped %d retried %d failed %d "
+        "suppressed %d",
+        publisher_stats["queued"],
+        publisher_stats["sent"],
+        publisher_stats["merged"],
+        publisher_stats["dropped"],
+        publisher_stats["retried"],
+        publisher_stats["failed"],
+        publisher_stats["suppressed"],
+    )
+
+
+def prefetch_global_db(runtime, adsb_data):
+    """
+    Look up the never seen aircraft of a snapshot, warming the Global DB cache
+    Runs beside the geo stage, so it checks the frozen set of hexcodes the
+    last tick left behind rather than the live known_aircraft
+    """
+    known_hexcodes = runtime["known_hexcodes"]
+    with STAGE_SECONDS.labels("enrich").time():
+        runtime["global_db"].lookup_many(
+            aircraft_record["hex"]
+            for aircraft_record in adsb_data["aircraft"]
+            if aircraft_record["hex"] not in known_hexcodes
+        )
+
+
+def run_serial(runtime):
+    """Main loop - read, process and post one snapshot at a time"""
     counter = 0
     while True:
-        try:
-            debug.dprint("Starting New Main Loop")
-            aircraft_filename = settings.get_string("dump1090", "aircraftjson")
-            aircraft_file = open(aircraft_filename)
-            adsb_data = json.load(aircraft_file)
-            logger.info("data_set Time: %s", time.ctime(adsb_data.get("now")))
-            update_adsb_data(adsb_data["aircraft"], known_aircraft, global_db)
-            update_aircraft_data(known_aircraft, airport_db, airspace_db)
-            #
-
-            flutter_known_aircraft(known_aircraft, airspace_db, bluesky_obj)
-
-            # print(known_aircraft)
-            print("------------")
-
-            pickle.dump(known_aircraft, open("data/known_aircraft.pkl", "wb"))
-            debug.dprint("Aging out old records")
-            age_out_old_adsb(known_aircraft, aircraft_max_age)
-            debug.dprint("Ending Main Loop")
-        finally:
-            aircraft_file.close()
-            random_delay(15, 40)
+        debug.dprint("Starting New Main Loop")
+        adsb_data = read_snapshot(runtime)
+        if adsb_data is None:
+            continue
+        process_snapshot(runtime, adsb_data)
+        debug.dprint("Ending Main Loop")
         counter += 1
         # debug.dprint("Completing 1000 loop run")
 
 
+def run_asyncio(runtime):
+    """
+    Main loop as an asyncio pipeline (see pipeline.py)
+    Snapshots keep being read while Global DB lookups are in flight, and
+    posts go out through the publisher thread as in the serial loop
+    """
+
+    def evaluate(adsb_data):
+        process_snapshot(runtime, adsb_data)
+        # Handed to the enrich stage - known_aircraft itself stays on this thread
+        runtime["known_hexcodes"] = frozenset(runtime["known_aircraft"])
+
+    runtime["known_hexcodes"] = frozenset(runtime["known_aircraft"])
+    runtime_pipeline = pipeline.Pipeline(
+        ingest=lambda: read_snapshot(runtime),
+        enrich=lambda adsb_data: prefetch_global_db(runtime, adsb_data),
+        evaluate=evaluate,
+        ingest_queue_size=settings.get_integer("pipeline", "ingest_queue"),
+        geo_queue_size=settings.get_integer("pipeline", "geo_queue"),
+        stats_interval=settings.get_integer("pipeline", "stats_interval"),
+    )
+    setup_pipeline_metrics(runtime_pipeline)
+    asyncio.run(runtime_pipeline.run())
+
+
+def main():
+    """
+    Main Entrypoint
+    Setup initial requirements
+     - Connection to bluesky
+     - Connection to FlightAware
+    Start Loop
+     - Scan list of seen aircraft
+     - Identify new target aircraft
+     - Generate and publish post
+    """
+
+    debug.dprint("Loading Settings")
+    settings.init()
+    debug.setup_logging(
+        debug.parse_level(settings.get_string("logging", "level")),
+        settings.get_string("logging", "syslog_address"),
+    )
+    debug.install_signal_handlers()
+
+    runtime_mode = settings.get_string("default", "runtime")
+    # The asyncio runtime looks up the Global DB from a worker thread
+    runtime = setup_runtime(check_same_thread=(runtime_mode != "asyncio"))
+    logger.info("Starting %s runtime", runtime_mode)
+    if runtime_mode == "asyncio":
+        run_asyncio(runtime)
+    else:
+        run_serial(runtime)
+
+
 if __name__ == "__main__":
     main()
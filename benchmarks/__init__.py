@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Barkley benchmarks - run from the repository root, e.g.
+
+    python3 -m benchmarks.micro
+"""
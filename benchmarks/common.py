@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared benchmark plumbing - timing, JSON results and baseline comparison.
+
+Results files look like
+
+    {
+      "meta": {"python": ..., "platform": ..., "seed": ..., "time": ...},
+      "results": {"<benchmark>": {"median_us": ..., "min_us": ..., ...}}
+    }
+
+A run is compared against a stored baseline by best-round time per item,
+which is less noisy than the median on a busy machine. Any benchmark
+slower than the baseline by more than the tolerance is flagged as a
+regression (and the script exits with status 1).
+
+Baselines are only comparable on the machine that recorded them, so they
+are recorded locally with --save-baseline rather than kept in git.
+"""
+
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+
+
+def measure(func, batch_size=1, repeat=7, min_time=0.2):
+    """
+    Time func() - which processes batch_size items per call
+    The number of calls per round is grown until a round takes min_time,
+    then repeat rounds are timed
+    Returns a dictionary of microseconds per item and items per second
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        rounds.append((time.perf_counter() - started) / (loops * batch_size))
+    median = statistics.median(rounds)
+    return {
+        "median_us": median * 1e6,
+        "min_us": min(rounds) * 1e6,
+        "max_us": max(rounds) * 1e6,
+        "ops_per_sec": 1.0 / median if median > 0 else 0.0,
+        "items": loops * batch_size,
+        "repeat": repeat,
+    }
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values (pct 0 - 100)"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples, items=1):
+    """
+    Latency summary of a list of samples (seconds), each covering items
+    Times are in microseconds per sample, throughput in items per second
+    """
+    median = statistics.median(samples)
+    return {
+        "median_us": median * 1e6,
+        "min_us": min(samples) * 1e6,
+        "p90_us": percentile(samples, 90) * 1e6,
+        "p99_us": percentile(samples, 99) * 1e6,
+        "max_us": max(samples) * 1e6,
+        "ops_per_sec": items / median if median > 0 else 0.0,
+        "items": items,
+        "repeat": len(samples),
+    }
+
+
+def metadata(seed, **extra):
+    """Where and how the results were produced"""
+    meta = {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "seed": seed,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    meta.update(extra)
+    return meta
+
+
+def write_results(filename, meta, results):
+    """Save results as JSON"""
+    with open(filename, "w") as results_file:
+        json.dump({"meta": meta, "results": results}, results_file, indent=2)
+        results_file.write("\n")
+
+
+def load_results(filename):
+    """Load a results (or baseline) file"""
+    with open(filename) as results_file:
+        return json.load(results_file)
+
+
+def compare(results, baseline, tolerance=0.25, key="min_us"):
+    """
+    Compare results against baseline results
+    Returns a list of (name, baseline value, value, ratio, regressed)
+    """
+    comparison = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if (base is None) or (key not in base) or (not base[key]):
+            continue
+        ratio = result[key] / base[key]
+        comparison.append((name, base[key], result[key], ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+def print_results(results):
+    """Table of results"""
+    print("%-32s %12s %12s %14s" % ("benchmark", "median us", "min us", "ops/sec"))
+    for name, result in sorted(results.items()):
+        print(
+            "%-32s %12.3f %12.3f %14.0f"
+            % (name, result["median_us"], result["min_us"], result["ops_per_sec"])
+        )
+
+
+def print_comparison(comparison, tolerance):
+    """Table of a comparison against the baseline - returns the regressions"""
+    regressions = [entry for entry in comparison if entry[4]]
+    print()
+    print("%-32s %12s %12s %8s" % ("vs baseline (min us)", "baseline", "now", "ratio"))
+    for name, base, value, ratio, regressed in comparison:
+        print(
+            "%-32s %12.3f %12.3f %7.2fx%s"
+            % (name, base, value, ratio, "  REGRESSION" if regressed else "")
+        )
+    print(
+        "%d regression(s) beyond %.0f%% tolerance" % (len(regressions), tolerance * 100)
+    )
+    return regressions
+
+
+def add_arguments(parser, default_baseline):
+    """Command line options shared by the benchmark scripts"""
+    parser.add_argument("--seed", type=int, default=1090, help="random seed")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        default=default_baseline,
+        help="baseline JSON to compare against (default %(default)s)",
+    )
+    parser.add_argument(
+        "--no-compare", action="store_true", help="skip the baseline comparison"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write the results to the baseline file instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="slowdown allowed before flagging a regression (default %(default)s)",
+    )
+
+
+def finish(args, meta, results, key="min_us"):
+    """
+    Write, print and compare results as asked on the command line
+    Returns the process exit status - 1 if anything regressed
+    """
+    print_results(results)
+    if args.output:
+        write_results(args.output, meta, results)
+    if args.save_baseline:
+        write_results(args.baseline, meta, results)
+        print("Baseline saved to " + args.baseline)
+        return 0
+    if args.no_compare:
+        return 0
+    try:
+        baseline = load_results(args.baseline)
+    except FileNotFoundError:
+        # Baselines are not kept in git - a fresh checkout has none
+        print(
+            "Comparison skipped - no baseline at "
+            + args.baseline
+            + " (baselines are recorded per machine and not kept in git)."
+        )
+        print("Record one on this machine with --save-baseline, then run again.")
+        return 0
+    regressions = print_comparison(
+        compare(results, baseline["results"], args.tolerance, key), args.tolerance
+    )
+    return 1 if regressions else 0
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Post image rendering throughput, in images/sec.
+
+    python3 -m benchmarks.images [--count 50] [--workers 1,2,4]
+
+Renders a batch of post images through
+
+    file     the old way - open the base image and font for every image,
+             and save each one to a temporary file
+    inline   postimage.PostImageRenderer in this process (cached base
+             image and font, PNG bytes in memory)
+    pool.N   the same renderer with N worker processes, the whole batch
+             submitted at once
+
+The base image is from the [images] section of config.ini if it exists,
+otherwise a synthetic one of --width x --height is drawn.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+import postimage
+import settings
+from benchmarks import common
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_images.json")
+
+
+def synthetic_base_image(filename, rng, width, height):
+    """Map-like base image - flat colour areas, roads and some noise"""
+    image = Image.new("RGB", (width, height), (236, 232, 222))
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x_pos, y_pos = rng.randrange(width), rng.randrange(height)
+        draw.rectangle(
+            (x_pos, y_pos, x_pos + rng.randrange(20, 200), y_pos + rng.randrange(20, 200)),
+            fill=(rng.randrange(150, 240), rng.randrange(180, 240), rng.randrange(150, 220)),
+        )
+    for _ in range(40):
+        draw.line(
+            (
+                rng.randrange(width),
+                rng.randrange(height),
+                rng.randrange(width),
+                rng.randrange(height),
+            ),
+            fill=(255, 255, 255),
+            width=rng.randrange(2, 8),
+        )
+    image.save(filename)
+
+
+def post_lines(rng, index):
+    """Text drawn under the hexcode"""
+    return (
+        "BNCH%03d" % index,
+        "@%dft Hdg:%s" % (rng.randrange(0, 41000, 100), rng.choice("NESW")),
+        time.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def render_to_file(base_image, font_file, font_size, hexcode, lines, directory):
+    """The old generate_temp_image - reload everything, write a file"""
+    image = Image.open(base_image)
+    try:
+        font = ImageFont.truetype(font_file, font_size)
+    except OSError:
+        font = ImageFont.load_default(font_size)
+    draw = ImageDraw.Draw(image)
+    draw.text((50, 50), hexcode, (0, 0, 0), font=font)
+    for offset, line in enumerate(lines):
+        draw.text((50, 110 + offset * 30), line, (0, 0, 0), font=font)
+    image_file = os.path.join(directory, hexcode + "-post_image.png")
+    image.save(image_file)
+    return image_file
+
+
+def time_batches(render_batch, count, repeat):
+    """Seconds per batch of count images, after one warm up batch"""
+    render_batch()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render_batch()
+        samples.append(time.perf_counter() - started)
+    return common.summarize(samples, count)
+
+
+def main():
+    """Command line entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    common.add_arguments(parser, DEFAULT_BASELINE)
+    parser.add_argument("--count", type=int, default=50, help="images per batch")
+    parser.add_argument("--repeat", type=int, default=5, help="timed batches")
+    parser.add_argument(
+        "--workers", default="1,2,4", help="worker process counts for the pool runs"
+    )
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument(
+        "--compress-level", type=int, default=6, help="PNG compression level"
+    )
+    args = parser.parse_args()
+
+    settings.init()
+    rng = random.Random(args.seed)
+    font_file = settings.get_string("images", "font")
+    font_size = settings.get_integer("images", "font_size")
+    posts = [("%06x" % rng.randrange(0xFFFFFF), post_lines(rng, index)) for index in range(args.count)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        base_image = settings.get_string("images", "base_image")
+        if not os.path.isfile(base_image):
+            base_image = os.path.join(work_dir, "base-image.png")
+            synthetic_base_image(base_image, rng, args.width, args.height)
+
+        def file_batch():
+            for hexcode, lines in posts:
+                render_to_file(base_image, font_file, font_size, hexcode, lines, work_dir)
+
+        results["images.file"] = time_batches(file_batch, args.count, args.repeat)
+
+        renderer = postimage.PostImageRenderer(
+            base_image, font_file, font_size, compress_level=args.compress_level
+        )
+
+        def inline_batch():
+            for hexcode, lines in posts:
+                renderer.render(hexcode, lines)
+
+        results["images.inline"] = time_batches(inline_batch, args.count, args.repeat)
+
+        for workers in sorted(int(count) for count in args.workers.split(",")):
+            renderer = postimage.PostImageRenderer(
+                base_image,
+                font_file,
+                font_size,
+                workers=workers,
+                compress_level=args.compress_level,
+            )
+
+            def pool_batch():
+                futures = [renderer.submit(hexcode, lines) for hexcode, lines in posts]
+                for future in futures:
+                    future.result()
+
+            try:
+                results["images.pool.%d" % workers] = time_batches(
+                    pool_batch, args.count, args.repeat
+                )
+            finally:
+                renderer.close()
+
+    print("%-20s %12s %12s" % ("renderer", "images/sec", "ms/image"))
+    for name, result in sorted(results.items()):
+        print(
+            "%-20s %12.1f %12.2f"
+            % (name, result["ops_per_sec"], 1000.0 / result["ops_per_sec"])
+        )
+    print()
+    meta = common.metadata(
+        args.seed,
+        count=args.count,
+        width=args.width,
+        height=args.height,
+        compress_level=args.compress_level,
+    )
+    return common.finish(args, meta, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks for the geo and aviation math hot paths.
+
+    python3 -m benchmarks.micro [--output results.json] [--save-baseline]
+
+Inputs are generated from a fixed seed around the Seattle area, so runs
+are repeatable. Results are compared against benchmarks/baseline_micro.json,
+recorded on the benchmark machine with --save-baseline.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+from geopy import Point
+
+import aircraft
+import airports
+import aviationmath
+import barkley
+import geocalc
+from benchmarks import common
+
+BATCH_SIZE = 1000
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_micro.json")
+
+CATEGORIES = ("A1", "A2", "A3", "A5", "A7", "B1")
+MANUFACTURERS = (("Boeing", "737-800"), ("Airbus", "A320"), ("Cessna", "172"), None)
+
+
+def random_positions(rng, count):
+    """(lat, lon) tuples within roughly 200 miles of Seattle"""
+    return [
+        (rng.uniform(45.0, 50.0), rng.uniform(-125.5, -119.0)) for _ in range(count)
+    ]
+
+
+def random_adsb_record(rng, index):
+    """A dump1090 aircraft.json style record - some fields left out"""
+    record = {
+        "hex": "%06x" % rng.randrange(0xFFFFFF),
+        "flight": "BNCH%03d " % (index % 1000),
+        "squawk": "%04d" % rng.choice((1200, 4521, 7700, 2301)),
+        "gs": rng.uniform(80, 520),
+        "lat": rng.uniform(45.0, 50.0),
+        "lon": rng.uniform(-125.5, -119.0),
+        "alt_baro": rng.choice(("ground", rng.randrange(0, 41000))),
+        "track": rng.uniform(0, 360),
+        "geom_rate": rng.randrange(-3000, 3000, 64),
+        "category": rng.choice(CATEGORIES),
+    }
+    for key in ("squawk", "geom_rate", "category", "track"):
+        if rng.random() < 0.2:
+            del record[key]
+    return record
+
+
+def random_aircraft(rng, count):
+    """Aircraft records with the Global DB fields filled in for some"""
+    crafts = []
+    for index in range(count):
+        craft = aircraft.Aircraft(random_adsb_record(rng, index))
+        maker = rng.choice(MANUFACTURERS)
+        if maker is not None:
+            craft.manufacturer, craft.model = maker
+        craft.update_airport_distance("ksea", rng.uniform(0, 200))
+        crafts.append(craft)
+    return crafts
+
+
+def build_benchmarks(seed):
+    """Name -> (callable processing BATCH_SIZE items)"""
+    rng = random.Random(seed)
+    points_a = random_positions(rng, BATCH_SIZE)
+    points_b = random_positions(rng, BATCH_SIZE)
+    pairs = list(zip(points_a, points_b))
+    geopoints = [Point(lat, lon) for lat, lon in points_a]
+    airport = airports.Airport("ksea", "sea", 47.4498889, -122.3117778, 423.3)
+    geobox = geocalc.Geocalc(
+        "seatac", 47.436920, 47.523239, -121.37, -122.30, 0, 10000
+    )
+    crafts = random_aircraft(rng, BATCH_SIZE)
+    distances = [craft.get_airport_distance("ksea") for craft in crafts]
+    craft_distances = list(zip(crafts, distances))
+
+    def bench_distance():
+        for point_a, point_b in pairs:
+            aviationmath.distance(point_a, point_b)
+
+    def bench_bearing():
+        for point_a, point_b in pairs:
+            aviationmath.bearing(point_a, point_b)
+
+    def bench_distance_to_airport():
+        for lat, lon in points_a:
+            barkley.distance_to_airport(airport, lat, lon)
+
+    def bench_inside2d():
+        for geopoint in geopoints:
+            geobox.inside2D(geopoint)
+
+    def bench_cardinal():
+        for craft in crafts:
+            craft.cardinal()
+
+    def bench_quality_score():
+        for craft in crafts:
+            craft.quality_score()
+
+    def bench_create_flutter():
+        for craft, distance in craft_distances:
+            barkley.create_flutter(craft, distance)
+
+    return {
+        "aviationmath.distance": bench_distance,
+        "aviationmath.bearing": bench_bearing,
+        "barkley.distance_to_airport": bench_distance_to_airport,
+        "geocalc.inside2D": bench_inside2d,
+        "aircraft.cardinal": bench_cardinal,
+        "aircraft.quality_score": bench_quality_score,
+        "barkley.create_flutter": bench_create_flutter,
+    }
+
+
+def main():
+    """Command line entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    common.add_arguments(parser, DEFAULT_BASELINE)
+    parser.add_argument(
+        "--only", action="append", help="run only benchmarks with this prefix"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=7, help="timed rounds per benchmark"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in build_benchmarks(args.seed).items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        results[name] = common.measure(func, BATCH_SIZE, repeat=args.repeat)
+    meta = common.metadata(args.seed, batch_size=BATCH_SIZE)
+    return common.finish(args, meta, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
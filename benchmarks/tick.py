@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end main loop benchmark with synthetic traffic.
+
+    python3 -m benchmarks.tick [--sizes 100,1000,10000,50000] [--ticks 30]
+
+For each fleet size a synthetic dump1090 feed is generated - aircraft fly
+straight-ish tracks at realistic speeds, climb and descend, and a share of
+them leave and are replaced by new aircraft every snapshot - and every
+snapshot is driven through the main loop stages:
+
+    parse     json.loads of the aircraft.json bytes
+    adsb      update_adsb_data
+    geo       update_aircraft_data
+    select    post candidate selection
+    flutter   flutter_known_aircraft (posts go to a no-op publisher)
+    clear     clear_tick_changes
+    save      StateStore.save (temporary database)
+    age_out   age_out_old_adsb
+
+Per-stage latency percentiles, aircraft/sec and peak RSS are reported per
+size. Sizes run smallest first, so the peak RSS of a size is not inflated
+by an earlier, larger one.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import airspace
+import barkley
+import debug
+import expiryindex
+import fleettable
+import global_aircraft_db
+import settings
+import statestore
+import trackhistory
+from benchmarks import common
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_tick.json")
+
+STAGES = ("parse", "adsb", "geo", "select", "flutter", "clear", "save", "age_out")
+
+# Centre of the synthetic traffic - SeaTac
+CENTRE_LAT = 47.45
+CENTRE_LON = -122.31
+
+CATEGORIES = ("A1", "A2", "A3", "A3", "A3", "A5", "A7", "B1")
+
+
+class TrafficGenerator:
+    """Synthetic aircraft.json snapshots with aircraft moving between them"""
+
+    def __init__(self, rng, count, churn=0.01, spread=3.0):
+        """
+        - count = aircraft visible in every snapshot
+        - churn = share of aircraft replaced by new ones per snapshot
+        - spread = degrees around the centre aircraft start in
+        """
+        self.rng = rng
+        self.churn = churn
+        self.spread = spread
+        self.next_serial = 0
+        self.aircraft = [self._new_aircraft() for _ in range(count)]
+
+    def _new_aircraft(self):
+        """State for one synthetic aircraft"""
+        rng = self.rng
+        self.next_serial += 1
+        climbing = rng.random()
+        return {
+            "hex": "%06x" % ((self.next_serial * 7919) & 0xFFFFFF),
+            "flight": "SYN%04d " % (self.next_serial % 10000),
+            "squawk": "%04o" % rng.randrange(0o10000),
+            "lat": CENTRE_LAT + rng.uniform(-self.spread, self.spread),
+            "lon": CENTRE_LON + rng.uniform(-self.spread, self.spread),
+            "alt": float(rng.randrange(0, 41000)),
+            "gs": rng.uniform(90, 520),
+            "track": rng.uniform(0, 360),
+            "vsi": 0 if climbing < 0.6 else rng.choice((-1, 1)) * rng.randrange(500, 3000),
+            "category": rng.choice(CATEGORIES),
+            # Some aircraft never report a position (Mode S only)
+            "has_position": rng.random() > 0.08,
+        }
+
+    def _move(self, craft, seconds):
+        """Fly one aircraft forward"""
+        rng = self.rng
+        craft["track"] = (craft["track"] + rng.gauss(0, 1.5)) % 360
+        distance_nm = craft["gs"] * seconds / 3600.0
+        track = math.radians(craft["track"])
+        craft["lat"] += distance_nm * math.cos(track) / 60.0
+        craft["lon"] += (
+            distance_nm * math.sin(track) / (60.0 * math.cos(math.radians(craft["lat"])))
+        )
+        craft["alt"] = min(45000.0, max(0.0, craft["alt"] + craft["vsi"] * seconds / 60.0))
+        if rng.random() < 0.01:
+            craft["vsi"] = rng.choice((0, 0, -1500, 1500))
+
+    def advance(self, seconds):
+        """Move every aircraft, and replace a share of them with new ones"""
+        for craft in self.aircraft:
+            self._move(craft, seconds)
+        for _ in range(int(len(self.aircraft) * self.churn)):
+            self.aircraft[self.rng.randrange(len(self.aircraft))] = self._new_aircraft()
+
+    def snapshot(self, now):
+        """aircraft.json contents as bytes"""
+        records = []
+        for craft in self.aircraft:
+            record = {
+                "hex": craft["hex"],
+                "flight": craft["flight"],
+                "squawk": craft["squawk"],
+                "gs": round(craft["gs"], 1),
+                "track": round(craft["track"], 1),
+                "geom_rate": craft["vsi"],
+                "category": craft["category"],
+                "alt_baro": "ground" if craft["alt"] < 50 else int(craft["alt"]),
+            }
+            if craft["has_position"]:
+                record["lat"] = round(craft["lat"], 6)
+                record["lon"] = round(craft["lon"], 6)
+            records.append(record)
+        return json.dumps({"now": now, "messages": 0, "aircraft": records}).encode()
+
+
+def run_size(size, args, state_dir):
+    """Drive args.ticks snapshots of size aircraft through the loop stages"""
+    rng = random.Random(args.seed + size)
+    traffic = TrafficGenerator(rng, size, churn=args.churn)
+    known_aircraft = {}
+    airport_db = {}
+    barkley.setup_airports(airport_db)
+    airspace_db = airspace.AirspaceRegistry(
+        float(settings.get_string("airspace", "grid_cell_size"))
+    )
+    barkley.setup_airspace(airspace_db)
+    global_db = global_aircraft_db.AircraftDbCache(
+        global_aircraft_db.open_readonly(args.global_db) if args.global_db else None
+    )
+    history_budget = trackhistory.HistoryBudget(
+        settings.get_integer("history", "max_memory_mb") * 1024 * 1024,
+        settings.get_integer("history", "samples"),
+    )
+    max_aircraft = args.max_aircraft
+    if max_aircraft is None:
+        # Room for every aircraft plus churn, so the cap does not evict
+        max_aircraft = max(settings.get_integer("tracking", "max_aircraft"), size * 2)
+    fleet_table = None
+    expiry_index = None
+    if args.mode == "fleet":
+        fleet_table = fleettable.FleetTable(size, max_aircraft)
+    else:
+        expiry_index = expiryindex.ExpiryIndex(max_aircraft)
+    state_store = statestore.StateStore(
+        os.path.join(state_dir, "state_%d.sqlite3" % size),
+        seen_interval=float(settings.get_string("state", "seen_interval")),
+    )
+    post_candidates = set()
+    posts = []
+
+    def publisher(craft, post_str):
+        # No-op publisher - the post always succeeds
+        posts.append(post_str)
+        craft.mark_as_fluttered()
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    now = time.time()
+    for tick in range(args.warmup + args.ticks):
+        traffic.advance(args.tick_seconds)
+        now += args.tick_seconds
+        raw = traffic.snapshot(now)
+        stage_times = {}
+
+        started = time.perf_counter()
+        adsb_data = json.loads(raw)
+        stage_times["parse"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        changed_hexcodes = barkley.update_adsb_data(
+            adsb_data["aircraft"],
+            known_aircraft,
+            global_db,
+            fleet_table,
+            history_budget,
+            expiry_index,
+            now,
+        )
+        stage_times["adsb"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        barkley.update_aircraft_data(
+            known_aircraft,
+            airport_db,
+            airspace_db,
+            fleet_table,
+            None if args.mode == "full" else changed_hexcodes,
+        )
+        stage_times["geo"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if fleet_table is not None:
+            candidates = barkley.sync_fleet_candidates(known_aircraft, fleet_table)
+        elif args.mode == "full":
+            candidates = None
+        else:
+            candidates = barkley.update_post_candidates(
+                known_aircraft, post_candidates, changed_hexcodes
+            )
+        stage_times["select"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        barkley.flutter_known_aircraft(
+            known_aircraft, airspace_db, None, candidates, publisher
+        )
+        stage_times["flutter"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        barkley.clear_tick_changes(known_aircraft, changed_hexcodes)
+        stage_times["clear"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        state_store.save(known_aircraft)
+        stage_times["save"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        barkley.age_out_old_adsb(
+            known_aircraft,
+            args.max_age,
+            fleet_table,
+            history_budget,
+            expiry_index,
+            now,
+        )
+        stage_times["age_out"] = time.perf_counter() - started
+
+        if tick < args.warmup:
+            continue
+        for stage, seconds in stage_times.items():
+            timings[stage].append(seconds)
+        totals.append(sum(stage_times.values()))
+    state_store.close()
+
+    results = {}
+    for stage in STAGES:
+        results["%s.%d.%s" % (args.mode, size, stage)] = common.summarize(
+            timings[stage], size
+        )
+    total = common.summarize(totals, size)
+    total["peak_rss_mb"] = peak_rss_mb()
+    total["tracked_aircraft"] = len(known_aircraft)
+    total["posts"] = len(posts)
+    results["%s.%d.tick" % (args.mode, size)] = total
+    return results
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def print_summary(results, sizes, mode):
+    """Per size table of stage latencies, throughput and memory"""
+    for size in sizes:
+        prefix = "%s.%d." % (mode, size)
+        total = results[prefix + "tick"]
+        print()
+        print(
+            "%d aircraft - %.0f aircraft/sec, peak RSS %.1f MB, tracked %d, posts %d"
+            % (
+                size,
+                total["ops_per_sec"],
+                total["peak_rss_mb"],
+                total["tracked_aircraft"],
+                total["posts"],
+            )
+        )
+        print("  %-8s %10s %10s %10s %10s" % ("stage", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for stage in STAGES + ("tick",):
+            result = results[prefix + stage]
+            print(
+                "  %-8s %10.2f %10.2f %10.2f %10.2f"
+                % (
+                    stage,
+                    result["median_us"] / 1000.0,
+                    result["p90_us"] / 1000.0,
+                    result["p99_us"] / 1000.0,
+                    result["max_us"] / 1000.0,
+                )
+            )
+
+
+def main():
+    """Command line entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    common.add_arguments(parser, DEFAULT_BASELINE)
+    parser.add_argument(
+        "--sizes",
+        default="100,1000,10000,50000",
+        help="comma separated aircraft counts (default %(default)s)",
+    )
+    parser.add_argument("--ticks", type=int, default=30, help="timed snapshots per size")
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="untimed snapshots before timing"
+    )
+    parser.add_argument(
+        "--tick-seconds", type=float, default=1.0, help="seconds between snapshots"
+    )
+    parser.add_argument(
+        "--churn",
+        type=float,
+        default=0.01,
+        help="share of aircraft replaced per snapshot (default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        default=60,
+        help="age out aircraft not seen for this many (snapshot clock) seconds",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("dirty", "full", "fleet"),
+        default="dirty",
+        help="dirty = only changed aircraft, full = every aircraft, fleet = fleet table",
+    )
+    parser.add_argument(
+        "--max-aircraft",
+        type=int,
+        help="cap on tracked aircraft (default: twice the size, at least the config cap)",
+    )
+    parser.add_argument("--global-db", help="Global DB (sqlite or table) for lookups")
+    parser.add_argument(
+        "--with-logging",
+        action="store_true",
+        help="keep debug output and logging on (off by default)",
+    )
+    args = parser.parse_args()
+
+    settings.init()
+    debug.set_level(logging.DEBUG if args.with_logging else logging.WARNING)
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as state_dir:
+        for size in sizes:
+            results.update(run_size(size, args, state_dir))
+    print_summary(results, sizes, args.mode)
+    print()
+    meta = common.metadata(
+        args.seed,
+        mode=args.mode,
+        ticks=args.ticks,
+        warmup=args.warmup,
+        churn=args.churn,
+        tick_seconds=args.tick_seconds,
+    )
+    return common.finish(args, meta, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
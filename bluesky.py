@@ -1,48 +1,311 @@
 import requests
-import json
+import logging
+import os
 import re
-from typing import List, Dict
-from datetime import datetime, timezone
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional
 
-from atproto import Client, client_utils
+from requests.adapters import HTTPAdapter
+
+from atproto import Client
 
 # from bsky_bridge import BskySession
 # from bsky_bridge import post_text
 # from bsky_bridge import post_image
 
+logger = logging.getLogger("barkley")
+
+DEFAULT_XRPC_URL = "https://bsky.social/xrpc"
+
+# XRPC error names meaning the session is no longer accepted
+AUTH_ERROR_NAMES = ("ExpiredToken", "InvalidToken", "AuthenticationRequired", "AuthMissing")
+
+# regex based on: https://atproto.com/specs/handle#handle-identifier-syntax
+MENTION_REGEX = re.compile(
+    rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
+)
+
+# partial/naive URL regex based on: https://stackoverflow.com/a/3809435
+# tweaked to disallow some training punctuation
+URL_REGEX = re.compile(
+    rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
+)
+
+
+def is_auth_error(err) -> bool:
+    """True if err means the session has to be established again"""
+    if type(err).__name__ in ("LoginRequiredError", "UnauthorizedError"):
+        return True
+    response = getattr(err, "response", None)
+    if getattr(response, "status_code", None) == 401:
+        return True
+    content = getattr(response, "content", None)
+    error_name = getattr(content, "error", None)
+    if (error_name is None) and isinstance(content, dict):
+        error_name = content.get("error")
+    return error_name in AUTH_ERROR_NAMES
+
+
+def create_http_session(pool_size=4):
+    """requests Session with a small keep-alive connection pool"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class HandleResolver:
+    """
+    Resolves handles to DIDs through com.atproto.identity.resolveHandle
+    Answers are cached for ttl seconds, and handles that do not resolve
+    for negative_ttl seconds, so repeated mentions cost no HTTP requests.
+    The cache is one LRU of at most max_entries handles, shared by every
+    thread that posts
+    """
+
+    def __init__(
+        self,
+        xrpc_url=DEFAULT_XRPC_URL,
+        session=None,
+        timeout=10.0,
+        ttl=3600.0,
+        negative_ttl=300.0,
+        max_entries=1024,
+        clock=time.monotonic,
+    ):
+        """Init object and set initial values for internals"""
+        self.resolve_url = xrpc_url.rstrip("/") + "/com.atproto.identity.resolveHandle"
+        self.session = session if session is not None else create_http_session()
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # handle -> (expiry time, did or None), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hit_count = 0
+        self.request_count = 0
+
+    def _lookup(self, handle):
+        """Cached (True, did or None), or (False, None) if not cached"""
+        with self.lock:
+            entry = self.entries.get(handle)
+            if entry is None:
+                return (False, None)
+            if entry[0] <= self.clock():
+                del self.entries[handle]
+                return (False, None)
+            self.entries.move_to_end(handle)
+            self.hit_count += 1
+            return (True, entry[1])
+
+    def _store(self, handle, did, ttl):
+        """
+        Cache an answer, evicting the least recently used if full
+        Expired answers at the cold end are dropped on the way
+        """
+        with self.lock:
+            now = self.clock()
+            self.entries[handle] = (now + ttl, did)
+            self.entries.move_to_end(handle)
+            while self.entries:
+                expires, _ = next(iter(self.entries.values()))
+                if (len(self.entries) <= self.max_entries) and (expires > now):
+                    break
+                self.entries.popitem(last=False)
+
+    def resolve(self, handle: str) -> Optional[str]:
+        """DID for handle, or None if it can not be resolved"""
+        cached, did = self._lookup(handle)
+        if cached:
+            return did
+        with self.lock:
+            self.request_count += 1
+        try:
+            resp = self.session.get(
+                self.resolve_url, params={"handle": handle}, timeout=self.timeout
+            )
+        except requests.RequestException as err:
+            # Not cached - the next post tries again
+            logger.warning("resolveHandle failed for %s: %s", handle, err)
+            return None
+        if resp.status_code == 400:
+            # Unknown handle
+            self._store(handle, None, self.negative_ttl)
+            return None
+        if resp.status_code != 200:
+            logger.warning(
+                "resolveHandle failed for %s: HTTP %d", handle, resp.status_code
+            )
+            return None
+        try:
+            did = resp.json().get("did")
+        except (ValueError, AttributeError) as err:
+            # Not JSON, or not a JSON object
+            logger.warning("resolveHandle bad response for %s: %s", handle, err)
+            return None
+        self._store(handle, did, self.ttl if did else self.negative_ttl)
+        return did
+
+    def hits(self):
+        """Handles answered from the cache"""
+        return self.hit_count
+
+    def requests_made(self):
+        """resolveHandle requests made"""
+        return self.request_count
+
 
 class BlueSky:
     _username = None
     _auth = None
     _bsky_session = None
+    _session = None
 
-    def __init__(self, user_name, user_auth):
-        """Setup new session and record userid/pass details."""
+    def __init__(
+        self,
+        user_name,
+        user_auth,
+        xrpc_url=DEFAULT_XRPC_URL,
+        http_timeout=10.0,
+        handle_ttl=3600.0,
+        handle_negative_ttl=300.0,
+        handle_cache_size=1024,
+        session_file=None,
+        relogin_margin=86400.0,
+    ):
+        """
+        Setup new session and record userid/pass details.
+        - session_file = where the session is kept between restarts
+        - relogin_margin = log in again this many seconds before the
+          refresh token expires
+        """
         self._username = user_name
         self._auth = user_auth
+        self._xrpc_url = xrpc_url
+        self._session_file = session_file
+        self._relogin_margin = relogin_margin
+        self._resolver = HandleResolver(
+            xrpc_url,
+            timeout=http_timeout,
+            ttl=handle_ttl,
+            negative_ttl=handle_negative_ttl,
+            max_entries=handle_cache_size,
+        )
+        self.login_method = None
+        self.login_seconds = 0.0
         self.bluesky_login()
         return
 
-    def bluesky_login(self):
-        """Start new login auth session."""
-        # TODO: Add error handling
-        self._bsky_session = Client()
-        self._bsky_session.login(self._username, self._auth)
+    def _new_client(self):
+        """atproto Client that keeps the session file up to date"""
+        client = Client(base_url=self._xrpc_url)
+        client.on_session_change(self._save_session)
+        return client
+
+    def _save_session(self, event, session):
+        """Session change callback - write the session out for the next start"""
+        self._session = session
+        if (not self._session_file) or (event.name == "IMPORT"):
+            return
+        temp_file = self._session_file + ".tmp"
+        try:
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as session_out:
+                session_out.write(session.export())
+            os.replace(temp_file, self._session_file)
+        except OSError as err:
+            logger.error("Unable to save bluesky session: %s", err)
+
+    def _load_session(self):
+        """Session string saved by a previous run, or None"""
+        if not (self._session_file and os.path.isfile(self._session_file)):
+            return None
+        with open(self._session_file) as session_in:
+            return session_in.read().strip() or None
+
+    def _session_expiring(self):
+        """True if the refresh token expires within relogin_margin"""
+        if self._session is None:
+            return True
+        expires = self._session.refresh_jwt_payload.exp
+        if expires is None:
+            return False
+        return expires - time.time() < self._relogin_margin
+
+    def bluesky_login(self, reuse_session=True):
+        """
+        Start new login auth session.
+        The session saved by a previous run is reused when it still has a
+        usable refresh token, otherwise log in with the account password
+        """
+        start_time = time.perf_counter()
+        self._session = None
+        session_string = self._load_session() if reuse_session else None
+        if session_string is not None:
+            self._bsky_session = self._new_client()
+            try:
+                self._bsky_session.login(
+                    session_string=session_string, fetch_bsky_profile=False
+                )
+                if not self._session_expiring():
+                    self.login_method = "session"
+                    self.login_seconds = time.perf_counter() - start_time
+                    return
+            except Exception as err:
+                logger.warning("Saved bluesky session unusable: %s", err)
+        self._bsky_session = self._new_client()
+        self._bsky_session.login(
+            self._username, self._auth, fetch_bsky_profile=False
+        )
+        self.login_method = "password"
+        self.login_seconds = time.perf_counter() - start_time
         return
 
-    def bluesky_flutter(self, msg_text):
-        """Post text message to existing session."""
-        # TODO: Need to identify and refresh expired sessions
+    def bluesky_flutter(self, msg_text, image=None):
+        """
+        Post text message to existing session.
+        image = PNG bytes to attach, described by the message text
+        The access token is refreshed by the client before it expires,
+        the session is replaced before the refresh token expires, and a
+        post rejected for auth reasons is retried once after logging in
+        """
+        if self._session_expiring():
+            self.bluesky_login(reuse_session=False)
         msg_facets = self.parse_facets(msg_text)
-        self._bsky_session.send_post(text=msg_text, facets=msg_facets)
+        try:
+            self._send_post(msg_text, msg_facets, image)
+        except Exception as err:
+            if not is_auth_error(err):
+                raise
+            logger.warning("bluesky session rejected, logging in again: %s", err)
+            self.bluesky_login(reuse_session=False)
+            self._send_post(msg_text, msg_facets, image)
         return True
 
+    def _send_post(self, msg_text, msg_facets, image=None):
+        """Post as the logged in account (the profile is not fetched at login)"""
+        if image is not None:
+            self._bsky_session.send_image(
+                text=msg_text,
+                image=image,
+                image_alt=msg_text,
+                facets=msg_facets,
+                profile_identify=self._session.did,
+            )
+            return
+        self._bsky_session.send_post(
+            text=msg_text, facets=msg_facets, profile_identify=self._session.did
+        )
+
     def parse_mentions(self, text: str) -> List[Dict]:
         spans = []
-        # regex based on: https://atproto.com/specs/handle#handle-identifier-syntax
-        mention_regex = rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
         text_bytes = text.encode("UTF-8")
-        for m in re.finditer(mention_regex, text_bytes):
+        for m in MENTION_REGEX.finditer(text_bytes):
             spans.append(
                 {
                     "start": m.start(1),
@@ -54,11 +317,8 @@ class BlueSky:
 
     def parse_urls(self, text: str) -> List[Dict]:
         spans = []
-        # partial/naive URL regex based on: https://stackoverflow.com/a/3809435
-        # tweaked to disallow some training punctuation
-        url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
         text_bytes = text.encode("UTF-8")
-        for m in re.finditer(url_regex, text_bytes):
+        for m in URL_REGEX.finditer(text_bytes):
             spans.append(
                 {
                     "start": m.start(1),
@@ -72,15 +332,11 @@ class BlueSky:
     def parse_facets(self, text: str) -> List[Dict]:
         facets = []
         for m in self.parse_mentions(text):
-            resp = requests.get(
-                "https://bsky.social/xrpc/com.atproto.identity.resolveHandle",
-                params={"handle": m["handle"]},
-            )
+            did = self._resolver.resolve(m["handle"])
             # If the handle can't be resolved, just skip it!
             # It will be rendered as text in the post instead of a link
-            if resp.status_code == 400:
+            if did is None:
                 continue
-            did = resp.json()["did"]
             facets.append(
                 {
                     "index": {
@@ -2,15 +2,116 @@
 
 # -*- coding: utf-8 -*-
 
+#
+# Debug prints go to stdout through the "barkley.debug" logger, everything
+# else to syslog through "barkley". Both share the level of the "barkley"
+# logger, which is set from config.ini and can be changed while running
+#
+#   kill -USR1 <pid>    more verbose (down to DEBUG)
+#   kill -USR2 <pid>    less verbose (up to ERROR)
+#
+# Messages are %-formatted lazily - dprint("Airplane: %s", hexcode) costs a
+# flag check while debug is off. Once setup_logging() has run, records are
+# put on a queue and written out by a listener thread, so a slow syslog
+# or stdout never holds up the main loop.
+#
 
-import datetime
+import atexit
+import logging
+import logging.handlers
+import queue
+import signal
+import sys
 
-DEBUG_MSGS = True
+DEBUG_MSGS = False
 
+logger = logging.getLogger("barkley")
+debug_logger = logging.getLogger("barkley.debug")
+# Until setup_logging() runs, debug prints go straight to stdout
+debug_logger.propagate = False
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(
+    logging.Formatter("%(asctime)s barkley DEBUG: %(message)s", "%Y-%m-%d %H:%M:%S")
+)
+debug_logger.addHandler(_console_handler)
 
-def dprint(args):
-    """Passthrough call to print() if DEBUG_MSGS is enabled"""
+# Steps taken by the SIGUSR1 / SIGUSR2 handlers
+LEVEL_STEPS = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR)
+
+_listener = None
+
+
+def dprint(message, *args):
+    """
+    Debug print - message % args, only formatted if debug is enabled
+    A single argument of any type is printed as it is
+    """
     if DEBUG_MSGS:
-        appname = "barkley"
-        logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(logtime, appname, "DEBUG:", args, flush=True)
+        debug_logger.debug(message, *args)
+
+
+def parse_level(name):
+    """Logging level from a config value - DEBUG / INFO / WARNING / ERROR"""
+    level = logging.getLevelName(str(name).strip().upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown logging level " + str(name))
+    return level
+
+
+def set_level(level):
+    """Set the level of every barkley logger, debug prints included"""
+    global DEBUG_MSGS
+    logger.setLevel(level)
+    DEBUG_MSGS = logger.isEnabledFor(logging.DEBUG)
+
+
+def adjust_level(steps):
+    """Move the level steps along LEVEL_STEPS - negative is more verbose"""
+    current = logger.getEffectiveLevel()
+    index = min(
+        range(len(LEVEL_STEPS)), key=lambda step: abs(LEVEL_STEPS[step] - current)
+    )
+    index = max(0, min(len(LEVEL_STEPS) - 1, index + steps))
+    set_level(LEVEL_STEPS[index])
+    logger.warning("Logging level now %s", logging.getLevelName(LEVEL_STEPS[index]))
+
+
+def _not_debug(record):
+    """Syslog handler filter - debug prints stay on stdout"""
+    return not record.name.startswith(debug_logger.name)
+
+
+def setup_logging(level, syslog_address="/dev/log"):
+    """
+    Set the level, and move the log handlers behind a queue
+     - "barkley" records go to syslog
+     - debug prints go to stdout
+    Returns the queue listener (stopped at exit)
+    """
+    global _listener
+    set_level(level)
+    if _listener is not None:
+        return _listener
+    syslog_handler = logging.handlers.SysLogHandler(syslog_address)
+    syslog_handler.setLevel(logging.DEBUG)
+    syslog_handler.addFilter(_not_debug)
+    _console_handler.addFilter(logging.Filter(debug_logger.name))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    debug_logger.removeHandler(_console_handler)
+    debug_logger.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(
+        log_queue, syslog_handler, _console_handler, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def install_signal_handlers():
+    """SIGUSR1 - more verbose, SIGUSR2 - less verbose (main thread only)"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: adjust_level(-1))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: adjust_level(1))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Expiry Index - Tracked aircraft ordered by the time they were last seen.
+
+Every aircraft in a snapshot is touched, which moves it to the back of an
+ordered dictionary. Snapshots arrive in time order, so the front of the
+dictionary is always the aircraft seen longest ago, and
+
+    - expiring everything not seen since a cutoff only looks at the
+      aircraft that actually expire (plus one)
+    - evicting down to a hard cap drops the least recently seen first,
+      but never an aircraft from the latest snapshot
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("barkley")
+
+
+class ExpiryIndex:
+    """Hexcodes in last seen order, oldest first"""
+
+    def __init__(self, max_entries=None):
+        """
+        - max_entries = hard cap on tracked aircraft, None for no cap
+        """
+        self.max_entries = max_entries
+        self.last_seen = OrderedDict()
+        self.expired_count = 0
+        self.evicted_count = 0
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def __contains__(self, hexcode):
+        return hexcode in self.last_seen
+
+    def touch(self, hexcode, timestamp):
+        """Record hexcode as seen at timestamp"""
+        last_seen = self.last_seen
+        last_seen[hexcode] = timestamp
+        last_seen.move_to_end(hexcode)
+
+    def rebuild(self, known_aircraft):
+        """Index restored aircraft by their saved last seen time"""
+        self.last_seen = OrderedDict(
+            sorted(
+                (
+                    (hexcode, craft.last_seen_time())
+                    for hexcode, craft in known_aircraft.items()
+                ),
+                key=lambda entry: entry[1],
+            )
+        )
+
+    def expire(self, cutoff):
+        """Remove and return the hexcodes last seen before cutoff"""
+        expired = []
+        last_seen = self.last_seen
+        while last_seen:
+            hexcode, timestamp = next(iter(last_seen.items()))
+            if timestamp >= cutoff:
+                break
+            last_seen.popitem(last=False)
+            expired.append(hexcode)
+        self.expired_count += len(expired)
+        return expired
+
+    def evict(self):
+        """
+        Remove and return the least recently seen hexcodes over the cap
+        Aircraft touched at the latest timestamp (the current snapshot) are
+        kept - evicting one would just recreate it, unflagged, next tick
+        """
+        evicted = []
+        last_seen = self.last_seen
+        if (self.max_entries is None) or (len(last_seen) <= self.max_entries):
+            return evicted
+        newest = next(reversed(last_seen.values()))
+        while len(last_seen) > self.max_entries:
+            hexcode, timestamp = next(iter(last_seen.items()))
+            if timestamp >= newest:
+                logger.warning(
+                    "Tracking %d aircraft, over the cap of %d - the rest"
+                    " are all in the latest snapshot",
+                    len(last_seen),
+                    self.max_entries,
+                )
+                break
+            last_seen.popitem(last=False)
+            evicted.append(hexcode)
+        self.evicted_count += len(evicted)
+        return evicted
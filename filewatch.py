@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+File Watch - Wake the main loop when dump1090 rewrites aircraft.json.
+
+On Linux the directory holding the file is watched with inotify (through
+ctypes, no extra modules needed). dump1090 replaces aircraft.json atomically
+by writing a temp file and renaming it over the old one, which shows up as
+IN_MOVED_TO ; in-place rewrites show up as IN_CLOSE_WRITE. Individual writes
+(IN_MODIFY) are not watched, so a half-written file never wakes the loop.
+
+Where inotify is not available the watcher falls back to polling the file
+inode / mtime / size.
+
+If the directory itself goes away (dump1090 restarting can recreate
+/run/dump1090-fa) the kernel drops the watch (IN_DELETE_SELF / IN_IGNORED).
+The watch is then added again on the new directory, or the watcher falls
+back to polling if that is not possible.
+
+Bursts are coalesced - if processing falls behind, every event queued since
+the last tick is drained and turned into a single wake up. A minimum tick
+interval stops the pipeline running more often than is useful.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+logger = logging.getLogger("barkley")
+
+
+class FileWatcher:
+    """Wait for a file to be rewritten - inotify with a polling fallback"""
+
+    def __init__(self, filename, min_interval=1.0, poll_interval=1.0, mode="auto"):
+        """
+        Init object and start watching
+        - min_interval = minimum seconds between two wake ups
+        - poll_interval = seconds between checks when polling
+        - mode = auto / inotify / poll
+        """
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.basename = os.fsencode(os.path.basename(filename))
+        self.min_interval = min_interval
+        self.poll_interval = poll_interval
+        self.last_wake = 0.0
+        self.last_signature = None
+        self.wake_count = 0
+        self.event_count = 0
+        self.inotify_fd = None
+        self.libc = None
+        self.watch_lost = False
+        # Always let the first wait() through, so startup processes
+        # whatever snapshot is already on disk
+        self.pending = True
+        if mode in ("auto", "inotify"):
+            self.inotify_fd = self._inotify_open()
+            if (self.inotify_fd is None) and (mode == "inotify"):
+                raise OSError("inotify is not available for " + self.directory)
+
+    def _inotify_open(self):
+        """Start an inotify watch on the directory, None if not possible"""
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            return None
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if inotify_fd < 0:
+            return None
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+            os.close(inotify_fd)
+            return None
+        self.libc = libc
+        return inotify_fd
+
+    def _rewatch(self):
+        """
+        The directory watch was dropped - watch the (new) directory again,
+        or fall back to polling if it can not be watched
+        """
+        self.watch_lost = False
+        if (
+            self.libc.inotify_add_watch(
+                self.inotify_fd, os.fsencode(self.directory), WATCH_MASK
+            )
+            >= 0
+        ):
+            logger.warning("Watch on %s was dropped - watching again", self.directory)
+            return
+        logger.warning(
+            "Watch on %s was dropped and can not be added again - polling instead",
+            self.directory,
+        )
+        self.close()
+
+    def mode(self):
+        """Watch mechanism in use"""
+        if self.inotify_fd is None:
+            return "poll"
+        return "inotify"
+
+    def close(self):
+        """Stop watching"""
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def _drain_events(self):
+        """
+        Read every queued inotify event
+        Returns True if any of them were for the watched file, or the
+        directory watch had to be added again
+        """
+        matched = False
+        while True:
+            try:
+                buffer = os.read(self.inotify_fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buffer:
+                break
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(buffer):
+                _, event_mask, _, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = buffer[offset : offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if event_mask & (IN_DELETE_SELF | IN_IGNORED):
+                    self.watch_lost = True
+                elif name == self.basename:
+                    matched = True
+                    self.event_count += 1
+        if self.watch_lost:
+            self._rewatch()
+            # The file has most likely been recreated along with the directory
+            matched = True
+        return matched
+
+    def _poll_changed(self):
+        """Polling check - has the file identity changed since last time"""
+        try:
+            stat_result = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        signature = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        if signature == self.last_signature:
+            return False
+        self.last_signature = signature
+        self.event_count += 1
+        return True
+
+    def _wait_for_change(self, deadline):
+        """Block until the file changes or the deadline passes"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if self.inotify_fd is not None:
+                if remaining <= 0:
+                    return self._drain_events()
+                ready, _, _ = select.select([self.inotify_fd], [], [], remaining)
+                if ready and self._drain_events():
+                    return True
+            else:
+                if self._poll_changed():
+                    return True
+                if remaining <= 0:
+                    return False
+                time.sleep(min(self.poll_interval, remaining))
+            if time.monotonic() >= deadline:
+                return False
+
+    def wait(self, timeout=30.0):
+        """
+        Block until the watched file has been rewritten
+        - never returns sooner than min_interval after the previous wake up
+        - any number of changes since the last wake up count as one
+        Returns True if the file changed, False if timeout expired first
+        """
+        hold_off = self.last_wake + self.min_interval - time.monotonic()
+        if hold_off > 0:
+            time.sleep(hold_off)
+        changed = self.pending
+        self.pending = False
+        if self.inotify_fd is not None:
+            # Coalesce everything that queued up while we were busy
+            changed = self._drain_events() or changed
+        elif self._poll_changed():
+            changed = True
+        if not changed:
+            changed = self._wait_for_change(time.monotonic() + timeout)
+        self.last_wake = time.monotonic()
+        if changed:
+            self.wake_count += 1
+        return changed
+
+    def wakes(self):
+        """Number of wake ups caused by a file change"""
+        return self.wake_count
+
+    def events(self):
+        """Number of raw file change events seen (before coalescing)"""
+        return self.event_count
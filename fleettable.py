@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fleet Table - Struct-of-arrays store for every aircraft currently tracked.
+
+Instead of one Aircraft object per hexcode being updated record by record,
+each aircraft.json snapshot is merged into NumPy columns in bulk:
+
+    - hexcodes become integer keys (24 bit ICAO address, bit 24 set for
+      non-ICAO '~' addresses) and a hex -> row index finds their row
+    - positions, speeds, altitudes, track and vertical rate are float columns
+      (NaN = never reported), scattered in with one assignment per column
+    - alt_baro = 'ground' is stored as 0 feet with a ground flag, so sync
+      hands the Aircraft 'ground' just like the per record path does
+    - a field presence column uses the aircraft.FIELD_* bits
+
+Distance, airspace containment and age-out then run directly on the
+columns. A row is marked dirty when a snapshot changes one of its values,
+and only the dirty rows are copied back (sync) into their aircraft.Aircraft
+objects - once a tick, before they are saved.
+"""
+
+import logging
+
+import numpy as np
+
+import aircraft
+import airspace
+import geodistance
+
+logger = logging.getLogger("barkley")
+
+NON_ICAO_FLAG = 1 << 24
+
+# (column, dump1090 key, field bit)
+NUMERIC_FIELDS = (
+    ("lat", "lat", aircraft.FIELD_LAT),
+    ("lon", "lon", aircraft.FIELD_LON),
+    ("alt", "alt_baro", aircraft.FIELD_ALT),
+    ("gs", "gs", aircraft.FIELD_GS),
+    ("track", "track", aircraft.FIELD_TRACK),
+    ("vsi", "geom_rate", aircraft.FIELD_VSI),
+)
+
+# Aircraft slot for each numeric column
+NUMERIC_SLOTS = {
+    "lat": "latitude",
+    "lon": "longitude",
+    "alt": "altitude",
+    "gs": "ground_speed",
+    "track": "track_angle",
+    "vsi": "vertical_rate",
+}
+
+
+def icao_key(hexcode):
+    """Integer key for a dump1090 hexcode"""
+    if hexcode[:1] == "~":
+        return int(hexcode[1:], 16) | NON_ICAO_FLAG
+    return int(hexcode, 16)
+
+
+class FleetTable:
+    """Columnar table of tracked aircraft"""
+
+    def __init__(self, capacity=1024, max_entries=None):
+        """
+        Create an empty table with room for capacity aircraft
+        - max_entries = hard cap on tracked aircraft, None for no cap
+        """
+        self.capacity = 0
+        self.max_entries = max_entries
+        self.hex_to_row = {}
+        self.row_to_hex = []
+        self.free_rows = []
+        self.icao = np.zeros(0, dtype=np.int32)
+        self.active = np.zeros(0, dtype=bool)
+        self.fields = np.zeros(0, dtype=np.uint16)
+        self.last_seen = np.zeros(0, dtype=np.float64)
+        # Rows with values not yet copied back to their Aircraft
+        self.dirty = np.zeros(0, dtype=bool)
+        self.ground = np.zeros(0, dtype=bool)
+        self.numeric = {
+            name: np.zeros(0, dtype=np.float64) for name, _, _ in NUMERIC_FIELDS
+        }
+        self.text = {
+            "flight": np.zeros(0, dtype=object),
+            "squawk": np.zeros(0, dtype=object),
+            "category": np.zeros(0, dtype=object),
+        }
+        self.airport_keys = []
+        self.airport_distance = np.zeros((0, 0), dtype=np.float64)
+        self.airspace_masks = {}
+        self._grow(capacity)
+
+    def __len__(self):
+        return len(self.hex_to_row)
+
+    def __contains__(self, hexcode):
+        return hexcode in self.hex_to_row
+
+    def _grow(self, capacity):
+        """Extend every column to capacity rows"""
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.icao = np.concatenate([self.icao, np.zeros(extra, dtype=np.int32)])
+        self.active = np.concatenate([self.active, np.zeros(extra, dtype=bool)])
+        self.fields = np.concatenate([self.fields, np.zeros(extra, dtype=np.uint16)])
+        self.last_seen = np.concatenate(
+            [self.last_seen, np.zeros(extra, dtype=np.float64)]
+        )
+        self.dirty = np.concatenate([self.dirty, np.zeros(extra, dtype=bool)])
+        self.ground = np.concatenate([self.ground, np.zeros(extra, dtype=bool)])
+        for name in self.numeric:
+            self.numeric[name] = np.concatenate(
+                [self.numeric[name], np.full(extra, np.nan, dtype=np.float64)]
+            )
+        for name in self.text:
+            self.text[name] = np.concatenate(
+                [self.text[name], np.full(extra, None, dtype=object)]
+            )
+        self.airport_distance = np.concatenate(
+            [
+                self.airport_distance,
+                np.full((extra, len(self.airport_keys)), -1.0, dtype=np.float64),
+            ]
+        )
+        for name in self.airspace_masks:
+            self.airspace_masks[name] = np.concatenate(
+                [self.airspace_masks[name], np.zeros(extra, dtype=bool)]
+            )
+        self.row_to_hex.extend([None] * extra)
+        self.free_rows.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def _allocate(self, hexcode):
+        """Find a row for a new aircraft"""
+        if not self.free_rows:
+            self._grow(max(self.capacity * 2, 1024))
+        row = self.free_rows.pop()
+        self.hex_to_row[hexcode] = row
+        self.row_to_hex[row] = hexcode
+        self.icao[row] = icao_key(hexcode)
+        self.active[row] = True
+        self.fields[row] = 0
+        self.dirty[row] = True
+        self.ground[row] = False
+        for name in self.numeric:
+            self.numeric[name][row] = np.nan
+        for name in self.text:
+            self.text[name][row] = None
+        self.airport_distance[row, :] = -1.0
+        for mask in self.airspace_masks.values():
+            mask[row] = False
+        return row
+
+    def restore(self, known_aircraft):
+        """
+        Track restored Aircraft records by their saved last seen time,
+        so they age out like any other - values arrive with the next snapshot
+        """
+        for hexcode, craft in known_aircraft.items():
+            if hexcode not in self.hex_to_row:
+                row = self._allocate(hexcode)
+                self.last_seen[row] = craft.last_seen_time()
+                self.dirty[row] = False
+
+    def row(self, hexcode):
+        """Row for hexcode, or None if it is not tracked"""
+        return self.hex_to_row.get(hexcode)
+
+    def merge_snapshot(self, adsb_list, now):
+        """
+        Merge a whole aircraft.json 'aircraft' list into the table
+        Fields missing from a record keep their previous value, rows with
+        a value that changed are marked dirty
+        Returns the list of hexcodes that were not tracked before
+        """
+        count = len(adsb_list)
+        new_hexcodes = []
+        rows = np.empty(count, dtype=np.int64)
+        field_bits = np.zeros(count, dtype=np.uint16)
+        ground = np.zeros(count, dtype=bool)
+        columns = {name: np.full(count, np.nan) for name, _, _ in NUMERIC_FIELDS}
+        text_values = {name: [None] * count for name in self.text}
+        for index, record in enumerate(adsb_list):
+            hexcode = record["hex"]
+            row = self.hex_to_row.get(hexcode)
+            if row is None:
+                row = self._allocate(hexcode)
+                new_hexcodes.append(hexcode)
+            rows[index] = row
+            mask, values = aircraft.decode_fields(record)
+            field_bits[index] = mask
+            ground[index] = values.get("altitude") == "ground"
+            for name, _, field_bit in NUMERIC_FIELDS:
+                if mask & field_bit:
+                    # altitude_value also copes with alt_baro = 'ground'
+                    columns[name][index] = airspace.altitude_value(
+                        values[NUMERIC_SLOTS[name]]
+                    )
+            text_values["flight"][index] = values.get("flight_id")
+            text_values["squawk"][index] = values.get("squawk_code")
+            text_values["category"][index] = values.get("category_text")
+
+        if count == 0:
+            return new_hexcodes
+        # Vectorized compare and scatter - one pass per column
+        changed = (self.fields[rows] & field_bits) != field_bits
+        for name, column in columns.items():
+            present = ~np.isnan(column)
+            changed[present] |= self.numeric[name][rows[present]] != column[present]
+            self.numeric[name][rows[present]] = column[present]
+        has_alt = ~np.isnan(columns["alt"])
+        changed[has_alt] |= self.ground[rows[has_alt]] != ground[has_alt]
+        self.ground[rows[has_alt]] = ground[has_alt]
+        for name, values in text_values.items():
+            present = np.fromiter(
+                (value is not None for value in values), dtype=bool, count=count
+            )
+            values = np.array(values, dtype=object)[present]
+            changed[present] |= self.text[name][rows[present]] != values
+            self.text[name][rows[present]] = values
+        np.bitwise_or.at(self.fields, rows, field_bits)
+        self.dirty[rows[changed]] = True
+        self.last_seen[rows] = now
+        return new_hexcodes
+
+    def active_rows(self):
+        """Row numbers of tracked aircraft"""
+        return np.nonzero(self.active)[0]
+
+    def update_distances(self, airport_db, method="haversine"):
+        """Distance from every tracked aircraft to every airport, in one pass"""
+        airport_keys, airport_lats, airport_lons = geodistance.airport_arrays(
+            airport_db
+        )
+        if airport_keys != self.airport_keys:
+            self.airport_keys = airport_keys
+            self.airport_distance = np.full(
+                (self.capacity, len(airport_keys)), -1.0, dtype=np.float64
+            )
+            # Every aircraft gets a new set of distances
+            self.dirty |= self.active
+        rows = self.active_rows()
+        if rows.size == 0 or not airport_keys:
+            return
+        matrix = geodistance.distance_matrix(
+            self.numeric["lat"][rows],
+            self.numeric["lon"][rows],
+            airport_lats,
+            airport_lons,
+            method=method,
+        )
+        self.airport_distance[rows] = np.where(np.isnan(matrix), -1.0, matrix)
+
+    def update_airspaces(self, airspace_db, altitude_bands=False):
+        """Airspace containment masks for every tracked aircraft"""
+        lats = self.numeric["lat"]
+        lons = self.numeric["lon"]
+        alts = self.numeric["alt"] if altitude_bands else None
+        masks = airspace_db.masks(lats, lons, alts)
+        self.airspace_masks = {
+            name: mask & self.active for name, mask in masks.items()
+        }
+
+    def inside_any_airspace(self):
+        """Boolean mask of rows inside at least one known airspace"""
+        result = np.zeros(self.capacity, dtype=bool)
+        for mask in self.airspace_masks.values():
+            result |= mask
+        return result
+
+    def distance_column(self, airport):
+        """Distance column for one airport (-1 if unknown)"""
+        if airport not in self.airport_keys:
+            return np.full(self.capacity, -1.0)
+        return self.airport_distance[:, self.airport_keys.index(airport)]
+
+    def select(self, field_bits=0, airport=None, max_distance=None, in_airspace=False):
+        """
+        Hexcodes of tracked aircraft that have every field in field_bits,
+        are within max_distance of airport, and (optionally) are inside
+        a known airspace
+        """
+        mask = self.active & ((self.fields & field_bits) == field_bits)
+        if (airport is not None) and (max_distance is not None):
+            mask &= self.distance_column(airport) <= max_distance
+        if in_airspace:
+            mask &= self.inside_any_airspace()
+        return [self.row_to_hex[row] for row in np.nonzero(mask)[0]]
+
+    def changed(self):
+        """Hexcodes of the rows changed since they were last synced"""
+        return [self.row_to_hex[row] for row in np.nonzero(self.dirty)[0]]
+
+    def sync_changed(self, known_aircraft):
+        """
+        Sync every changed row into its record in known_aircraft
+        Returns the hexcodes synced
+        """
+        synced = []
+        for hexcode in self.changed():
+            craft = known_aircraft.get(hexcode)
+            if craft is not None:
+                self.sync(craft)
+                synced.append(hexcode)
+        return synced
+
+    def sync(self, craft):
+        """Bring an Aircraft object up to date from the table"""
+        row = self.hex_to_row.get(craft.hexcode())
+        if row is None:
+            return
+        self.dirty[row] = False
+        field_mask = int(self.fields[row])
+        values = {}
+        for name, _, field_bit in NUMERIC_FIELDS:
+            if field_mask & field_bit:
+                values[NUMERIC_SLOTS[name]] = self.numeric[name][row].item()
+        if field_mask & aircraft.FIELD_ALT:
+            if self.ground[row]:
+                values["altitude"] = "ground"
+            else:
+                values["altitude"] = int(values["altitude"])
+        for name, slot in (
+            ("flight", "flight_id"),
+            ("squawk", "squawk_code"),
+            ("category", "category_text"),
+        ):
+            if self.text[name][row] is not None:
+                values[slot] = self.text[name][row]
+        craft.set_fields(field_mask, values, self.last_seen[row].item())
+        for column, airport in enumerate(self.airport_keys):
+            craft.update_airport_distance(
+                airport, self.airport_distance[row, column].item()
+            )
+        craft.set_airspaces(
+            [name for name, mask in self.airspace_masks.items() if mask[row]]
+        )
+
+    def remove(self, hexcode):
+        """Stop tracking hexcode"""
+        row = self.hex_to_row.pop(hexcode, None)
+        if row is None:
+            return
+        self.row_to_hex[row] = None
+        self.active[row] = False
+        self.dirty[row] = False
+        self.free_rows.append(row)
+
+    def _remove_rows(self, rows):
+        """Stop tracking the given rows - returns their hexcodes"""
+        hexcodes = [self.row_to_hex[row] for row in rows]
+        for hexcode in hexcodes:
+            self.remove(hexcode)
+        return hexcodes
+
+    def age_out(self, cutoff):
+        """Remove and return the hexcodes last seen before cutoff"""
+        return self._remove_rows(
+            np.nonzero(self.active & (self.last_seen < cutoff))[0]
+        )
+
+    def evict(self):
+        """
+        Remove and return the least recently seen hexcodes over the cap
+        Rows from the latest snapshot are kept - evicting one would just
+        recreate it, unflagged, next tick
+        """
+        over = len(self) - (self.max_entries or len(self))
+        if over <= 0:
+            return []
+        rows = np.nonzero(self.active)[0]
+        rows = rows[self.last_seen[rows] < self.last_seen[rows].max()]
+        if rows.size < over:
+            logger.warning(
+                "Tracking %d aircraft, over the cap of %d - the rest"
+                " are all in the latest snapshot",
+                len(self) - rows.size,
+                self.max_entries,
+            )
+        oldest = rows[np.argsort(self.last_seen[rows], kind="stable")[:over]]
+        return self._remove_rows(oldest)
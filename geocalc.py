@@ -10,11 +10,15 @@ and a direction track is heading into or away from an airport - or just passing
 2D Tests do not consider altitude
 3D Tests consider altitude
 
+Batch tests take NumPy arrays of lat/lon/altitude (one entry per aircraft)
+and return a boolean mask, so a whole tick can be tested without a Python
+loop per aircraft. Unknown altitudes (NaN) are never inside a 3D volume.
+
 """
 
 import datetime
-from geopy import distance
-from geopy import point
+
+import numpy as np
 
 
 class Geocalc:
@@ -35,6 +39,21 @@ class Geocalc:
     def name(self):
         return self.identity
 
+    def bbox(self):
+        """Bounding box as (south, north, west, east)"""
+        return (
+            self.latitude_south,
+            self.latitude_north,
+            self.longitude_west,
+            self.longitude_east,
+        )
+
+    def contains(self, lat, lon):
+        """2D test on plain lat/lon values - used by airspace.AirspaceRegistry"""
+        return (self.latitude_south <= lat <= self.latitude_north) and (
+            self.longitude_west <= lon <= self.longitude_east
+        )
+
     def inside2D(self, geopoint):
         inside_latitude = False
         inside_longitude = False
@@ -60,6 +79,37 @@ class Geocalc:
         ):
             inside_altitude = True
 
-        if self.inside2D(point) and inside_altitude:
+        if self.inside2D(geopoint) and inside_altitude:
             result = True
         return result
+
+    def inside2D_batch(self, lats, lons):
+        """Boolean mask of the lat/lon pairs that are inside the box"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        return (
+            (lats >= self.latitude_south)
+            & (lats <= self.latitude_north)
+            & (lons <= self.longitude_east)
+            & (lons >= self.longitude_west)
+        )
+
+    def inside3D_batch(self, lats, lons, alts):
+        """Boolean mask of the lat/lon/alt points that are inside the cube"""
+        return self.inside2D_batch(lats, lons) & altitude_band_mask(
+            alts, self.altitude_lower, self.altitude_upper
+        )
+
+
+def altitude_band_mask(alts, alt_bottom, alt_top):
+    """
+    Boolean mask of the altitudes inside [alt_bottom, alt_top]
+    A bound of None is open ended ; NaN altitudes are never inside
+    """
+    alts = np.asarray(alts, dtype=np.float64)
+    mask = ~np.isnan(alts)
+    if alt_bottom is not None:
+        mask &= alts >= alt_bottom
+    if alt_top is not None:
+        mask &= alts <= alt_top
+    return mask
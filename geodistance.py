@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Geo Distance - Batched distance calculations between aircraft and airports.
+
+Rather than asking geopy for one geodesic solve per aircraft per airport,
+all current aircraft positions and all airport positions are packed into
+NumPy arrays and the full distance matrix is computed in a single pass.
+
+Two methods are available
+    haversine - Great circle on a spherical earth (default, fastest)
+    ellipsoid - Lambert's formula on the WGS-84 ellipsoid, within a few
+                metres of geopy's geodesic result at the ranges Barkley uses
+
+All distances are returned in statute miles, matching geopy's .miles
+"""
+
+import numpy as np
+
+# Mean earth radius used by geopy (6371.009 km) expressed in statute miles
+EARTH_RADIUS_MILES = 3958.7613
+
+# WGS-84 ellipsoid
+WGS84_A_MILES = 6378137.0 / 1609.344
+WGS84_F = 1 / 298.257223563
+
+DISTANCE_METHODS = ("haversine", "ellipsoid")
+
+
+def _central_angle(lat_a, lon_a, lat_b, lon_b):
+    """
+    Haversine central angle (radians) between every point in a
+    and every point in b. Inputs are radians, a is (n,1) and b is (1,m)
+    """
+    dlat = lat_b - lat_a
+    dlon = lon_b - lon_a
+    angle = (
+        np.sin(dlat / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin(dlon / 2) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(np.clip(angle, 0.0, 1.0)))
+
+
+def haversine_matrix(lat_a, lon_a, lat_b, lon_b):
+    """
+    Great circle distance in miles between every point in a and every
+    point in b (decimal degrees). Returns an (len(a), len(b)) array
+    """
+    lat_a = np.radians(np.asarray(lat_a, dtype=np.float64))[:, np.newaxis]
+    lon_a = np.radians(np.asarray(lon_a, dtype=np.float64))[:, np.newaxis]
+    lat_b = np.radians(np.asarray(lat_b, dtype=np.float64))[np.newaxis, :]
+    lon_b = np.radians(np.asarray(lon_b, dtype=np.float64))[np.newaxis, :]
+    return _central_angle(lat_a, lon_a, lat_b, lon_b) * EARTH_RADIUS_MILES
+
+
+def ellipsoid_matrix(lat_a, lon_a, lat_b, lon_b):
+    """
+    Lambert's formula for long lines on the WGS-84 ellipsoid.
+    Distance in miles between every point in a and every point in b
+    (decimal degrees). Returns an (len(a), len(b)) array
+    """
+    lat_a = np.radians(np.asarray(lat_a, dtype=np.float64))[:, np.newaxis]
+    lon_a = np.radians(np.asarray(lon_a, dtype=np.float64))[:, np.newaxis]
+    lat_b = np.radians(np.asarray(lat_b, dtype=np.float64))[np.newaxis, :]
+    lon_b = np.radians(np.asarray(lon_b, dtype=np.float64))[np.newaxis, :]
+
+    # Reduced (parametric) latitudes
+    beta_a = np.arctan((1 - WGS84_F) * np.tan(lat_a))
+    beta_b = np.arctan((1 - WGS84_F) * np.tan(lat_b))
+    sigma = _central_angle(beta_a, lon_a, beta_b, lon_b)
+
+    p_mid = (beta_a + beta_b) / 2
+    q_mid = (beta_b - beta_a) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_term = (
+            (sigma - np.sin(sigma))
+            * (np.sin(p_mid) * np.cos(q_mid)) ** 2
+            / np.cos(sigma / 2) ** 2
+        )
+        y_term = (
+            (sigma + np.sin(sigma))
+            * (np.cos(p_mid) * np.sin(q_mid)) ** 2
+            / np.sin(sigma / 2) ** 2
+        )
+        result = WGS84_A_MILES * (sigma - (WGS84_F / 2) * (x_term + y_term))
+    # Coincident points produce 0/0 - they are simply zero distance apart
+    return np.where(sigma == 0, 0.0, result)
+
+
+def distance_matrix(lat_a, lon_a, lat_b, lon_b, method="haversine"):
+    """Distance in miles between every point in a and every point in b"""
+    if method == "ellipsoid":
+        return ellipsoid_matrix(lat_a, lon_a, lat_b, lon_b)
+    if method == "haversine":
+        return haversine_matrix(lat_a, lon_a, lat_b, lon_b)
+    raise ValueError("Unknown distance method: " + str(method))
+
+
+def airport_arrays(airport_db):
+    """Pack an airport_db dict into (keys, lat array, lon array)"""
+    keys = list(airport_db)
+    lats = np.fromiter(
+        (airport_db[key].get_lat() for key in keys), dtype=np.float64, count=len(keys)
+    )
+    lons = np.fromiter(
+        (airport_db[key].get_lon() for key in keys), dtype=np.float64, count=len(keys)
+    )
+    return keys, lats, lons
+
+
+def aircraft_arrays(craft_list):
+    """
+    Pack a list of Aircraft into (lat array, lon array)
+    Aircraft without a position are recorded as NaN
+    """
+    count = len(craft_list)
+    lats = np.full(count, np.nan, dtype=np.float64)
+    lons = np.full(count, np.nan, dtype=np.float64)
+    for index, craft in enumerate(craft_list):
+        lat = craft.lat()
+        lon = craft.lon()
+        if (lat is not None) and (lon is not None):
+            lats[index] = lat
+            lons[index] = lon
+    return lats, lons
+
+
+def update_airport_distances(craft_list, airport_db, method="haversine"):
+    """
+    Compute the distance from every aircraft in craft_list to every
+    airport in airport_db in one pass, and record the results through
+    Aircraft.update_airport_distance. Aircraft without a position get -1,
+    matching barkley.distance_to_airport
+    """
+    craft_list = list(craft_list)
+    if (not craft_list) or (not airport_db):
+        return None
+    airport_keys, airport_lats, airport_lons = airport_arrays(airport_db)
+    craft_lats, craft_lons = aircraft_arrays(craft_list)
+    matrix = distance_matrix(
+        craft_lats, craft_lons, airport_lats, airport_lons, method=method
+    )
+    matrix = np.where(np.isnan(matrix), -1.0, matrix)
+    rows = matrix.tolist()
+    for craft, row in zip(craft_list, rows):
+        for airport_entry, craft_distance in zip(airport_keys, row):
+            craft.update_airport_distance(airport_entry, craft_distance)
+    return matrix
@@ -4,11 +4,177 @@
 Created on Tue Jun 18 23:42:16 2019
 
 @author: chris
+
+Map images built from OSM style (slippy map) tiles.
+
+The tiles covering a lat/lon bounding box are fetched concurrently over a
+pooled HTTP session, kept in an MBTiles style SQLite cache, and stitched
+together and cropped to the bounding box. Maps of an area that has been
+drawn before come straight from the cache without any HTTP requests.
 """
 
+import concurrent.futures
+import logging
+import math
+import sqlite3
+import time
 from io import BytesIO
+
+import requests
 from PIL import Image
-import matplotlib.pyplot as plot
+from PIL import ImageDraw
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("barkley")
+
+TILE_SIZE = 256
+# Web Mercator stops short of the poles
+MAX_LATITUDE = 85.0511287798
+# Refuse maps that would need more tiles than this
+MAX_TILES = 100
+BLANK_TILE_COLOUR = (224, 224, 224)
+# Tile servers (tile.openstreetmap.org included) ask for an identifying agent
+USER_AGENT = "barkley ADS-B bot (https://github.com/ch166/barkley-public)"
+
+
+def world_pixel(lat, lon, zoom):
+    """(x, y) of lat / lon in pixels across the whole map at zoom"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    scale = TILE_SIZE * (2**zoom)
+    lat_rad = math.radians(lat)
+    x_pos = (lon + 180.0) / 360.0 * scale
+    y_pos = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * scale
+    return x_pos, y_pos
+
+
+def tile_for(lat, lon, zoom):
+    """(x, y) of the tile holding lat / lon at zoom"""
+    x_pos, y_pos = world_pixel(lat, lon, zoom)
+    last_tile = 2**zoom - 1
+    return (
+        max(0, min(last_tile, int(x_pos // TILE_SIZE))),
+        max(0, min(last_tile, int(y_pos // TILE_SIZE))),
+    )
+
+
+def create_http_session(pool_size=4):
+    """requests Session with a keep-alive connection pool for tile fetches"""
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class TileCache:
+    """
+    MBTiles style SQLite tile store
+    - tiles are keyed by zoom_level / tile_column / tile_row, with TMS row
+      numbering as in MBTiles (row 0 at the south edge)
+    - every tile has a last used time, and past max_tiles the least
+      recently used tiles are evicted
+    One cache file holds the tiles of one tile server
+    """
+
+    def __init__(self, db_file, max_tiles=5000, clock=time.time):
+        """Open (or create) the cache database"""
+        self.db_file = db_file
+        self.max_tiles = max_tiles
+        self.clock = clock
+        self.evicted_count = 0
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            " zoom_level INTEGER NOT NULL,"
+            " tile_column INTEGER NOT NULL,"
+            " tile_row INTEGER NOT NULL,"
+            " tile_data BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (zoom_level, tile_column, tile_row))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)"
+        )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')"
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def close(self):
+        """Close the database"""
+        self.conn.close()
+
+    @staticmethod
+    def _tms_row(zoom, y_pos):
+        """MBTiles row number of slippy map tile row y_pos"""
+        return (2**zoom - 1) - y_pos
+
+    def get_many(self, zoom, tiles):
+        """
+        Cached tile images among tiles [(x, y), ...] at zoom
+        Returns a dictionary of (x, y) -> PNG bytes, marking them used
+        """
+        found = {}
+        for x_pos, y_pos in tiles:
+            row = self.conn.execute(
+                "SELECT tile_data FROM tiles"
+                " WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (zoom, x_pos, self._tms_row(zoom, y_pos)),
+            ).fetchone()
+            if row is not None:
+                found[(x_pos, y_pos)] = row[0]
+        if found:
+            now = self.clock()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE tiles SET last_used = ?"
+                    " WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    [
+                        (now, zoom, x_pos, self._tms_row(zoom, y_pos))
+                        for x_pos, y_pos in found
+                    ],
+                )
+        return found
+
+    def put_many(self, zoom, tiles):
+        """Store tiles {(x, y): PNG bytes} at zoom, then evict past max_tiles"""
+        if not tiles:
+            return
+        now = self.clock()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tiles"
+                " (zoom_level, tile_column, tile_row, tile_data, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (zoom, x_pos, self._tms_row(zoom, y_pos), tile_data, now)
+                    for (x_pos, y_pos), tile_data in tiles.items()
+                ],
+            )
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used tiles past max_tiles - returns how many"""
+        excess = len(self) - self.max_tiles
+        if excess <= 0:
+            return 0
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM tiles WHERE rowid IN"
+                " (SELECT rowid FROM tiles ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+        self.evicted_count += excess
+        return excess
 
 
 class GeoMapImage:
@@ -24,13 +190,28 @@ class GeoMapImage:
     geomap = GeoMap(tileserver=" ... ", lat_s, lat_n, lon_e, lon_w, zoom)
     """
 
-    def __init__(self, tileserver, lat_s, lat_n, lon_e, lon_w, zoom):
+    def __init__(
+        self,
+        tileserver,
+        lat_s,
+        lat_n,
+        lon_e,
+        lon_w,
+        zoom,
+        cache=None,
+        session=None,
+        workers=4,
+        timeout=10.0,
+    ):
         """
         Setup a GeoMap base image
         - tileserver = OSM Formatted URL Pattern
         -- tileserver.a.b.c/{z}/{x}/{y}.png
         - lat_s / lat_n = South and North Latitude boundaries
         - lon_e / lon_w = East and West Longitude boundaries
+        - cache = TileCache to keep tiles in, None to always fetch them
+        - session / workers / timeout = HTTP session, concurrent tile
+          fetches and seconds to wait on a tile
         """
 
         self.tileserver = tileserver
@@ -45,12 +226,142 @@ class GeoMapImage:
 
         self.image_png = None
         self.base_image = None
+        # Fraction of the bounding box added around it on every side
         self.margin = 0.1
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.session = session if session is not None else create_http_session(
+            self.workers
+        )
+        # World pixel (at zoom_level) of the top left corner of base_image
+        self.pixel_origin = (0, 0)
+        self.tiles_fetched = 0
+        self.tiles_cached = 0
+        self.tiles_failed = 0
 
     def _create_tile_url(self, x_pos, y_pos, zoom_level):
         """Insert X / Y / Zoom into tileserver string"""
         return self.tileserver.format(z=zoom_level, x=x_pos, y=y_pos)
 
+    def _pixel_bounds(self):
+        """World pixel (left, top, right, bottom) of the bounding box plus margin"""
+        south = min(self.bbox_south, self.bbox_north)
+        north = max(self.bbox_south, self.bbox_north)
+        west = min(self.bbox_east, self.bbox_west)
+        east = max(self.bbox_east, self.bbox_west)
+        lat_pad = (north - south) * self.margin
+        lon_pad = (east - west) * self.margin
+        left, top = world_pixel(north + lat_pad, west - lon_pad, self.zoom_level)
+        right, bottom = world_pixel(south - lat_pad, east + lon_pad, self.zoom_level)
+        return int(left), int(top), int(math.ceil(right)), int(math.ceil(bottom))
+
+    def tiles(self):
+        """(x, y) of every tile covering the bounding box, row by row"""
+        left, top, right, bottom = self._pixel_bounds()
+        last_tile = 2**self.zoom_level - 1
+        first_x = max(0, left // TILE_SIZE)
+        first_y = max(0, top // TILE_SIZE)
+        last_x = min(last_tile, max(left, right - 1) // TILE_SIZE)
+        last_y = min(last_tile, max(top, bottom - 1) // TILE_SIZE)
+        return [
+            (x_pos, y_pos)
+            for y_pos in range(first_y, last_y + 1)
+            for x_pos in range(first_x, last_x + 1)
+        ]
+
+    def _fetch_tile(self, x_pos, y_pos):
+        """PNG bytes of one tile from the tile server, or None"""
+        url = self._create_tile_url(x_pos, y_pos, self.zoom_level)
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as err:
+            logger.warning("Tile %s could not be fetched: %s", url, err)
+            return None
+        if response.status_code != 200:
+            logger.warning("Tile %s - HTTP %d", url, response.status_code)
+            return None
+        return response.content
+
+    def fetch_tiles(self, tiles):
+        """
+        Tile images for tiles [(x, y), ...] - from the cache, the rest
+        fetched concurrently (and cached)
+        Returns a dictionary of (x, y) -> PNG bytes, None for missing tiles
+        """
+        found = {}
+        if self.cache is not None:
+            found = self.cache.get_many(self.zoom_level, tiles)
+        self.tiles_cached += len(found)
+        missing = [tile for tile in tiles if tile not in found]
+        if not missing:
+            return found
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.workers, len(missing))
+        ) as executor:
+            fetched = dict(
+                zip(
+                    missing,
+                    executor.map(lambda tile: self._fetch_tile(*tile), missing),
+                )
+            )
+        downloaded = {tile: data for tile, data in fetched.items() if data is not None}
+        self.tiles_fetched += len(downloaded)
+        self.tiles_failed += len(fetched) - len(downloaded)
+        if self.cache is not None:
+            self.cache.put_many(self.zoom_level, downloaded)
+        found.update(fetched)
+        return found
+
+    def render(self):
+        """
+        Stitch the tiles covering the bounding box and crop to it
+        Missing tiles are left blank
+        Return the base image
+        """
+        left, top, right, bottom = self._pixel_bounds()
+        tiles = self.tiles()
+        if len(tiles) > MAX_TILES:
+            raise ValueError(
+                "Map needs %d tiles (max %d) - lower the zoom" % (len(tiles), MAX_TILES)
+            )
+        first_x = min(x_pos for x_pos, _ in tiles)
+        first_y = min(y_pos for _, y_pos in tiles)
+        columns = max(x_pos for x_pos, _ in tiles) - first_x + 1
+        rows = max(y_pos for _, y_pos in tiles) - first_y + 1
+        mosaic = Image.new(
+            "RGB", (columns * TILE_SIZE, rows * TILE_SIZE), BLANK_TILE_COLOUR
+        )
+        for (x_pos, y_pos), tile_data in self.fetch_tiles(tiles).items():
+            if tile_data is None:
+                continue
+            try:
+                with Image.open(BytesIO(tile_data)) as tile_image:
+                    mosaic.paste(
+                        tile_image.convert("RGB"),
+                        ((x_pos - first_x) * TILE_SIZE, (y_pos - first_y) * TILE_SIZE),
+                    )
+            except OSError as err:
+                logger.warning(
+                    "Tile %d/%d/%d unreadable: %s", self.zoom_level, x_pos, y_pos, err
+                )
+        origin_x = first_x * TILE_SIZE
+        origin_y = first_y * TILE_SIZE
+        self.base_image = mosaic.crop(
+            (left - origin_x, top - origin_y, right - origin_x, bottom - origin_y)
+        )
+        self.pixel_origin = (left, top)
+        self.image_png = None
+        return self.base_image
+
+    def to_pixel(self, lat, lon):
+        """(x, y) on the base image of lat / lon"""
+        x_pos, y_pos = world_pixel(lat, lon, self.zoom_level)
+        return (
+            int(round(x_pos - self.pixel_origin[0])),
+            int(round(y_pos - self.pixel_origin[1])),
+        )
+
     def _image_to_png(self):
         """Use Bytes IO As target to write image to"""
         file = BytesIO()
@@ -64,27 +375,38 @@ class GeoMapImage:
 
     def get_png(self):
         """Convert the base image to a .png image"""
-        result = None
-        if not self.image_png is None:
-            if not self.base_image is None:
-                self.image_png = self._image_to_png()
-                result = self.image_png
-        else:
-            result = self.image_png
-        return result
+        if self.base_image is None:
+            self.render()
+        if self.image_png is None:
+            self._image_to_png()
+        return self.image_png
+
+    def _draw(self):
+        """ImageDraw for the base image, rendering it first if needed"""
+        if self.base_image is None:
+            self.render()
+        # Drawing changes the image, the png is made again when asked for
+        self.image_png = None
+        return ImageDraw.Draw(self.base_image)
 
-    def draw_box(self, x1, y1, x2, y2):
+    def draw_box(self, x1, y1, x2, y2, colour=(255, 0, 0), width=3):
         """
-        Draw a box on the base image
+        Draw a box on the base image (pixel corners, see to_pixel)
         Return the updated image
         """
-        result = True
-        if x1 + x2 > y1 + y2:
-            result = False
-        return result
+        self._draw().rectangle(
+            (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)),
+            outline=colour,
+            width=width,
+        )
+        return self.base_image
 
-    def draw_spot(self, x1, y1):
+    def draw_spot(self, x1, y1, radius=6, colour=(255, 0, 0)):
         """
-        Draw a circle on the base image
+        Draw a circle on the base image (pixel centre, see to_pixel)
         Return the updated image
         """
+        self._draw().ellipse(
+            (x1 - radius, y1 - radius, x1 + radius, y1 + radius), fill=colour
+        )
+        return self.base_image
@@ -2,8 +2,25 @@
 """ Get data from the Global Aircraft DB """
 
 import sqlite3
+import threading
+from collections import OrderedDict
 from sqlite3 import Error
 
+import aircraft_table
+
+# Only the columns Barkley uses - the order keeps the historic row layout
+# row[3] = manufacturer name, row[4] = model, row[5] = typecode
+LOOKUP_COLUMNS = "icao24, registration, manufacturericao, manufacturername, model, typecode"
+
+# The compact table built by global_db_builder.py stores icao24 as an integer
+COMPACT_LOOKUP_COLUMNS = (
+    "printf('%06x', icao24), registration, manufacturericao, manufacturername,"
+    " model, typecode"
+)
+
+# SQLite limits the number of bound parameters in one statement
+QUERY_BATCH_SIZE = 500
+
 
 def create_connection(db_file):
     """
@@ -21,20 +38,114 @@ def create_connection(db_file):
     return None
 
 
-def find_aircraft_entry(conn, icao_str):
+def open_readonly(db_file, mmap_size=268435456, check_same_thread=True):
     """
-    Query all rows in the tasks table
+    Open the database read-only, with the file memory mapped
+    A compiled aircraft_table file is opened as an AircraftTable,
+    which the lookup functions below accept in place of a connection
+    :param db_file: database file
+    :param mmap_size: bytes of the file to memory map
+    :param check_same_thread: False lets a worker thread use the connection
+    :return: Connection object, AircraftTable or None
+    """
+    if aircraft_table.is_table_file(db_file):
+        return aircraft_table.AircraftTable(db_file)
+    try:
+        conn = sqlite3.connect(
+            "file:" + db_file + "?mode=ro",
+            uri=True,
+            check_same_thread=check_same_thread,
+        )
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA mmap_size = " + str(int(mmap_size)))
+        return conn
+    except Error as err:
+        print(err)
+
+    return None
+
+
+def is_compact(conn):
+    """
+    True if the database holds the compact 'aircraft' table
+    built by global_db_builder.py, rather than the raw CSV import
+    """
+    if isinstance(conn, aircraft_table.AircraftTable):
+        return True
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'aircraft'"
+    )
+    return cur.fetchone() is not None
+
+
+def _icao_int(icao_str):
+    """Convert a hexcode to the compact table key - None if not a hexcode"""
+    try:
+        return int(icao_str, 16)
+    except ValueError:
+        return None
+
+
+def find_aircraft_entry(conn, icao_str, compact=None):
+    """
+    Find the Global DB row for a single icao24 hexcode
     :param conn: the Connection object
-    :return:
+    :param compact: table layout, detected if not given
+    :return: row tuple, or None if the aircraft is unknown
+    """
+    rows = find_aircraft_entries(conn, [icao_str], compact)
+    return rows.get(icao_str.lower())
+
+
+def find_aircraft_entries(conn, icao_list, compact=None):
+    """
+    Find the Global DB rows for a batch of icao24 hexcodes
+    :param conn: the Connection object
+    :param compact: table layout, detected if not given
+    :return: dictionary of icao24 -> row for the hexcodes that were found
     """
+    if isinstance(conn, aircraft_table.AircraftTable):
+        return conn.find_many(icao_list)
+    result = {}
+    if compact is None:
+        compact = is_compact(conn)
+    if compact:
+        select_sql = "SELECT " + COMPACT_LOOKUP_COLUMNS + " FROM aircraft"
+        icao_list = [_icao_int(icao_str) for icao_str in icao_list]
+        icao_list = [icao for icao in icao_list if icao is not None]
+    else:
+        select_sql = "SELECT " + LOOKUP_COLUMNS + " FROM aircraftDatabase"
+        icao_list = [icao_str.lower() for icao_str in icao_list]
     cur = conn.cursor()
-    cur.execute("SELECT * FROM aircraftDatabase WHERE icao24 = ? ", (icao_str,))
+    for start in range(0, len(icao_list), QUERY_BATCH_SIZE):
+        batch = icao_list[start : start + QUERY_BATCH_SIZE]
+        cur.execute(
+            select_sql + " WHERE icao24 IN (" + ",".join("?" * len(batch)) + ")",
+            batch,
+        )
+        for row in cur.fetchall():
+            # Duplicate icao24 rows exist in the OpenSky data - first one wins
+            result.setdefault(row[0], row)
+    return result
 
-    rows = cur.fetchall()
-    if len(rows) > 1:
-        return rows[0]
-        # print("Global DB - Multiple Rows for " + icao_str)
-    return None
+
+def iter_all_entries(conn):
+    """
+    Every row in the database as
+    (icao24 int, registration, manufacturericao, manufacturername, model, typecode)
+    :param conn: the Connection object
+    """
+    cur = conn.cursor()
+    if is_compact(conn):
+        cur.execute("SELECT " + LOOKUP_COLUMNS + " FROM aircraft ORDER BY icao24")
+        yield from cur
+        return
+    cur.execute("SELECT " + LOOKUP_COLUMNS + " FROM aircraftDatabase")
+    for row in cur:
+        icao = _icao_int(row[0] or "")
+        if (icao is not None) and (0 <= icao <= 0xFFFFFF):
+            yield (icao,) + tuple(row[1:])
 
 
 def find_aircraft_icao(conn, icao_str):
@@ -51,3 +162,89 @@ def find_aircraft_icao(conn, icao_str):
         print("Global DB - Duplicate" + icao_str)
     for row in rows:
         print("GlobalDB: " + row[3] + " " + row[4])
+
+
+class AircraftDbCache:
+    """
+    Bounded LRU cache in front of the Global DB
+    Unknown hexcodes are cached too (negative caching), so an aircraft
+    missing from the DB costs one query rather than one per appearance
+    Lookups are serialized by a lock, so the cache can be warmed from a
+    worker thread while the main loop reads it
+    """
+
+    NOT_FOUND = None
+
+    def __init__(self, conn, max_entries=20000):
+        """Init object and set initial values for internals"""
+        self.conn = conn
+        self.compact = None
+        if conn is not None:
+            self.compact = is_compact(conn)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.query_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _store(self, hexcode, row):
+        """Add an entry and evict the least recently used if full"""
+        self.entries[hexcode] = row
+        self.entries.move_to_end(hexcode)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup_many(self, hexcodes):
+        """
+        Look up a batch of hexcodes - one DB query for every cache miss
+        :return: dictionary of hexcode -> row (None for unknown aircraft)
+        """
+        with self.lock:
+            return self._lookup_many(hexcodes)
+
+    def _lookup_many(self, hexcodes):
+        """lookup_many with the lock held"""
+        result = {}
+        missing = []
+        for hexcode in hexcodes:
+            if hexcode in self.entries:
+                self.entries.move_to_end(hexcode)
+                result[hexcode] = self.entries[hexcode]
+                self.hit_count += 1
+            elif hexcode not in result:
+                result[hexcode] = self.NOT_FOUND
+                missing.append(hexcode)
+        if not missing:
+            return result
+        self.miss_count += len(missing)
+        # Non-ICAO addresses (TIS-B etc. are prefixed '~') can never match
+        query_list = [hexcode.lower() for hexcode in missing if hexcode[:1] != "~"]
+        rows = {}
+        if query_list and (self.conn is not None):
+            self.query_count += 1
+            rows = find_aircraft_entries(self.conn, query_list, self.compact)
+        for hexcode in missing:
+            row = rows.get(hexcode.lower(), self.NOT_FOUND)
+            result[hexcode] = row
+            self._store(hexcode, row)
+        return result
+
+    def lookup(self, hexcode):
+        """Look up a single hexcode - row or None"""
+        return self.lookup_many([hexcode])[hexcode]
+
+    def hits(self):
+        """Lookups answered from the cache (including negative entries)"""
+        return self.hit_count
+
+    def misses(self):
+        """Lookups that had to go to the DB"""
+        return self.miss_count
+
+    def queries(self):
+        """Number of DB queries issued"""
+        return self.query_count
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build the compact Global Aircraft DB from the OpenSky aircraft CSV.
+
+    python3 global_db_builder.py aircraftDatabase.csv global_db.sqlite3
+
+Optionally also compile the memory mapped lookup table (see aircraft_table.py)
+
+    python3 global_db_builder.py aircraftDatabase.csv global_db.sqlite3 --table global_db.bin
+
+The CSV is streamed from a local file straight into SQLite, keeping only
+the columns Barkley uses. icao24 is stored as an INTEGER PRIMARY KEY (the
+table rowid), so the table is its own index.
+
+The OpenSky data contains duplicate icao24 rows. The deterministic rule is
+    - keep the row with the most populated kept columns
+    - on a tie, keep the row that appears first in the file
+
+The database is built in a temporary file and renamed into place, so a
+failed build never replaces a working database.
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import time
+
+import aircraft_table
+import global_aircraft_db
+
+KEPT_COLUMNS = ("registration", "manufacturericao", "manufacturername", "model", "typecode")
+
+INSERT_BATCH_SIZE = 10000
+
+
+def _populated_sql(table):
+    """SQL expression counting the non-NULL kept columns of a row"""
+    return " + ".join(
+        "(" + table + "." + column + " IS NOT NULL)" for column in KEPT_COLUMNS
+    )
+
+
+CREATE_SQL = (
+    "CREATE TABLE aircraft (icao24 INTEGER PRIMARY KEY, "
+    + ", ".join(column + " TEXT" for column in KEPT_COLUMNS)
+    + ")"
+)
+
+UPSERT_SQL = (
+    "INSERT INTO aircraft (icao24, "
+    + ", ".join(KEPT_COLUMNS)
+    + ") VALUES (?"
+    + ", ?" * len(KEPT_COLUMNS)
+    + ") ON CONFLICT(icao24) DO UPDATE SET "
+    + ", ".join(column + " = excluded." + column for column in KEPT_COLUMNS)
+    + " WHERE "
+    + _populated_sql("excluded")
+    + " > "
+    + _populated_sql("aircraft")
+)
+
+
+def _open_csv(csv_file):
+    """
+    Open the CSV - older OpenSky dumps quote with ", newer ones with '
+    Returns (file object, csv.DictReader)
+    """
+    csv_handle = open(csv_file, newline="", encoding="utf-8", errors="replace")
+    first_char = csv_handle.read(1)
+    csv_handle.seek(0)
+    quotechar = "'" if first_char == "'" else '"'
+    return csv_handle, csv.DictReader(csv_handle, quotechar=quotechar)
+
+
+def _parse_row(row):
+    """Convert a CSV row to a table row - None if the icao24 is unusable"""
+    try:
+        icao24 = int((row.get("icao24") or "").strip(), 16)
+    except ValueError:
+        return None
+    if not 0 <= icao24 <= 0xFFFFFF:
+        return None
+    values = [icao24]
+    for column in KEPT_COLUMNS:
+        value = (row.get(column) or "").strip()
+        values.append(value if value else None)
+    return values
+
+
+def build_database(csv_file, db_file):
+    """
+    Stream csv_file into a new compact database at db_file
+    Returns a dictionary of build statistics
+    """
+    start_time = time.perf_counter()
+    temp_file = db_file + ".tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    conn = sqlite3.connect(temp_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(CREATE_SQL)
+
+    rows_read = 0
+    rows_rejected = 0
+    batch = []
+    csv_handle, reader = _open_csv(csv_file)
+    with csv_handle:
+        for row in reader:
+            rows_read += 1
+            values = _parse_row(row)
+            if values is None:
+                rows_rejected += 1
+                continue
+            batch.append(values)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                conn.executemany(UPSERT_SQL, batch)
+                batch = []
+    if batch:
+        conn.executemany(UPSERT_SQL, batch)
+    conn.commit()
+    rows_kept = conn.execute("SELECT COUNT(*) FROM aircraft").fetchone()[0]
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(temp_file, db_file)
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "rows_read": rows_read,
+        "rows_rejected": rows_rejected,
+        "rows_kept": rows_kept,
+        "duplicates_merged": rows_read - rows_rejected - rows_kept,
+        "seconds": elapsed,
+        "rows_per_second": rows_read / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def build_table(db_file, table_file):
+    """
+    Compile a built database into an aircraft_table file
+    Returns (records written, seconds)
+    """
+    start_time = time.perf_counter()
+    conn = sqlite3.connect(db_file)
+    try:
+        records = aircraft_table.compile_table(
+            global_aircraft_db.iter_all_entries(conn), table_file
+        )
+    finally:
+        conn.close()
+    return records, time.perf_counter() - start_time
+
+
+def main():
+    """Command line entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("csv_file", help="OpenSky aircraftDatabase.csv")
+    parser.add_argument("db_file", help="SQLite database to create")
+    parser.add_argument(
+        "--table", help="also compile a memory mapped lookup table to this file"
+    )
+    args = parser.parse_args()
+
+    stats = build_database(args.csv_file, args.db_file)
+    print(
+        "Built %s : %d rows read, %d kept, %d duplicates merged, %d rejected"
+        % (
+            args.db_file,
+            stats["rows_read"],
+            stats["rows_kept"],
+            stats["duplicates_merged"],
+            stats["rows_rejected"],
+        )
+    )
+    print(
+        "Build time %.2fs (%.0f rows/sec)" % (stats["seconds"], stats["rows_per_second"])
+    )
+    if args.table:
+        records, seconds = build_table(args.db_file, args.table)
+        print("Compiled %s : %d records in %.2fs" % (args.table, records, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ingest - Read dump1090 aircraft.json snapshots, skipping duplicates.
+
+dump1090 rewrites aircraft.json in place (or atomically replaces it) about
+once a second. Re-parsing an unchanged file is wasted work, so a snapshot is
+only handed to the pipeline when
+
+    - the file identity (inode, mtime, size) has changed, and
+    - the embedded 'now' timestamp is newer than the last processed one
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger("barkley")
+
+
+class SnapshotReader:
+    """Change-detecting reader for a dump1090 aircraft.json file"""
+
+    def __init__(self, filename):
+        """Init object and set initial values for internals"""
+        self.filename = filename
+        self.signature = None
+        self.last_now = None
+        self.processed_count = 0
+        self.skipped_count = 0
+
+    @staticmethod
+    def _signature(stat_result):
+        """File identity used to detect a rewritten file"""
+        return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    def changed(self):
+        """True if the file on disk looks different to the last one read"""
+        try:
+            return self._signature(os.stat(self.filename)) != self.signature
+        except FileNotFoundError:
+            return False
+
+    def read(self):
+        """
+        Return the parsed snapshot dict,
+        or None if the snapshot is unchanged (or not available yet)
+        """
+        if not self.changed():
+            self.skipped_count += 1
+            return None
+        try:
+            with open(self.filename, encoding="utf-8") as aircraft_file:
+                # Take the signature from the open file, in case the path
+                # was replaced between the stat() and the open()
+                signature = self._signature(os.fstat(aircraft_file.fileno()))
+                adsb_data = json.load(aircraft_file)
+        except FileNotFoundError:
+            # Replaced between the stat() and the open() - retried next tick
+            self.skipped_count += 1
+            return None
+        except ValueError as err:
+            # Caught part way through a rewrite - the signature is left
+            # alone, so the next tick reads the file again
+            logger.warning("Unreadable snapshot %s: %s", self.filename, err)
+            self.skipped_count += 1
+            return None
+        self.signature = signature
+        snapshot_time = adsb_data.get("now")
+        if (
+            (snapshot_time is not None)
+            and (self.last_now is not None)
+            and (snapshot_time <= self.last_now)
+        ):
+            # File was touched, but dump1090 has no newer data in it
+            self.skipped_count += 1
+            return None
+        self.last_now = snapshot_time
+        self.processed_count += 1
+        return adsb_data
+
+    def processed(self):
+        """Number of snapshots handed to the pipeline"""
+        return self.processed_count
+
+    def skipped(self):
+        """Number of reads skipped because the snapshot was unchanged"""
+        return self.skipped_count
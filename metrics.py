@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics - Counters, gauges and latency histograms for the main loop.
+
+Metrics are exported in the Prometheus text format
+
+    - served on http://<listen_address>:<port>/metrics
+    - written to a file every few seconds (e.g. for the node_exporter
+      textfile collector, or just to look at)
+
+Updating a metric on the hot path is a couple of attribute updates -
+histograms find their bucket with bisect. Numbers that another object
+already keeps (Global DB cache hits, publisher counters, dictionary sizes)
+are not copied every tick, they are read by a callback when exported.
+
+Each metric is only updated from one thread (the main loop, or the
+publisher thread). Exports read the values without locking, so they may
+be a tick behind, but never block the main loop.
+"""
+
+import bisect
+import http.server
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger("barkley")
+
+# Seconds - from a fast dictionary pass up to a slow Bluesky post
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    """Sample value in the text format"""
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value):
+    """Label value escaped for the text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values):
+    """{name="value",...} or an empty string"""
+    if not labelnames:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '%s="%s"' % (name, _escape(value)) for name, value in zip(labelnames, values)
+        )
+        + "}"
+    )
+
+
+class Metric:
+    """
+    Common parts of a metric family - name, help text and labelled children
+    A metric without labels records its values on itself
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Init object and set initial values for internals"""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self._reset()
+
+    def _reset(self):
+        """Set the recorded values to their starting point"""
+
+    def _new_child(self):
+        """Unlabelled metric of the same kind"""
+        return type(self)(self.name, self.documentation)
+
+    def labels(self, *values):
+        """The child metric recording values for these label values"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    "%s takes labels %s" % (self.name, ", ".join(self.labelnames))
+                )
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _child_samples(self):
+        """(label values, child) of everything to export"""
+        if self.labelnames:
+            return list(self.children.items())
+        return [((), self)]
+
+    def samples(self):
+        """(name suffix, label names, label values, value) tuples"""
+        for values, child in self._child_samples():
+            yield "", self.labelnames, values, child.value
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    kind = "counter"
+
+    def _reset(self):
+        """Set the recorded values to their starting point"""
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Add amount"""
+        self.value += amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+
+    kind = "gauge"
+
+    def _reset(self):
+        """Set the recorded values to their starting point"""
+        self.value = 0
+
+    def set(self, value):
+        """Set to value"""
+        self.value = value
+
+    def inc(self, amount=1):
+        """Add amount"""
+        self.value += amount
+
+    def dec(self, amount=1):
+        """Subtract amount"""
+        self.value -= amount
+
+
+class Timer:
+    """Context manager observing the time spent inside it into a histogram"""
+
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        """Init object and set initial values for internals"""
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Histogram(Metric):
+    """Distribution of observed values - Prometheus cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Init object and set initial values for internals
+        - buckets = increasing upper bounds, +Inf is always added
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _reset(self):
+        """Set the recorded values to their starting point"""
+        # Per bucket counts, not cumulative - the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        """Unlabelled histogram with the same buckets"""
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        """Record one value"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def time(self):
+        """with histogram.time(): ... - observes the seconds spent inside"""
+        return Timer(self)
+
+    def samples(self):
+        """(name suffix, label names, label values, value) tuples"""
+        bucket_labels = self.labelnames + ("le",)
+        for values, child in self._child_samples():
+            cumulative = 0
+            # Copied first, so the buckets add up to the count
+            counts = list(child.counts)
+            for bound, bucket_count in zip(child.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", bucket_labels, values + (
+                    _format_value(bound),
+                ), cumulative
+            yield "_sum", self.labelnames, values, child.total
+            yield "_count", self.labelnames, values, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    Counter or gauge read from a callback when exported
+    - func() returns a number, or with a label name a dictionary of
+      label value -> number
+    """
+
+    def __init__(self, name, documentation, kind, func, labelname=None):
+        """Init object and set initial values for internals"""
+        super().__init__(name, documentation, (labelname,) if labelname else ())
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        """(name suffix, label names, label values, value) tuples"""
+        value = self.func()
+        if not self.labelnames:
+            yield "", (), (), value
+            return
+        for label_value, sample in sorted(value.items()):
+            yield "", self.labelnames, (label_value,), sample
+
+
+class Registry:
+    """Every metric to export, by name"""
+
+    def __init__(self):
+        """Init object and set initial values for internals"""
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, replacing one of the same name - returns it"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """New registered counter"""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        """New registered gauge"""
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """New registered histogram"""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, kind, func, labelname=None):
+        """New registered counter / gauge read from func() when exported"""
+        return self.register(
+            CallbackMetric(name, documentation, kind, func, labelname)
+        )
+
+    def exposition(self):
+        """Every metric in the Prometheus text format"""
+        with self.lock:
+            metric_list = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metric_list:
+            try:
+                samples = list(metric.samples())
+            except Exception as err:
+                # One broken callback should not hide every other metric
+                logger.error("Metrics - unable to read %s: %s", metric.name, err)
+                continue
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for suffix, labelnames, values, value in samples:
+                lines.append(
+                    "%s%s%s %s"
+                    % (
+                        metric.name,
+                        suffix,
+                        _format_labels(labelnames, values),
+                        _format_value(value),
+                    )
+                )
+        lines.append("")
+        return "\n".join(lines)
+
+    def write_textfile(self, filename):
+        """Write the exposition to filename, replacing it in one step"""
+        temp_file = filename + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as metrics_out:
+            metrics_out.write(self.exposition())
+        os.replace(temp_file, filename)
+
+
+# Metrics of the running process
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """HTTP endpoint serving the registry on /metrics, from a daemon thread"""
+
+    def __init__(self, registry, address="127.0.0.1", port=9108):
+        """Init object and bind the listening socket"""
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """GET /metrics"""
+
+            def do_GET(handler):
+                if handler.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    handler.send_error(404)
+                    return
+                body = registry.exposition().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", CONTENT_TYPE)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, message_format, *args):
+                # Scrapes every few seconds would flood the log
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="barkley-metrics", daemon=True
+        )
+
+    def address(self):
+        """(host, port) actually listened on"""
+        return self.server.server_address[:2]
+
+    def start(self):
+        """Start serving - returns self"""
+        self.thread.start()
+        return self
+
+    def close(self):
+        """Stop serving and release the socket"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TextfileWriter:
+    """Write the registry to a file every interval seconds, from a daemon thread"""
+
+    def __init__(self, registry, filename, interval=60.0):
+        """Init object and set initial values for internals"""
+        self.registry = registry
+        self.filename = filename
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="barkley-metrics-file", daemon=True
+        )
+
+    def start(self):
+        """Start writing - returns self"""
+        self.thread.start()
+        return self
+
+    def write(self):
+        """Write the file now"""
+        try:
+            self.registry.write_textfile(self.filename)
+        except OSError as err:
+            logger.error("Metrics - unable to write %s: %s", self.filename, err)
+
+    def _run(self):
+        """Thread loop"""
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def close(self):
+        """Stop writing, after a last write"""
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.write()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipeline - asyncio runtime for the Barkley main loop.
+
+The loop is split into independent stages connected by bounded queues
+
+    ingest  -> [ingest queue] -> enrich -> [geo queue] -> geo
+
+    ingest  - wait for dump1090 to rewrite aircraft.json and parse it
+    enrich  - resolve never-seen hexcodes in the Global DB
+    geo     - apply the snapshot, distances / airspaces, pick posts,
+              save state and age out old aircraft
+
+Posts are handed to the publisher (publisher.py), which queues, rate
+limits and sends them on its own thread - so there is no publish stage here.
+
+Anything that blocks (file waits, sqlite, HTTP) runs in a worker thread, so
+a slow Global DB lookup never stalls ingestion. Each stage waits on a full
+downstream queue (back-pressure) rather than growing memory.
+
+Only the geo stage changes the tracked aircraft. It also saves state
+(sqlite) and looks up the Global DB, so it runs in its own single worker
+thread - one snapshot at a time, never two applied at once. Stages only
+hand each other parsed snapshots, which nothing modifies.
+
+The stages themselves are plain callables handed in by barkley.py
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger("barkley")
+
+QUEUE_NAMES = ("ingest", "geo")
+
+
+class StageStats:
+    """Counters for one pipeline stage"""
+
+    def __init__(self, name):
+        """Init object and set initial values for internals"""
+        self.name = name
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+    def record(self, started, finished):
+        """Record one item processed between started and finished"""
+        self.processed += 1
+        self.busy_seconds += finished - started
+
+
+class Pipeline:
+    """
+    Stage callables
+    - ingest() -> snapshot or None       blocking, worker thread
+    - enrich(snapshot)                   blocking, Global DB thread
+    - evaluate(snapshot)                 blocking, geo thread
+    """
+
+    def __init__(
+        self,
+        ingest,
+        enrich,
+        evaluate,
+        ingest_queue_size=2,
+        geo_queue_size=2,
+        stats_interval=60,
+    ):
+        """Init object and set initial values for internals"""
+        self.ingest = ingest
+        self.enrich = enrich
+        self.evaluate = evaluate
+        self.queue_sizes = {
+            "ingest": ingest_queue_size,
+            "geo": geo_queue_size,
+        }
+        self.stats_interval = stats_interval
+        self.queues = {}
+        self.max_depths = {name: 0 for name in QUEUE_NAMES}
+        self.stats = {name: StageStats(name) for name in ("ingest", "enrich", "geo")}
+        self.ingest_executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="barkley-ingest"
+        )
+        self.db_executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="barkley-db"
+        )
+        self.geo_executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="barkley-geo"
+        )
+
+    def queue_depths(self):
+        """Current number of items waiting in each queue"""
+        return {name: queue.qsize() for name, queue in self.queues.items()}
+
+    def queue_max_depths(self):
+        """Most items seen waiting in each queue"""
+        return dict(self.max_depths)
+
+    async def _put(self, queue_name, stage_name, item):
+        """Put on a downstream queue, recording time spent blocked on it"""
+        queue = self.queues[queue_name]
+        started = time.perf_counter()
+        await queue.put(item)
+        self.stats[stage_name].blocked_seconds += time.perf_counter() - started
+        self.max_depths[queue_name] = max(self.max_depths[queue_name], queue.qsize())
+
+    async def _ingest_stage(self):
+        """Wait for and read new snapshots"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = time.perf_counter()
+            snapshot = await loop.run_in_executor(self.ingest_executor, self.ingest)
+            if snapshot is None:
+                continue
+            self.stats["ingest"].record(started, time.perf_counter())
+            await self._put("ingest", "ingest", snapshot)
+
+    async def _enrich_stage(self):
+        """Warm the Global DB cache for new aircraft off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            snapshot = await self.queues["ingest"].get()
+            started = time.perf_counter()
+            await loop.run_in_executor(self.db_executor, self.enrich, snapshot)
+            self.stats["enrich"].record(started, time.perf_counter())
+            await self._put("geo", "enrich", snapshot)
+
+    async def _geo_stage(self):
+        """Apply snapshots, off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            snapshot = await self.queues["geo"].get()
+            started = time.perf_counter()
+            await loop.run_in_executor(self.geo_executor, self.evaluate, snapshot)
+            self.stats["geo"].record(started, time.perf_counter())
+
+    async def _stats_stage(self):
+        """Periodically log queue depths and stage timings"""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.log_stats()
+
+    def log_stats(self):
+        """Log queue depths and stage timings"""
+        for name, stats in self.stats.items():
+            logger.info(
+                "Pipeline stage %s: processed %d busy %.3fs blocked %.3fs",
+                name,
+                stats.processed,
+                stats.busy_seconds,
+                stats.blocked_seconds,
+            )
+        depths = self.queue_depths()
+        for name in QUEUE_NAMES:
+            logger.info(
+                "Pipeline queue %s: depth %d (max %d)",
+                name,
+                depths.get(name, 0),
+                self.max_depths[name],
+            )
+
+    async def run(self):
+        """Run every stage until one of them fails"""
+        self.queues = {
+            name: asyncio.Queue(maxsize=size) for name, size in self.queue_sizes.items()
+        }
+        stages = [
+            asyncio.ensure_future(self._ingest_stage()),
+            asyncio.ensure_future(self._enrich_stage()),
+            asyncio.ensure_future(self._geo_stage()),
+            asyncio.ensure_future(self._stats_stage()),
+        ]
+        try:
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for stage in done:
+                stage.result()
+        finally:
+            for stage in stages:
+                stage.cancel()
+            self.ingest_executor.shutdown(wait=False)
+            self.db_executor.shutdown(wait=False)
+            self.geo_executor.shutdown(wait=False)
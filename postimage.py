@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Post Image - Render the image attached to a post, in memory.
+
+The base image and fonts are decoded once per process and kept ; every
+render draws on a copy of the base image and returns PNG bytes, so no
+temporary files are written.
+
+Rendering can be handed to a pool of worker processes, so drawing and PNG
+encoding several images never holds up the main loop. Each worker loads
+the base image and fonts once, when it starts.
+"""
+
+import concurrent.futures
+import functools
+import io
+import logging
+import multiprocessing
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+logger = logging.getLogger("barkley")
+
+TEXT_COLOUR = (0, 0, 0)
+TEXT_ORIGIN = (50, 50)
+
+
+@functools.lru_cache(maxsize=8)
+def load_base_image(filename):
+    """Decoded base image, cached per process - draw on a copy of it"""
+    with Image.open(filename) as image:
+        return image.convert("RGB")
+
+
+@functools.lru_cache(maxsize=16)
+def load_font(filename, size):
+    """TrueType font at size, cached per process"""
+    try:
+        return ImageFont.truetype(filename, size)
+    except OSError:
+        logger.warning("Font %s not found - using the default font", filename)
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow before 10.1 has a single fixed size default font
+        return ImageFont.load_default()
+
+
+def render_post_image(
+    base_image, font_file, hexcode, lines=(), font_size=48, compress_level=6
+):
+    """
+    PNG bytes of hexcode, with lines of smaller text under it,
+    drawn on top of the base image
+    """
+    image = load_base_image(base_image).copy()
+    draw = ImageDraw.Draw(image)
+    x_pos, y_pos = TEXT_ORIGIN
+    draw.text((x_pos, y_pos), hexcode, TEXT_COLOUR, font=load_font(font_file, font_size))
+    line_size = max(1, font_size // 2)
+    line_font = load_font(font_file, line_size)
+    y_pos += font_size + line_size // 2
+    for line in lines:
+        draw.text((x_pos, y_pos), line, TEXT_COLOUR, font=line_font)
+        y_pos += line_size + line_size // 4
+    image_file = io.BytesIO()
+    image.save(image_file, "png", compress_level=compress_level)
+    return image_file.getvalue()
+
+
+def _warm_cache(base_image, font_file, font_size):
+    """Worker process initializer - load the base image and fonts up front"""
+    load_base_image(base_image)
+    load_font(font_file, font_size)
+    load_font(font_file, max(1, font_size // 2))
+
+
+class PostImageRenderer:
+    """
+    - base_image / font_file / font_size = what every image is drawn with
+    - workers = worker processes, 0 renders in the calling thread
+    - compress_level = PNG compression, 1 (fastest) to 9 (smallest)
+    """
+
+    def __init__(
+        self, base_image, font_file, font_size=48, workers=0, compress_level=6
+    ):
+        """Init object and start the worker processes"""
+        self.base_image = base_image
+        self.font_file = font_file
+        self.font_size = font_size
+        self.compress_level = compress_level
+        self.rendered = 0
+        self.executor = None
+        if workers > 0:
+            # Barkley runs other threads by now, which makes fork() unsafe
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_cache,
+                initargs=(base_image, font_file, font_size),
+            )
+
+    def render(self, hexcode, lines=()):
+        """PNG bytes of the image for hexcode, rendered in this process"""
+        self.rendered += 1
+        return render_post_image(
+            self.base_image,
+            self.font_file,
+            hexcode,
+            tuple(lines),
+            self.font_size,
+            self.compress_level,
+        )
+
+    def submit(self, hexcode, lines=()):
+        """
+        Start rendering the image for hexcode
+        Returns a future of the PNG bytes - already done with no workers
+        """
+        if self.executor is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(self.render(hexcode, lines))
+            except Exception as err:
+                future.set_exception(err)
+            return future
+        self.rendered += 1
+        return self.executor.submit(
+            render_post_image,
+            self.base_image,
+            self.font_file,
+            hexcode,
+            tuple(lines),
+            self.font_size,
+            self.compress_level,
+        )
+
+    def close(self):
+        """Stop the worker processes, after the images in progress"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+"""
+Publisher - Rate limited, retrying post queue in front of Bluesky.
+
+Posts are handed to a Publisher and sent from its own thread, so the main
+loop never waits on Bluesky:
+
+    - a token bucket limits the posting rate (with a small burst allowance)
+    - a bounded priority queue sends emergencies first
+    - a post for an aircraft that is already queued replaces the queued
+      text rather than queueing twice (merge by hexcode)
+    - when the queue is full the lowest priority post is dropped - the
+      newest one queued, or the new one, depending on the overflow policy.
+      The oldest post is never dropped, as it is the next one to be sent
+    - a failed post is queued again and sending backs off exponentially
+      (with jitter) until it succeeds or runs out of attempts, after which
+      its key is refused for a cooldown rather than retried from scratch
+
+The result of each post is reported through the on_result(key, success)
+callback, which runs on the publisher thread.
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("barkley")
+
+PRIORITY_EMERGENCY = 0
+PRIORITY_NORMAL = 1
+
+OVERFLOW_DROP_QUEUED = "drop_queued"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+
+class TokenBucket:
+    """Allows rate events per second on average, and up to burst at once"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        """Init object and set initial values for internals"""
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        """Add the tokens earned since the last refill"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Take a token if one is available - returns True on success"""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class QueuedPost:
+    """One post waiting to be sent"""
+
+    __slots__ = ("key", "text", "priority", "sequence", "attempts")
+
+    def __init__(self, key, text, priority, sequence):
+        """Init object and set initial values for internals"""
+        self.key = key
+        self.text = text
+        self.priority = priority
+        self.sequence = sequence
+        self.attempts = 0
+
+
+class Publisher:
+    """
+    - send(text) posts one message, returning True or raising on failure
+    - on_result(key, success) is told how each post ended
+    - rate / burst = posts per second and how many may go back to back
+    - max_queue = posts waiting before the overflow policy drops one
+    - max_attempts = tries per post before it is given up on
+    - backoff_base / backoff_max = seconds to back off after a failure,
+      doubling per consecutive failure up to the max
+    - dedupe_seconds = a key that was posted is refused for this long
+    - give_up_seconds = a key that ran out of attempts is refused for this long
+    """
+
+    def __init__(
+        self,
+        send,
+        on_result=None,
+        rate=0.125,
+        burst=2,
+        max_queue=20,
+        overflow=OVERFLOW_DROP_QUEUED,
+        max_attempts=4,
+        backoff_base=5.0,
+        backoff_max=300.0,
+        dedupe_seconds=600.0,
+        give_up_seconds=600.0,
+        clock=time.monotonic,
+    ):
+        """Init object and set initial values for internals"""
+        self.send = send
+        self.on_result = on_result
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dedupe_seconds = dedupe_seconds
+        self.give_up_seconds = give_up_seconds
+        self.clock = clock
+        self.heap = []
+        self.queued = {}
+        self.in_flight = None
+        self.recently_sent = {}
+        self.gave_up = {}
+        self.sequence = 0
+        self.failures = 0
+        self.resume_at = 0.0
+        self.counters = {
+            "submitted": 0,
+            "merged": 0,
+            "dropped": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "suppressed": 0,
+        }
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="barkley-publisher", daemon=True
+        )
+
+    def start(self):
+        """Start the publisher thread"""
+        self.thread.start()
+        return self
+
+    def close(self, timeout=None):
+        """Stop the publisher thread - posts still queued are not sent"""
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def __len__(self):
+        return len(self.queued)
+
+    def stats(self):
+        """Copy of the publisher counters, plus the current queue depth"""
+        with self.condition:
+            result = dict(self.counters)
+            result["queued"] = len(self.queued)
+        return result
+
+    def pending(self, key):
+        """True if a post for key is queued or being sent"""
+        with self.condition:
+            return (key in self.queued) or (key == self.in_flight)
+
+    def _push(self, post):
+        """Put post on the heap"""
+        self.queued[post.key] = post
+        heapq.heappush(self.heap, (post.priority, post.sequence, post.key))
+
+    def _next_sequence(self):
+        """Increasing number - keeps equal priority posts in order"""
+        self.sequence += 1
+        return self.sequence
+
+    def _overflow_victim(self):
+        """Queued post to drop when full - lowest priority, then newest"""
+        return max(self.queued.values(), key=lambda post: (post.priority, post.sequence))
+
+    @staticmethod
+    def _within(times, key, now, seconds):
+        """True if key was recorded in times (key -> time) within seconds"""
+        recorded_at = times.get(key)
+        if recorded_at is None:
+            return False
+        if now - recorded_at < seconds:
+            return True
+        del times[key]
+        return False
+
+    @staticmethod
+    def _prune(times, now, seconds):
+        """Forget keys recorded more than seconds ago (oldest first)"""
+        while times:
+            key, recorded_at = next(iter(times.items()))
+            if now - recorded_at < seconds:
+                break
+            del times[key]
+
+    @staticmethod
+    def _record(times, key, now):
+        """Record key at now - re-inserted at the end, so times stays in order"""
+        times.pop(key, None)
+        times[key] = now
+
+    def submit(self, key, text, priority=PRIORITY_NORMAL):
+        """
+        Queue a post - returns False if it was refused or dropped
+        Posting for a key already waiting updates its text instead
+        """
+        with self.condition:
+            now = self.clock()
+            self.counters["submitted"] += 1
+            if (key == self.in_flight) or self._within(
+                self.recently_sent, key, now, self.dedupe_seconds
+            ):
+                self.counters["merged"] += 1
+                return False
+            if self._within(self.gave_up, key, now, self.give_up_seconds):
+                self.counters["suppressed"] += 1
+                return False
+            queued_post = self.queued.get(key)
+            if queued_post is not None:
+                queued_post.text = text
+                if priority < queued_post.priority:
+                    # Re-push - the stale heap entry is skipped when popped
+                    queued_post.priority = priority
+                    queued_post.sequence = self._next_sequence()
+                    heapq.heappush(
+                        self.heap,
+                        (queued_post.priority, queued_post.sequence, queued_post.key),
+                    )
+                self.counters["merged"] += 1
+                return True
+            if len(self.queued) >= self.max_queue:
+                victim = self._overflow_victim()
+                if (priority > victim.priority) or (
+                    (priority == victim.priority)
+                    and (self.overflow != OVERFLOW_DROP_QUEUED)
+                ):
+                    self.counters["dropped"] += 1
+                    logger.info("Publisher queue full - dropping post for %s", key)
+                    return False
+                del self.queued[victim.key]
+                self.counters["dropped"] += 1
+                logger.info("Publisher queue full - dropping post for %s", victim.key)
+            self._push(QueuedPost(key, text, priority, self._next_sequence()))
+            self.condition.notify()
+            return True
+
+    def _pop(self):
+        """Highest priority queued post, or None"""
+        while self.heap:
+            _, sequence, key = heapq.heappop(self.heap)
+            post = self.queued.get(key)
+            if (post is not None) and (post.sequence == sequence):
+                del self.queued[key]
+                return post
+        return None
+
+    def _backoff(self):
+        """Seconds to wait after the current run of failures"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (self.failures - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _wait(self, seconds):
+        """Sleep, waking early if the publisher is closed"""
+        if seconds > 0:
+            self.stopping.wait(seconds)
+        return not self.stopping.is_set()
+
+    def _report(self, key, success):
+        """Tell on_result how a post ended"""
+        if self.on_result is None:
+            return
+        try:
+            self.on_result(key, success)
+        except Exception as err:
+            logger.error("Publisher result callback failed for %s: %s", key, err)
+
+    def _run(self):
+        """Publisher thread - send queued posts until closed"""
+        while not self.stopping.is_set():
+            with self.condition:
+                while (not self.queued) and (not self.stopping.is_set()):
+                    self.condition.wait()
+            if not self._wait(self.resume_at - self.clock()):
+                return
+            if not self._wait(self.bucket.wait_time()):
+                return
+            with self.condition:
+                post = self._pop()
+                if post is None:
+                    continue
+                self.bucket.take()
+                self.in_flight = post.key
+            post.attempts += 1
+            try:
+                success = bool(self.send(post.text))
+            except Exception as err:
+                logger.error("Publisher - post for %s failed: %s", post.key, err)
+                success = False
+            self._finish(post, success)
+
+    def _finish(self, post, success):
+        """Record the outcome of one attempt, requeueing it if worth retrying"""
+        if success:
+            self.failures = 0
+            self.resume_at = 0.0
+            # Reported before in_flight is cleared, so the key is never free
+            # to be queued again while the caller has not seen the result
+            self._report(post.key, True)
+            with self.condition:
+                now = self.clock()
+                self._prune(self.recently_sent, now, self.dedupe_seconds)
+                self._record(self.recently_sent, post.key, now)
+                self.counters["sent"] += 1
+                self.in_flight = None
+            return
+        self.failures += 1
+        self.resume_at = self.clock() + self._backoff()
+        with self.condition:
+            self.in_flight = None
+            if post.key in self.queued:
+                # A newer post for the same key arrived meanwhile - it wins
+                self.counters["merged"] += 1
+                return
+            give_up = post.attempts >= self.max_attempts
+            if give_up:
+                now = self.clock()
+                self._prune(self.gave_up, now, self.give_up_seconds)
+                self._record(self.gave_up, post.key, now)
+                self.counters["failed"] += 1
+            else:
+                self.counters["retried"] += 1
+                self._push(post)
+        if give_up:
+            self._report(post.key, False)
@@ -2,9 +2,8 @@
 
 wget https://opensky-network.org/datasets/metadata/aircraftDatabase.csv
 
-# FIXME: Need to find and eliminate duplicate records or the sqlite process
-# will fail to create an index
-
-sqlite3 < load.sql
+# Streams the CSV into a compact table (icao24 as an integer primary key),
+# keeping only the columns Barkley uses and de-duplicating icao24 rows
+python3 "$(dirname "$0")/../global_db_builder.py" aircraftDatabase.csv global_db.sqlite3
 
 echo "Should now have a new sqlite3 file that can be moved over the active one "
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+State Store - Incremental, crash-safe persistence of known_aircraft.
+
+Each Aircraft is stored as its own row in an SQLite database running in WAL
+mode. Aircraft records carry a revision number that is bumped whenever the
+record changes ; a save only writes the rows whose revision differs from the
+one last written, and deletes the rows for aircraft that have aged out.
+
+Being seen again does not change the revision, so a row is also rewritten
+once its last seen time has moved on by seen_interval seconds - otherwise an
+aircraft that sits still would be restored with a stale last seen time and
+aged out straight away.
+
+Every save is a single transaction, so a crash part way through leaves the
+previous consistent state on disk rather than a truncated pickle file.
+"""
+
+import os
+import pickle
+import sqlite3
+import time
+
+
+class StateStore:
+    """SQLite backed store for the known_aircraft dictionary"""
+
+    def __init__(self, db_file, check_same_thread=True, seen_interval=60.0):
+        """
+        Open (or create) the state database
+        - check_same_thread = False lets a worker thread save
+        - seen_interval = seconds last seen may lag behind on disk
+        """
+        self.db_file = db_file
+        self.seen_interval = seen_interval
+        self.conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS aircraft ("
+            " hexcode TEXT PRIMARY KEY,"
+            " revision INTEGER NOT NULL,"
+            " record BLOB NOT NULL)"
+        )
+        self.conn.commit()
+        # hexcode -> revision / last seen time currently on disk
+        self.saved_revisions = {}
+        self.saved_seen = {}
+        self.load_seconds = 0.0
+
+    def close(self):
+        """Close the database"""
+        self.conn.close()
+
+    def load(self):
+        """
+        Restore the known_aircraft dictionary
+        Rows that fail to unpickle are dropped rather than stopping startup
+        """
+        start_time = time.perf_counter()
+        known_aircraft = {}
+        bad_rows = []
+        for hexcode, revision, record in self.conn.execute(
+            "SELECT hexcode, revision, record FROM aircraft"
+        ):
+            try:
+                known_aircraft[hexcode] = pickle.loads(record)
+            except Exception:
+                bad_rows.append((hexcode,))
+                continue
+            self.saved_revisions[hexcode] = revision
+            self.saved_seen[hexcode] = known_aircraft[hexcode].last_seen_time()
+        if bad_rows:
+            with self.conn:
+                self.conn.executemany("DELETE FROM aircraft WHERE hexcode = ?", bad_rows)
+        self.load_seconds = time.perf_counter() - start_time
+        return known_aircraft
+
+    def save(self, known_aircraft):
+        """
+        Write the changed and removed aircraft records
+        Returns (rows written, rows deleted)
+        """
+        changed = []
+        saved_seen = self.saved_seen
+        for hexcode, craft in known_aircraft.items():
+            revision = craft.revision()
+            last_seen = craft.last_seen_time()
+            if (self.saved_revisions.get(hexcode) != revision) or (
+                last_seen - saved_seen[hexcode] >= self.seen_interval
+            ):
+                changed.append(
+                    (
+                        hexcode,
+                        revision,
+                        pickle.dumps(craft, protocol=pickle.HIGHEST_PROTOCOL),
+                        last_seen,
+                    )
+                )
+        removed = [
+            (hexcode,) for hexcode in self.saved_revisions if hexcode not in known_aircraft
+        ]
+        if (not changed) and (not removed):
+            return (0, 0)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO aircraft (hexcode, revision, record) VALUES (?, ?, ?) "
+                "ON CONFLICT(hexcode) DO UPDATE SET "
+                "revision = excluded.revision, record = excluded.record",
+                [row[:3] for row in changed],
+            )
+            self.conn.executemany("DELETE FROM aircraft WHERE hexcode = ?", removed)
+        for hexcode, revision, _, last_seen in changed:
+            self.saved_revisions[hexcode] = revision
+            saved_seen[hexcode] = last_seen
+        for (hexcode,) in removed:
+            del self.saved_revisions[hexcode]
+            del saved_seen[hexcode]
+        return (len(changed), len(removed))
+
+    def import_pickle(self, pickle_file):
+        """
+        One off migration from the old full-dump known_aircraft.pkl
+        Returns the imported dictionary (empty if there is nothing to import)
+        """
+        if not os.path.isfile(pickle_file):
+            return {}
+        with open(pickle_file, "rb") as legacy_file:
+            known_aircraft = pickle.load(legacy_file)
+        self.save(known_aircraft)
+        return known_aircraft
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the airspace registry and its batch containment masks"""
+
+import numpy as np
+import pytest
+
+import airspace
+import geocalc
+
+# A triangle with a square notch - [lon, lat] as in GeoJSON
+TRIANGLE = [[-122.4, 47.4], [-122.0, 47.4], [-122.2, 47.8], [-122.4, 47.4]]
+SQUARE = [[-121.5, 47.0], [-121.0, 47.0], [-121.0, 47.5], [-121.5, 47.5]]
+HOLE = [[-121.4, 47.1], [-121.1, 47.1], [-121.1, 47.4], [-121.4, 47.4]]
+
+
+@pytest.fixture
+def registry():
+    registry = airspace.AirspaceRegistry(0.1)
+    registry.add(airspace.Airspace("triangle", [[TRIANGLE]], 0, 10000))
+    registry.add(airspace.Airspace("donut", [[SQUARE, HOLE]]))
+    registry.add(geocalc.Geocalc("box", 46.0, 46.5, -120.0, -120.5, 1000, 5000))
+    return registry
+
+
+def random_points(count=2000, seed=1):
+    rng = np.random.default_rng(seed)
+    lats = rng.uniform(45.8, 48.0, count)
+    lons = rng.uniform(-122.6, -119.8, count)
+    alts = rng.uniform(-500, 12000, count)
+    return lats, lons, alts
+
+
+def test_masks_match_point_queries(registry):
+    lats, lons, _ = random_points()
+    masks = registry.masks(lats, lons)
+    assert set(masks) == {"triangle", "donut", "box"}
+    assert all(mask.any() for mask in masks.values())
+    for index in range(lats.size):
+        inside = {entry.name() for entry in registry.query(lats[index], lons[index])}
+        for name, mask in masks.items():
+            assert mask[index] == (name in inside)
+
+
+def test_masks_honour_altitude_bands(registry):
+    lats, lons, alts = random_points()
+    flat = registry.masks(lats, lons)
+    banded = registry.masks(lats, lons, alts)
+    for name, mask in banded.items():
+        entry = registry[name]
+        expected = flat[name] & geocalc.altitude_band_mask(
+            alts, entry.altitude_lower, entry.altitude_upper
+        )
+        assert np.array_equal(mask, expected)
+    assert banded["box"].any()
+    assert not np.array_equal(banded["box"], flat["box"])
+
+
+def test_hole_is_outside():
+    donut = airspace.Airspace("donut", [[SQUARE, HOLE]])
+    mask = donut.inside2D_batch([47.05, 47.25], [-121.25, -121.25])
+    assert mask.tolist() == [True, False]
+    assert donut.contains(47.05, -121.25)
+    assert not donut.contains(47.25, -121.25)
+
+
+def test_unknown_positions_are_never_inside(registry):
+    masks = registry.masks([np.nan, 47.5], [-122.2, np.nan])
+    assert masks == {}
+    assert registry.query(None, -122.2) == []
+
+
+def test_removed_airspace_is_not_tested(registry):
+    lats, lons, _ = random_points(200)
+    registry.remove("triangle")
+    assert "triangle" not in registry
+    assert "triangle" not in registry.masks(lats, lons)
+    assert all(entry.name() != "triangle" for entry in registry.query(47.5, -122.2))
+
+
+def test_altitude_value():
+    assert np.isnan(airspace.altitude_value(None))
+    assert airspace.altitude_value("ground") == 0.0
+    assert airspace.altitude_value(3500) == 3500.0
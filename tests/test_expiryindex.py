@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the last seen ordered expiry index"""
+
+import aircraft
+import expiryindex
+
+
+def test_expire_returns_only_the_aircraft_seen_before_cutoff():
+    index = expiryindex.ExpiryIndex()
+    index.touch("a00001", 10.0)
+    index.touch("a00002", 20.0)
+    index.touch("a00003", 30.0)
+    index.touch("a00001", 40.0)
+    assert index.expire(25.0) == ["a00002"]
+    assert index.expire(25.0) == []
+    assert len(index) == 2
+    assert "a00002" not in index
+    assert index.expired_count == 1
+
+
+def test_evict_drops_least_recently_seen_over_the_cap():
+    index = expiryindex.ExpiryIndex(max_entries=2)
+    for number, timestamp in enumerate((10.0, 20.0, 30.0, 40.0)):
+        index.touch("a0000%d" % number, timestamp)
+    assert index.evict() == ["a00000", "a00001"]
+    assert list(index.last_seen) == ["a00002", "a00003"]
+    assert index.evict() == []
+    assert index.evicted_count == 2
+
+
+def test_evict_keeps_the_latest_snapshot():
+    index = expiryindex.ExpiryIndex(max_entries=1)
+    index.touch("a00000", 10.0)
+    for number in range(1, 4):
+        index.touch("a0000%d" % number, 20.0)
+    assert index.evict() == ["a00000"]
+    assert len(index) == 3
+
+
+def test_rebuild_orders_restored_aircraft_by_last_seen():
+    known_aircraft = {}
+    for hexcode, timestamp in (("a00001", 30.0), ("a00002", 10.0), ("a00003", 20.0)):
+        craft = aircraft.Aircraft({"hex": hexcode})
+        craft.seen(timestamp)
+        known_aircraft[hexcode] = craft
+    index = expiryindex.ExpiryIndex()
+    index.rebuild(known_aircraft)
+    assert list(index.last_seen) == ["a00002", "a00003", "a00001"]
+    assert index.expire(25.0) == ["a00002", "a00003"]
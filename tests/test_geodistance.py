@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the batched aircraft to airport distance matrix"""
+
+import numpy as np
+import pytest
+from geopy import distance
+
+import aircraft
+import airports
+import geodistance
+
+# KSEA, KBFI, KPAE
+AIRPORT_POSITIONS = [(47.4490, -122.3093), (47.5300, -122.3020), (47.9063, -122.2816)]
+AIRCRAFT_POSITIONS = [(47.6062, -122.3321), (47.2529, -122.4443), (48.7519, -122.4787)]
+
+
+def test_haversine_matches_geopy_great_circle():
+    lats, lons = zip(*AIRCRAFT_POSITIONS)
+    airport_lats, airport_lons = zip(*AIRPORT_POSITIONS)
+    matrix = geodistance.haversine_matrix(lats, lons, airport_lats, airport_lons)
+    assert matrix.shape == (3, 3)
+    for row, craft_position in enumerate(AIRCRAFT_POSITIONS):
+        for column, airport_position in enumerate(AIRPORT_POSITIONS):
+            expected = distance.great_circle(craft_position, airport_position).miles
+            assert matrix[row, column] == pytest.approx(expected, rel=1e-6)
+
+
+def test_ellipsoid_within_metres_of_geopy_geodesic():
+    lats, lons = zip(*AIRCRAFT_POSITIONS)
+    airport_lats, airport_lons = zip(*AIRPORT_POSITIONS)
+    matrix = geodistance.distance_matrix(
+        lats, lons, airport_lats, airport_lons, method="ellipsoid"
+    )
+    for row, craft_position in enumerate(AIRCRAFT_POSITIONS):
+        for column, airport_position in enumerate(AIRPORT_POSITIONS):
+            expected = distance.geodesic(craft_position, airport_position).miles
+            # 10 metres
+            assert abs(matrix[row, column] - expected) < 10 / 1609.344
+
+
+def test_coincident_points_are_zero_apart():
+    lats, lons = zip(*AIRPORT_POSITIONS)
+    for method in geodistance.DISTANCE_METHODS:
+        matrix = geodistance.distance_matrix(lats, lons, lats, lons, method=method)
+        assert np.all(np.diag(matrix) == 0.0)
+
+
+def test_unknown_method_is_refused():
+    with pytest.raises(ValueError):
+        geodistance.distance_matrix([0.0], [0.0], [1.0], [1.0], method="flat")
+
+
+def test_update_airport_distances_records_every_pair():
+    airport_db = {
+        "KSEA": airports.Airport("KSEA", "SEA", 47.4490, -122.3093, 433),
+        "KBFI": airports.Airport("KBFI", "BFI", 47.5300, -122.3020, 21),
+    }
+    placed = aircraft.Aircraft({"hex": "a00001", "lat": 47.6062, "lon": -122.3321})
+    unplaced = aircraft.Aircraft({"hex": "a00002"})
+    matrix = geodistance.update_airport_distances([placed, unplaced], airport_db)
+    assert matrix.shape == (2, 2)
+    assert placed.get_airport_distance("KSEA") == pytest.approx(
+        distance.great_circle((47.6062, -122.3321), (47.4490, -122.3093)).miles
+    )
+    assert unplaced.get_airport_distance("KSEA") == -1
+    assert unplaced.get_airport_distance("KBFI") == -1
+
+
+def test_update_airport_distances_with_nothing_to_do():
+    assert geodistance.update_airport_distances([], {}) is None
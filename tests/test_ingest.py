@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the change-detecting aircraft.json reader"""
+
+import json
+import os
+
+import ingest
+
+
+def write_snapshot(path, now, aircraft=()):
+    """Replace the snapshot atomically, as dump1090 does"""
+    temp_path = str(path) + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+        json.dump({"now": now, "aircraft": list(aircraft)}, snapshot_file)
+    os.replace(temp_path, path)
+
+
+def test_reads_each_new_snapshot_once(tmp_path):
+    path = tmp_path / "aircraft.json"
+    reader = ingest.SnapshotReader(str(path))
+    write_snapshot(path, 100.0, [{"hex": "a00001"}])
+    snapshot = reader.read()
+    assert snapshot["now"] == 100.0
+    assert snapshot["aircraft"] == [{"hex": "a00001"}]
+    assert reader.read() is None
+    write_snapshot(path, 101.0)
+    assert reader.read()["now"] == 101.0
+    assert (reader.processed(), reader.skipped()) == (2, 1)
+
+
+def test_missing_file_is_skipped(tmp_path):
+    reader = ingest.SnapshotReader(str(tmp_path / "aircraft.json"))
+    assert not reader.changed()
+    assert reader.read() is None
+    assert reader.skipped() == 1
+
+
+def test_rewrite_without_newer_data_is_skipped(tmp_path):
+    path = tmp_path / "aircraft.json"
+    reader = ingest.SnapshotReader(str(path))
+    write_snapshot(path, 100.0)
+    assert reader.read() is not None
+    write_snapshot(path, 100.0, [{"hex": "a00001"}])
+    assert reader.read() is None
+    assert not reader.changed()
+
+
+def test_half_written_snapshot_is_read_again(tmp_path):
+    path = tmp_path / "aircraft.json"
+    reader = ingest.SnapshotReader(str(path))
+    path.write_text('{"now": 100.0, "aircr', encoding="utf-8")
+    assert reader.read() is None
+    # The signature is not taken, so the same file is tried again
+    assert reader.changed()
+    write_snapshot(path, 100.0)
+    assert reader.read()["now"] == 100.0
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the rate limited, retrying publisher"""
+
+import threading
+
+import pytest
+
+import publisher
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Results:
+    """on_result callback that can be waited on"""
+
+    def __init__(self):
+        self.outcomes = []
+        self.condition = threading.Condition()
+
+    def __call__(self, key, success):
+        with self.condition:
+            self.outcomes.append((key, success))
+            self.condition.notify_all()
+
+    def wait_for(self, count, timeout=5.0):
+        with self.condition:
+            assert self.condition.wait_for(
+                lambda: len(self.outcomes) >= count, timeout
+            ), self.outcomes
+        return list(self.outcomes)
+
+
+def fast_publisher(send, results, **kwargs):
+    """Publisher that is not slowed down by rate limits or backoff"""
+    options = {"rate": 1000.0, "burst": 10, "backoff_base": 0.001, "backoff_max": 0.01}
+    options.update(kwargs)
+    return publisher.Publisher(send, results, **options)
+
+
+def test_token_bucket_limits_the_rate():
+    clock = FakeClock()
+    bucket = publisher.TokenBucket(rate=0.5, burst=2, clock=clock)
+    assert bucket.take() and bucket.take()
+    assert not bucket.take()
+    assert bucket.wait_time() == pytest.approx(2.0)
+    clock.now = 2.0
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_posts_for_the_same_key_are_merged():
+    post_publisher = publisher.Publisher(lambda text: True)
+    assert post_publisher.submit("a00001", "first")
+    assert post_publisher.submit("a00001", "second")
+    assert len(post_publisher) == 1
+    assert post_publisher.queued["a00001"].text == "second"
+    assert post_publisher.stats()["merged"] == 1
+
+
+def test_full_queue_drops_the_newest_queued_post():
+    post_publisher = publisher.Publisher(lambda text: True, max_queue=2)
+    post_publisher.submit("a00001", "one")
+    post_publisher.submit("a00002", "two")
+    assert post_publisher.submit("a00003", "three")
+    # The oldest post is next to be sent, so it is kept
+    assert set(post_publisher.queued) == {"a00001", "a00003"}
+    assert post_publisher.stats()["dropped"] == 1
+
+
+def test_full_queue_refuses_new_posts_under_drop_newest():
+    post_publisher = publisher.Publisher(
+        lambda text: True, max_queue=2, overflow=publisher.OVERFLOW_DROP_NEWEST
+    )
+    post_publisher.submit("a00001", "one")
+    post_publisher.submit("a00002", "two")
+    assert not post_publisher.submit("a00003", "three")
+    assert set(post_publisher.queued) == {"a00001", "a00002"}
+
+
+def test_emergency_displaces_normal_post_and_is_sent_first():
+    sent = []
+    results = Results()
+    post_publisher = fast_publisher(
+        lambda text: sent.append(text) or True, results, max_queue=2
+    )
+    post_publisher.submit("a00001", "one")
+    post_publisher.submit("a00002", "two")
+    assert post_publisher.submit("a00003", "mayday", publisher.PRIORITY_EMERGENCY)
+    post_publisher.start()
+    try:
+        results.wait_for(2)
+    finally:
+        post_publisher.close(5)
+    assert sent == ["mayday", "one"]
+
+
+def test_sent_key_is_not_queued_again():
+    results = Results()
+    post_publisher = fast_publisher(lambda text: True, results).start()
+    try:
+        post_publisher.submit("a00001", "one")
+        assert results.wait_for(1) == [("a00001", True)]
+        assert not post_publisher.submit("a00001", "again")
+    finally:
+        post_publisher.close(5)
+
+
+def test_failed_post_is_retried():
+    attempts = []
+
+    def send(text):
+        attempts.append(text)
+        if len(attempts) < 3:
+            raise RuntimeError("unavailable")
+        return True
+
+    results = Results()
+    post_publisher = fast_publisher(send, results).start()
+    try:
+        post_publisher.submit("a00001", "one")
+        assert results.wait_for(1) == [("a00001", True)]
+    finally:
+        post_publisher.close(5)
+    assert len(attempts) == 3
+    assert post_publisher.stats()["retried"] == 2
+
+
+def test_given_up_key_is_suppressed_for_the_cooldown():
+    clock = FakeClock()
+    post_publisher = publisher.Publisher(
+        lambda text: False, max_attempts=1, give_up_seconds=60.0, clock=clock
+    )
+    post_publisher.submit("a00001", "one")
+    post = post_publisher._pop()
+    post.attempts = 1
+    post_publisher._finish(post, False)
+    assert post_publisher.stats()["failed"] == 1
+    assert not post_publisher.submit("a00001", "again")
+    assert post_publisher.stats()["suppressed"] == 1
+    clock.now = 61.0
+    assert post_publisher.submit("a00001", "later")
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the incremental SQLite state store"""
+
+import pickle
+
+import pytest
+
+import aircraft
+import statestore
+
+
+def make_aircraft(hexcode, last_seen=1000.0):
+    craft = aircraft.Aircraft({"hex": hexcode, "flight": "TEST1", "alt_baro": 3000})
+    craft.seen(last_seen)
+    return craft
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = statestore.StateStore(str(tmp_path / "state.sqlite3"), seen_interval=60.0)
+    yield store
+    store.close()
+
+
+def test_only_changed_and_removed_rows_are_written(store):
+    known_aircraft = {hexcode: make_aircraft(hexcode) for hexcode in ("a00001", "a00002")}
+    assert store.save(known_aircraft) == (2, 0)
+    assert store.save(known_aircraft) == (0, 0)
+    known_aircraft["a00001"].record_changed()
+    del known_aircraft["a00002"]
+    assert store.save(known_aircraft) == (1, 1)
+
+
+def test_load_restores_the_saved_records(store, tmp_path):
+    known_aircraft = {"a00001": make_aircraft("a00001", 1234.0)}
+    store.save(known_aircraft)
+    reopened = statestore.StateStore(str(tmp_path / "state.sqlite3"))
+    try:
+        restored = reopened.load()
+        assert list(restored) == ["a00001"]
+        assert restored["a00001"].flight() == "TEST1"
+        assert restored["a00001"].last_seen_time() == 1234.0
+        # Nothing changed since it was loaded
+        assert reopened.save(restored) == (0, 0)
+    finally:
+        reopened.close()
+
+
+def test_last_seen_is_saved_once_it_moves_on_by_the_interval(store):
+    craft = make_aircraft("a00001", 1000.0)
+    known_aircraft = {"a00001": craft}
+    store.save(known_aircraft)
+    craft.seen(1059.0)
+    assert store.save(known_aircraft) == (0, 0)
+    craft.seen(1060.0)
+    assert store.save(known_aircraft) == (1, 0)
+    assert store.saved_seen["a00001"] == 1060.0
+
+
+def test_unreadable_rows_are_dropped_on_load(store, tmp_path):
+    store.save({"a00001": make_aircraft("a00001")})
+    with store.conn:
+        store.conn.execute(
+            "INSERT INTO aircraft (hexcode, revision, record) VALUES (?, ?, ?)",
+            ("a00002", 0, b"not a pickle"),
+        )
+    reopened = statestore.StateStore(str(tmp_path / "state.sqlite3"))
+    try:
+        assert list(reopened.load()) == ["a00001"]
+        rows = reopened.conn.execute("SELECT hexcode FROM aircraft").fetchall()
+        assert rows == [("a00001",)]
+    finally:
+        reopened.close()
+
+
+def test_import_pickle_migrates_the_legacy_dump(store, tmp_path):
+    legacy_file = tmp_path / "known_aircraft.pkl"
+    with open(legacy_file, "wb") as legacy_out:
+        pickle.dump({"a00001": make_aircraft("a00001")}, legacy_out)
+    assert list(store.import_pickle(str(legacy_file))) == ["a00001"]
+    assert store.save({"a00001": store.load()["a00001"]}) == (0, 0)
+    assert store.import_pickle(str(tmp_path / "missing.pkl")) == {}
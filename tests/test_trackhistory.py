@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the track history ring buffers and the fleet history budget"""
+
+import math
+
+import aircraft
+import trackhistory
+
+
+def test_ring_buffer_keeps_the_latest_samples():
+    history = trackhistory.TrackHistory(capacity=3)
+    assert history.latest() is None
+    for timestamp in range(5):
+        history.append(float(timestamp), 47.0, -122.0, "ground", None, 90)
+    assert len(history) == 3
+    assert [sample[0] for sample in history.samples()] == [2.0, 3.0, 4.0]
+    latest = history.latest()
+    assert latest[:4] == (4.0, 47.0, -122.0, 0.0)
+    assert math.isnan(latest[4])
+
+
+def test_budget_refuses_histories_over_the_cap():
+    budget = trackhistory.HistoryBudget(capacity=4)
+    budget.max_bytes = 2 * budget.sample_bytes()
+    first = budget.allocate()
+    second = budget.allocate()
+    assert (first is not None) and (second is not None)
+    assert budget.allocate() is None
+    assert budget.refused == 1
+    budget.release(first)
+    assert budget.used_bytes() == budget.sample_bytes()
+    assert budget.history_count() == 1
+
+
+def test_freed_history_goes_to_the_aircraft_waiting_longest():
+    budget = trackhistory.HistoryBudget(capacity=4)
+    budget.max_bytes = budget.sample_bytes()
+    fleet = [aircraft.Aircraft({"hex": "a0000%d" % number}) for number in range(3)]
+    for craft in fleet:
+        budget.attach(craft)
+    assert fleet[0].history is not None
+    assert (fleet[1].history is None) and (fleet[2].history is None)
+    assert budget.waiting_count() == 2
+    budget.detach(fleet[0])
+    assert fleet[0].history is None
+    assert fleet[1].history is not None
+    assert fleet[2].history is None
+    assert budget.waiting_count() == 1
+    # An aircraft that ages out while waiting leaves the queue
+    budget.detach(fleet[2])
+    assert budget.waiting_count() == 0
+    assert budget.history_count() == 1
+
+
+def test_samples_are_stamped_with_the_snapshot_time():
+    budget = trackhistory.HistoryBudget(capacity=4)
+    craft = aircraft.Aircraft({"hex": "a00001"})
+    budget.attach(craft)
+    craft.update({"hex": "a00001", "lat": 47.5, "lon": -122.3, "alt_baro": 2500}, 1234.0)
+    assert craft.history.latest()[:4] == (1234.0, 47.5, -122.3, 2500.0)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Track History - Bounded record of where each aircraft has been.
+
+Each tracked aircraft can hold a TrackHistory ring buffer of
+(timestamp, lat, lon, alt, gs, track) samples. The buffer is one flat
+preallocated array of doubles, so an append is O(1) and the memory used
+per aircraft is fixed. Once full, the oldest sample is overwritten.
+
+A HistoryBudget hands out the buffers and keeps the total across the fleet
+under a cap - when the cap is reached new aircraft are tracked without a
+history and wait in line ; as older aircraft age out and release theirs,
+the freed buffers go to the aircraft that have waited longest.
+"""
+
+import math
+from array import array
+from collections import OrderedDict
+
+SAMPLE_FIELDS = ("timestamp", "lat", "lon", "alt", "gs", "track")
+SAMPLE_WIDTH = len(SAMPLE_FIELDS)
+
+
+def _number(value):
+    """Sample value as a float - NaN if unknown (or 'ground' altitude is 0)"""
+    if value is None:
+        return math.nan
+    if value == "ground":
+        return 0.0
+    return float(value)
+
+
+class TrackHistory:
+    """Fixed size ring buffer of track samples"""
+
+    __slots__ = ("capacity", "buffer", "head", "count")
+
+    def __init__(self, capacity=120):
+        """Preallocate room for capacity samples"""
+        self.capacity = capacity
+        self.buffer = array("d", [math.nan]) * (capacity * SAMPLE_WIDTH)
+        self.head = 0
+        self.count = 0
+
+    def __getstate__(self):
+        """Pickle support"""
+        return (self.capacity, self.buffer, self.head, self.count)
+
+    def __setstate__(self, state):
+        """Pickle support"""
+        self.capacity, self.buffer, self.head, self.count = state
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        """Memory used by the sample buffer"""
+        return self.buffer.itemsize * len(self.buffer)
+
+    def append(self, timestamp, lat, lon, alt, gs, track):
+        """Add a sample, overwriting the oldest once full"""
+        offset = self.head * SAMPLE_WIDTH
+        buffer = self.buffer
+        buffer[offset] = timestamp
+        buffer[offset + 1] = _number(lat)
+        buffer[offset + 2] = _number(lon)
+        buffer[offset + 3] = _number(alt)
+        buffer[offset + 4] = _number(gs)
+        buffer[offset + 5] = _number(track)
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _sample(self, index):
+        """Sample number index (0 = oldest) as a tuple"""
+        start = (self.head - self.count + index) % self.capacity
+        offset = start * SAMPLE_WIDTH
+        return tuple(self.buffer[offset : offset + SAMPLE_WIDTH])
+
+    def latest(self):
+        """Most recent sample, or None if there are none"""
+        if self.count == 0:
+            return None
+        return self._sample(self.count - 1)
+
+    def samples(self):
+        """List of samples, oldest first"""
+        return [self._sample(index) for index in range(self.count)]
+
+
+class HistoryBudget:
+    """Hands out TrackHistory buffers while keeping total memory under a cap"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, capacity=120):
+        """
+        - max_bytes = total history memory allowed across the fleet
+        - capacity = samples per aircraft
+        """
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+        self.used = 0
+        self.histories = 0
+        self.refused = 0
+        # hexcode -> aircraft waiting for a history, longest waiting first
+        self.waiting = OrderedDict()
+
+    def sample_bytes(self):
+        """Memory needed for one aircraft's history"""
+        return self.capacity * SAMPLE_WIDTH * array("d").itemsize
+
+    def allocate(self):
+        """A new TrackHistory, or None if the fleet budget is used up"""
+        if self.used + self.sample_bytes() > self.max_bytes:
+            self.refused += 1
+            return None
+        history = TrackHistory(self.capacity)
+        self.used += history.nbytes()
+        self.histories += 1
+        return history
+
+    def release(self, history):
+        """Give back the memory of a history that is no longer needed"""
+        if history is None:
+            return
+        self.used -= history.nbytes()
+        self.histories -= 1
+
+    def attach(self, craft):
+        """
+        Give an aircraft a history - or, if the budget is used up,
+        queue it for one once another aircraft releases theirs
+        """
+        history = self.allocate()
+        if history is None:
+            self.waiting[craft.hexcode()] = craft
+            return
+        craft.attach_history(history)
+
+    def detach(self, craft):
+        """
+        Take back the history of an aircraft that is no longer tracked,
+        and hand the freed memory on to the aircraft waiting for it
+        """
+        self.waiting.pop(craft.hexcode(), None)
+        self.release(craft.detach_history())
+        while self.waiting and (self.used + self.sample_bytes() <= self.max_bytes):
+            _, waiting_craft = self.waiting.popitem(last=False)
+            waiting_craft.attach_history(self.allocate())
+
+    def waiting_count(self):
+        """Number of aircraft waiting for a history"""
+        return len(self.waiting)
+
+    def used_bytes(self):
+        """Total history memory in use across the fleet"""
+        return self.used
+
+    def history_count(self):
+        """Number of aircraft holding a history"""
+        return self.histories